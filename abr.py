@@ -0,0 +1,158 @@
+# NetStream - server-driven adaptive bitrate
+#
+# The page asks its camera for 720p30 and the browser's congestion control
+# keeps that resolution on a weak uplink, so the picture freezes instead of
+# degrading. The controller picks a rung of LADDER for every sender from the
+# stats batches its page reports (call-stats), and the page applies the rung
+# to its video senders with RTCRtpSender.setParameters (encoding-params).
+#
+# Hysteresis keeps it from oscillating: a sender steps down as soon as a batch
+# shows its uplink struggling, but steps up only after UPGRADE_HOLD healthy
+# batches in a row, at least UPGRADE_COOLDOWN seconds after its last change,
+# and only with headroom over the next rung's bitrate. A decision is a few
+# comparisons per batch, so every sender of every call gets one.
+import time
+
+from metrics import Counter
+
+
+class Rung:
+    __slots__ = ('max_bitrate', 'scale', 'max_framerate')
+
+    def __init__(self, max_bitrate, scale, max_framerate):
+        self.max_bitrate = max_bitrate  # bits per second
+        self.scale = scale  # scaleResolutionDownBy of the captured 1280x720
+        self.max_framerate = max_framerate
+
+    def params(self):
+        """The encoding parameters the page applies"""
+        return {'maxBitrate': self.max_bitrate, 'scaleResolutionDownBy': self.scale,
+                'maxFramerate': self.max_framerate}
+
+
+LADDER = (
+    Rung(2500000, 1.0, 30),  # 720p30
+    Rung(1200000, 1.5, 30),  # 480p30
+    Rung(600000, 2.0, 24),  # 360p24
+    Rung(300000, 4.0, 15),  # 180p15
+    Rung(150000, 4.0, 10),  # 180p10
+)
+DOWN_LOSS = 10.0  # % of packets the far end reports lost that forces a step down
+UP_LOSS = 2.0  # % of packets lost below which a batch counts as healthy
+DOWN_HEADROOM = 0.85  # step down when the estimated uplink falls under this share of the rung's bitrate
+UP_HEADROOM = 1.3  # step up only when the estimate covers the next rung's bitrate this many times over
+CPU_SHARE = 0.5  # share of samples with a CPU-limited encoder that forces a step down
+UPGRADE_HOLD = 2  # healthy batches in a row before a step up
+UPGRADE_COOLDOWN = 20  # seconds after any change before a step up
+
+
+class SenderState:
+    __slots__ = ('rung', 'healthy', 'changed_at')
+
+    def __init__(self, rung, now):
+        self.rung = rung
+        self.healthy = 0  # healthy batches since the last change or unhealthy batch
+        self.changed_at = now
+
+
+def _worst(samples, field, pick):
+    values = [sample[field] for sample in samples
+              if isinstance(sample.get(field), (int, float)) and not isinstance(sample.get(field), bool)]
+    return pick(values) if values else None
+
+
+class BitrateController:
+    """The rung every sender should encode at, by sid"""
+
+    def __init__(self):
+        self.senders = {}
+        self.overrides = {}  # call id -> rung index every sender of the call is pinned to
+        self.changes = Counter('netstream_abr_changes_total', 'Encoding rung changes pushed to senders',
+                               ['direction'])
+
+    @property
+    def metrics(self):
+        return (self.changes,)
+
+    def observe(self, sid, call_id, samples, now=None):
+        """Fold in a batch of a sender's stats; returns the Rung to push to it, or None to leave it be.
+
+        A sender's first batch always returns its rung, so a page that reconnected to
+        another process gets back in step with the controller.
+        """
+        now = time.monotonic() if now is None else now
+        state = self.senders.get(sid)
+        if state is None:
+            pinned = self.overrides.get(call_id)
+            state = self.senders[sid] = SenderState(pinned if pinned is not None else 0, now)
+            return LADDER[state.rung]
+        pinned = self.overrides.get(call_id)
+        if pinned is not None:
+            return self._move(state, pinned, 'override', now) if pinned != state.rung else None
+        target = self._decide(state, samples, now)
+        if target == state.rung:
+            return None
+        return self._move(state, target, 'down' if target > state.rung else 'up', now)
+
+    def _decide(self, state, samples, now):
+        rung = LADDER[state.rung]
+        loss = _worst(samples, 'send_loss_pct', max)
+        available = _worst(samples, 'available_kbps', min)
+        cpu = _worst(samples, 'cpu_limited', lambda values: sum(values) / len(values))
+        if loss is None and available is None and cpu is None:
+            return state.rung  # nothing measured yet, e.g. no peer connected
+        available = available * 1000 if available is not None else None
+        if ((loss is not None and loss >= DOWN_LOSS) or (cpu is not None and cpu >= CPU_SHARE)
+                or (available is not None and available < rung.max_bitrate * DOWN_HEADROOM)):
+            state.healthy = 0
+            target = state.rung + 1
+            if available is not None:
+                # Straight to the best rung the estimate carries, rather than one step per batch
+                while target < len(LADDER) - 1 and LADDER[target].max_bitrate > available * DOWN_HEADROOM:
+                    target += 1
+            return min(target, len(LADDER) - 1)
+        if state.rung == 0 or (loss is not None and loss >= UP_LOSS):
+            state.healthy = 0
+            return state.rung
+        if available is not None and available < LADDER[state.rung - 1].max_bitrate * UP_HEADROOM:
+            state.healthy = 0
+            return state.rung
+        state.healthy += 1
+        if state.healthy >= UPGRADE_HOLD and now - state.changed_at >= UPGRADE_COOLDOWN:
+            return state.rung - 1
+        return state.rung
+
+    def _move(self, state, target, direction, now):
+        state.rung = target
+        state.healthy = 0
+        state.changed_at = now
+        self.changes.inc(direction)
+        return LADDER[target]
+
+    def override(self, call_id, index, sids, now=None):
+        """Pin every sender of a call to LADDER[index]; returns [(sid, Rung)] to push right away"""
+        now = time.monotonic() if now is None else now
+        self.overrides[call_id] = index
+        pushes = []
+        for sid in sids:
+            state = self.senders.get(sid)
+            if state is not None and state.rung != index:
+                pushes.append((sid, self._move(state, index, 'override', now)))
+        return pushes
+
+    def clear_override(self, call_id):
+        """Let a call's senders adapt again, starting from the pinned rung"""
+        return self.overrides.pop(call_id, None) is not None
+
+    def rename(self, old_sid, new_sid):
+        state = self.senders.pop(old_sid, None)
+        if state is not None:
+            self.senders[new_sid] = state
+
+    def forget(self, sid):
+        self.senders.pop(sid, None)
+
+    def call_state(self, call_id, sids):
+        """{sid: rung index} of a call's senders that reported, and its override"""
+        return {'senders': {sid: self.senders[sid].rung for sid in sids if sid in self.senders},
+                'override': self.overrides.get(call_id)}
@@ -0,0 +1,240 @@
+# NetStream - asyncio/ASGI entry point
+#
+# Serves the signaling handlers of videoapp.py on python-socketio's
+# AsyncServer under an ASGI server (uvicorn), as an alternative to the gevent
+# WSGIServer and its gevent-websocket handler. The handlers are the same
+# functions, registered by signaling_event and called with the same Flask
+# request context (request.sid, request.args) the gevent path gives them, so
+# the event contract is the same by construction.
+#
+# The handlers are synchronous and call socketio.emit, join_room and
+# socketio.server.disconnect. videoapp.socketio.server is replaced with a
+# bridge that turns each of those into a task on the event loop; a handler's
+# emits are awaited before the server acknowledges the event, so everything a
+# connect handler sends (role-assigned, or the error of a rejected connection)
+# still reaches the client ahead of the CONNECT / CONNECT_ERROR packet.
+# Timers run on the loop too: call_later becomes loop.call_later and the
+# timing wheel ticks from a task. Flask's HTTP routes run on the loop thread,
+# the way they run on the hub under gevent.
+#
+#   python asgiapp.py --port 8080
+#   uvicorn asgiapp:application --port 8080
+#
+# Not available here: --workers and the message bus, --sfu, --turn, graceful
+# restart, ICE server probing (servers are handed out in configured order),
+# the hub monitor and the profiler.
+import asyncio
+import io
+import logging
+import os
+import time
+
+import socketio
+from flask import request
+
+import videoapp
+from logpipeline import configure_logging, parse_sample_rates
+from metrics import CountingJSON
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+gevent_eio = videoapp.socketio.server.eio
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', ping_interval=gevent_eio.ping_interval,
+                           ping_timeout=gevent_eio.ping_timeout, max_http_buffer_size=gevent_eio.max_http_buffer_size,
+                           json=CountingJSON(videoapp.EMITS, videoapp.EMIT_BYTES))
+
+
+class ServerBridge:
+    """Stands in for flask_socketio's server: the calls the handlers make, as tasks on the loop"""
+
+    def __init__(self, server):
+        self.server = server
+        self.tasks = set()  # keeps running tasks referenced until they finish
+        self.started = None  # tasks started by the handler running now, which it waits for
+
+    @property
+    def manager(self):
+        return self.server.manager
+
+    @property
+    def eio(self):
+        return self.server.eio
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if self.started is not None:
+            self.started.append(task)
+        return task
+
+    def emit(self, event, *args, **kwargs):
+        return self._spawn(self.server.emit(event, *args, **kwargs))
+
+    def disconnect(self, sid, namespace=None, **kwargs):
+        return self._spawn(self.server.disconnect(sid, namespace=namespace))
+
+    def enter_room(self, sid, room, namespace=None):
+        self.server.manager.basic_enter_room(sid, namespace or '/', room)
+
+    def leave_room(self, sid, room, namespace=None):
+        self.server.manager.basic_leave_room(sid, namespace or '/', room)
+
+
+bridge = videoapp.socketio.server = ServerBridge(sio)
+
+
+def socketio_environ(environ, scope=None):
+    """Complete Engine.IO's environ into one Flask builds a request from"""
+    scope = scope or environ.get('asgi.scope') or {}
+    environ.setdefault('wsgi.url_scheme', {'ws': 'http', 'wss': 'https'}.get(scope.get('scheme'),
+                                                                         scope.get('scheme', 'http')))
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    return environ
+
+
+async def run_handler(sid, environ, event, args):
+    """Run a signaling handler the way flask_socketio does, then wait for what it emitted"""
+    bridge.started = started = []
+    try:
+        with videoapp.app.request_context(environ):
+            request.sid = sid
+            request.namespace = '/'
+            request.event = {'message': event, 'args': args}
+            result = videoapp.signaling_events[event](*args)
+    finally:
+        bridge.started = None
+    if started:
+        await asyncio.gather(*started, return_exceptions=True)
+    return result
+
+
+def register(event):
+    if event == 'connect':
+        async def handler(sid, environ, auth=None):
+            return await run_handler(sid, socketio_environ(environ), event, (auth,))
+    else:
+        async def handler(sid, *args):
+            return await run_handler(sid, sio.get_environ(sid) or {}, event, args)
+    sio.on(event, handler)
+
+
+for name in videoapp.signaling_events:
+    register(name)
+
+
+async def serve_wsgi(scope, receive, send):
+    """Everything that is not Socket.IO: the Flask app, called on the loop thread"""
+    if scope['type'] != 'http':
+        await send({'type': 'websocket.close'})
+        return
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('127.0.0.1', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [int(status.split(' ', 1)[0]), headers]
+
+    chunks = videoapp.app(environ, start_response)
+    try:
+        started = False
+        # Chunk by chunk, so a streamed response (/transcripts/export) is never held whole in memory
+        for chunk in chunks:
+            if not started:
+                started = True
+                await send_start(send, response)
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not started:
+            await send_start(send, response)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def send_start(send, response):
+    status, headers = response
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+
+
+async def run_timers(wheel):
+    next_tick = time.monotonic() + wheel.tick
+    while True:
+        await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+        next_tick = wheel.catch_up(next_tick)
+
+
+async def startup():
+    loop = asyncio.get_running_loop()
+    videoapp.server_loop = 'asyncio'
+    videoapp.call_later = loop.call_later
+    # start() sees the wheel already running and leaves it alone
+    videoapp.timers.greenlet = loop.create_task(run_timers(videoapp.timers))
+
+
+application = socketio.ASGIApp(sio, other_asgi_app=serve_wsgi, on_startup=startup)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='NetStream Video Chat Server (asyncio/ASGI)')
+    parser.add_argument('--host', default='0.0.0.0', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'])
+    parser.add_argument('--log-sample', default='',
+                        help='per-event sampling rates, e.g. candidate=0.1,chat-message=0.5')
+    parser.add_argument('--chat-dir', default=videoapp.CHAT_DIR, help='directory for the on-disk chat history logs')
+    parser.add_argument('--transcript-dir', default=videoapp.TRANSCRIPT_DIR,
+                        help='directory for the on-disk transcripts')
+    parser.add_argument('--connect-rate', type=float, default=videoapp.CONNECT_RATE_LIMIT[0],
+                        help='connections accepted per second, with twice that as burst')
+    args = parser.parse_args()
+    configure_logging(getattr(logging, args.log_level), fmt=args.log_format,
+                      sample_rates=parse_sample_rates(args.log_sample))
+    videoapp.chat_store.directory = args.chat_dir
+    videoapp.transcripts.directory = args.transcript_dir
+    videoapp.connect_bucket = TokenBucket(args.connect_rate, 2 * args.connect_rate)
+
+    print('NetStream Video Chat Server (asyncio)')
+    print('-------------------------------------')
+    print(f'Local access: http://localhost:{args.port}')
+    logger.info('Server running on http://%s:%d (asyncio, pid %d)', args.host, args.port, os.getpid())
+    uvicorn.run(application, host=args.host, port=args.port, log_config=None, log_level=args.log_level.lower())
@@ -0,0 +1,129 @@
+# NetStream - content-hashed static assets
+#
+# The page's stylesheet and script and the vendored Socket.IO client are
+# written to static/ at startup under names that carry a hash of their
+# content (app.3f2a9c1e4b5d.js), each next to gzip and brotli variants that a
+# front proxy can serve as they are (nginx gzip_static / brotli_static). A
+# name never changes content, so browsers may keep them for a year without
+# revalidating: a repeat visit costs the page itself (a 304) and nothing
+# else. The server holds the variants in memory and serves them too.
+#
+# Each build keeps the files of the build before it, which a page rendered by
+# the previous process of a graceful restart still refers to, and deletes
+# older ones. Builds are told apart by file time: a build rewrites or touches
+# every file it serves.
+import gzip
+import hashlib
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+HASH_LENGTH = 12  # hex digits of the content hash in a file name
+SUFFIXES = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+ETAG_SUFFIXES = {'identity': '', 'gzip': '-gz', 'br': '-br'}
+PRELOAD_TYPES = {'text/css': 'style', 'application/javascript': 'script'}
+
+
+def precompress(body):
+    """{encoding: body} for every encoding this server can serve"""
+    variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    return variants
+
+
+def negotiate(variants, accept_encodings):
+    """The encoding among `variants` the request gives the highest q-value; q=0 refuses one"""
+    best, best_quality = 'identity', 0
+    for encoding in ('br', 'gzip'):  # on a tie, the smaller one
+        quality = accept_encodings.quality(encoding)
+        if encoding in variants and quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Asset:
+    __slots__ = ('name', 'mimetype', 'digest', 'variants', 'etags')
+
+    def __init__(self, name, mimetype, digest, variants):
+        self.name = name
+        self.mimetype = mimetype
+        self.digest = digest
+        self.variants = variants
+        # A strong ETag names one exact byte sequence, so each encoding gets its own
+        self.etags = {encoding: digest + ETAG_SUFFIXES[encoding] for encoding in variants}
+
+
+class AssetBundle:
+    """Hashed assets, by file name and by the logical name the page refers to them with"""
+
+    def __init__(self, directory, prefix='/static/'):
+        self.directory = directory
+        self.prefix = prefix
+        self.assets = {}
+        self.logical = {}
+
+    def add(self, logical_name, body, mimetype):
+        digest = hashlib.sha256(body).hexdigest()
+        stem, extension = os.path.splitext(logical_name)
+        name = f'{stem}.{digest[:HASH_LENGTH]}{extension}'
+        variants = precompress(body)
+        os.makedirs(self.directory, exist_ok=True)
+        for encoding, data in variants.items():
+            self._write(name + SUFFIXES[encoding], data)
+        self.assets[name] = self.logical[logical_name] = Asset(name, mimetype, digest[:32], variants)
+        return self.url(logical_name)
+
+    def prune(self, keep=1):
+        """Delete the files of all but the `keep` most recent earlier builds; returns the names deleted"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        deleted = []
+        for logical_name, asset in self.logical.items():
+            stem, extension = os.path.splitext(logical_name)
+            pattern = re.compile(rf'{re.escape(stem)}\.([0-9a-f]{{{HASH_LENGTH}}}){re.escape(extension)}'
+                                 r'(?:\.gz|\.br)?')
+            builds = {}
+            for name in names:
+                match = pattern.fullmatch(name)
+                if match and match.group(1) != asset.digest[:HASH_LENGTH]:
+                    builds.setdefault(match.group(1), []).append(name)
+            ages = {}
+            for digest, files in builds.items():
+                try:
+                    ages[digest] = max(os.path.getmtime(os.path.join(self.directory, name)) for name in files)
+                except FileNotFoundError:  # pruned by another worker just now
+                    ages[digest] = 0.0
+            for digest in sorted(ages, key=ages.get, reverse=True)[keep:]:
+                for name in builds[digest]:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        continue
+                    deleted.append(name)
+        return deleted
+
+    def url(self, logical_name):
+        return self.prefix + self.logical[logical_name].name
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path) and os.path.getsize(path) == len(data):
+            os.utime(path)  # same name, so the same content: mark it as part of this build for prune
+            return
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def preload_links(self, logical_names):
+        """A Link header value asking the browser to fetch these assets right away"""
+        return ', '.join(f'<{self.url(logical)}>; rel=preload; as={PRELOAD_TYPES[self.logical[logical].mimetype]}'
+                         for logical in logical_names)
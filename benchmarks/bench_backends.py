@@ -0,0 +1,144 @@
+# NetStream - gevent vs asyncio server benchmark
+#
+# Starts the gevent server (videoapp.py) and the asyncio/ASGI server
+# (asgiapp.py) in turn and measures each the same way:
+# - capacity: idle participants, each seated in its own room, are connected in
+#   batches up to --connections; reports how many got a seat, the connect rate
+#   and the connect latency percentiles;
+# - memory: server RSS growth per connected participant while they are idle;
+# - relay latency: the two-party call flow of loadtest.py (offer, answer,
+#   candidates, chat, transcriptions) with its per-event percentiles.
+#
+#   python benchmarks/bench_backends.py --connections 2000 --calls 200
+#
+# The clients run in this one process, so at high counts the client side can
+# saturate before either server does; compare the backends at the same load.
+# Requires python-socketio's asyncio client and uvicorn.
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import socketio  # noqa: E402
+
+import loadtest  # noqa: E402
+
+BACKENDS = {'gevent': 'videoapp.py', 'asyncio': 'asgiapp.py'}
+SERVER_ARGS = ['--log-level', 'WARNING', '--connect-rate', '100000']
+SETTLE = 1.0  # seconds to let the server's RSS settle before reading it
+
+
+async def connect_idle(url, index, latencies):
+    client = socketio.AsyncClient(reconnection=False)
+    seated = asyncio.get_running_loop().create_future()
+    client.on('role-assigned', lambda data: seated.done() or seated.set_result(None))
+    start = time.perf_counter()
+    await client.connect(f'{url}?room=idle-{os.getpid()}-{index}', transports=['websocket'])
+    await seated
+    latencies.append(time.perf_counter() - start)
+    return client
+
+
+async def measure_capacity(url, pid, args):
+    await asyncio.sleep(SETTLE)
+    rss_before = loadtest.process_usage(pid)[1]
+    clients = []
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    for first in range(0, args.connections, args.batch):
+        batch = range(first, min(first + args.batch, args.connections))
+        results = await asyncio.gather(
+            *(asyncio.wait_for(connect_idle(url, i, latencies), args.timeout) for i in batch),
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                failures += 1
+            else:
+                clients.append(result)
+        if failures > args.connections // 20:
+            break  # past what the server (or this client) can take
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(SETTLE)
+    rss_after = loadtest.process_usage(pid)[1]
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+    latencies.sort()
+    return {
+        'connected': len(clients),
+        'failed': failures,
+        'connect_rate_per_s': len(clients) / elapsed if elapsed else 0.0,
+        'connect_p50_ms': loadtest.percentile(latencies, 0.50) * 1000,
+        'connect_p99_ms': loadtest.percentile(latencies, 0.99) * 1000,
+        'rss_mb': rss_after / 2**20,
+        'rss_kb_per_connection': (rss_after - rss_before) / len(clients) / 1024 if clients else float('nan'),
+    }
+
+
+def run_backend(name, args):
+    port = loadtest.free_port()
+    server = loadtest.start_server(port, SERVER_ARGS, script=BACKENDS[name])
+    url = f'http://127.0.0.1:{port}'
+    try:
+        loadtest.wait_ready(url)
+        report = asyncio.run(measure_capacity(url, server.pid, args))
+        report['calls'] = asyncio.run(loadtest.run(args, url, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+    return report
+
+
+def print_comparison(reports):
+    names = list(reports)
+    print(f"{'':<28}" + ''.join(f'{name:>14}' for name in names))
+
+    def row(label, values, fmt):
+        print(f'{label:<28}' + ''.join(f'{value:>14{fmt}}' for value in values))
+
+    for key, label, fmt in (('connected', 'connections held', 'd'), ('failed', 'connections failed', 'd'),
+                            ('connect_rate_per_s', 'connects/s', '.0f'),
+                            ('connect_p50_ms', 'connect p50 ms', '.2f'), ('connect_p99_ms', 'connect p99 ms', '.2f'),
+                            ('rss_mb', 'RSS MB (all connected)', '.1f'),
+                            ('rss_kb_per_connection', 'RSS KB per connection', '.1f')):
+        row(label, [reports[name][key] for name in names], fmt)
+    row('failed calls', [reports[name]['calls']['failed_calls'] for name in names], 'd')
+    row('call server CPU s/1k', [reports[name]['calls'].get('server_cpu_s_per_1k_sessions', float('nan'))
+                                 for name in names], '.2f')
+    events = sorted({event for name in names for event in reports[name]['calls']['latency']})
+    for event in events:
+        for quantile in ('p50_ms', 'p99_ms'):
+            row(f'{event} {quantile.replace("_", " ")}',
+                [reports[name]['calls']['latency'].get(event, {}).get(quantile, float('nan')) for name in names],
+                '.2f')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NetStream gevent vs asyncio server benchmark')
+    parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                        help='backend to measure (repeatable); default both')
+    parser.add_argument('--connections', type=int, default=2000, help='idle participants to hold at once')
+    parser.add_argument('--batch', type=int, default=200, help='participants connected at the same time')
+    parser.add_argument('--calls', type=int, default=200, help='two-party calls for the relay latency')
+    parser.add_argument('--concurrency', type=int, default=50, help='calls set up at the same time')
+    parser.add_argument('--candidates', type=int, default=12, help='candidates sent by each side')
+    parser.add_argument('--chat', type=int, default=5, help='chat messages per call')
+    parser.add_argument('--transcriptions', type=int, default=5, help='transcriptions per call')
+    parser.add_argument('--timeout', type=float, default=30.0, help='per-connection and per-call timeout in seconds')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    reports = {}
+    for name in args.backend or list(BACKENDS):
+        print(f'measuring {name} ({BACKENDS[name]})...', flush=True)
+        reports[name] = run_backend(name, args)
+    print_comparison(reports)
+
+
+if __name__ == '__main__':
+    main()
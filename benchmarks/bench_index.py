@@ -0,0 +1,71 @@
+# NetStream - index page throughput benchmark
+#
+# Compares the old per-request render_template_string(HTML) route with the
+# pre-rendered, precompressed index route, in-process through the WSGI stack,
+# then the hashed static assets the page loads, and what a first and a repeat
+# visit transfer in all.
+#
+#   python benchmarks/bench_index.py [--requests 2000]
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template_string  # noqa: E402
+
+import videoapp  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+
+@videoapp.app.route('/__bench/legacy-index')
+def legacy_index():
+    return render_template_string(videoapp.HTML, assets=videoapp.static_assets)
+
+
+def run(client, path, headers, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(path, headers=headers)
+        response.close()
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, len(response.data), response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the index page route')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    args = parser.parse_args()
+
+    client = videoapp.app.test_client()
+    etag = client.get('/', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    scenarios = [
+        ('legacy render per hit', '/__bench/legacy-index', {'Accept-Encoding': 'gzip, br'}),
+        ('prebuilt, identity', '/', {}),
+        ('prebuilt, gzip', '/', {'Accept-Encoding': 'gzip'}),
+        ('prebuilt, br', '/', {'Accept-Encoding': 'gzip, br'}),
+        ('prebuilt, 304 revalidate', '/', {'Accept-Encoding': 'gzip', 'If-None-Match': etag}),
+    ]
+    for logical in ('app.css', 'app.js', 'socket.io.min.js'):
+        scenarios.append((f'{logical}, br', videoapp.static_assets.url(logical), {'Accept-Encoding': 'gzip, br'}))
+
+    print(f"{'scenario':<28}{'req/s':>10}{'bytes':>10}{'status':>8}")
+    for name, path, headers in scenarios:
+        run(client, path, headers, min(args.requests, 100))  # warm up
+        rate, size, status = run(client, path, headers, args.requests)
+        print(f'{name:<28}{rate:>10.0f}{size:>10}{status:>8}')
+
+    # A repeat visit revalidates the page and finds every asset in its cache (immutable)
+    headers = {'Accept-Encoding': 'gzip, br'}
+    first = [client.get('/', headers=headers)] + [client.get(videoapp.static_assets.url(logical), headers=headers)
+                                                 for logical in ('app.css', 'app.js', 'socket.io.min.js')]
+    repeat = client.get('/', headers={**headers, 'If-None-Match': first[0].headers['ETag']})
+    print(f'\nfirst visit: {len(first)} requests, {sum(len(r.data) for r in first)} bytes; '
+          f'repeat visit: 1 request ({repeat.status_code}), {len(repeat.data)} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# NetStream - logging pipeline overhead benchmark
+#
+# Drives offer/answer/candidate/chat traffic through the real Socket.IO
+# handlers in-process and reports the mean handler latency recorded in
+# netstream_handler_latency_seconds for each logging configuration. Records
+# are written to a file so the synchronous modes pay for real write() calls.
+#
+#   python benchmarks/bench_logging.py [--calls 200] [--candidates 12]
+import argparse
+import itertools
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gevent  # noqa: E402
+
+import videoapp  # noqa: E402
+from logpipeline import configure_logging, stop_listener  # noqa: E402
+from ratelimit import TokenBucket  # noqa: E402
+
+EVENTS = ('offer', 'answer', 'candidate', 'chat-message')
+SCENARIOS = [
+    ('sync text', dict(mode='sync', fmt='text')),
+    ('sync json', dict(mode='sync', fmt='json')),
+    ('queue text', dict(mode='queue', fmt='text')),
+    ('queue json', dict(mode='queue', fmt='json')),
+    ('queue json, candidate=0.1', dict(mode='queue', fmt='json', sample_rates={'candidate': 0.1})),
+]
+ROOMS = itertools.count()
+
+
+def drive(calls, candidates):
+    for _ in range(calls):
+        # A fresh room each time: the seats of a call that just hung up are held for RESUME_GRACE
+        query = f'room=bench-log-{next(ROOMS)}'
+        host = videoapp.socketio.test_client(videoapp.app, query_string=query)
+        client = videoapp.socketio.test_client(videoapp.app, query_string=query)
+        host.emit('offer', {'offer': {'type': 'offer', 'sdp': 'v=0 offer'}})
+        client.emit('answer', {'answer': {'type': 'answer', 'sdp': 'v=0 answer'}})
+        for index in range(candidates):
+            client.emit('candidate', {'candidate': {'candidate': f'candidate:{index} 1 udp 1 10.0.0.1 {index} typ host'}})
+            host.emit('candidate', {'candidate': {'candidate': f'candidate:{index} 1 udp 1 10.0.0.2 {index} typ host'}})
+        client.emit('candidate', {'candidate': None})
+        host.emit('candidate', {'candidate': None})
+        client.emit('chat-message', 'hello there')
+        gevent.sleep(videoapp.CANDIDATE_FLUSH_WINDOW * 2)
+        client.disconnect()
+        host.disconnect()
+
+
+def mean_latency(event):
+    series = videoapp.HANDLER_LATENCY.series.get((event,))
+    if not series:
+        return 0.0
+    return series[-1] / sum(series[:-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark handler latency per logging mode')
+    parser.add_argument('--calls', type=int, default=200, help='calls per scenario')
+    parser.add_argument('--candidates', type=int, default=12, help='ICE candidates per side per call')
+    parser.add_argument('--level', default='DEBUG', choices=['DEBUG', 'INFO'],
+                        help='DEBUG includes the per-candidate record')
+    args = parser.parse_args()
+    # Every call connects two test clients back to back; keep the accept limit out of the way
+    videoapp.connect_bucket = TokenBucket(100000, 200000)
+
+    print(f"{'scenario':<28}" + ''.join(f'{event + " us":>16}' for event in EVENTS))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, options in SCENARIOS:
+            with open(os.path.join(tmp, 'bench.log'), 'w') as stream:
+                configure_logging(getattr(logging, args.level), stream=stream, **options)
+                drive(min(args.calls, 20), args.candidates)  # warm up
+                videoapp.HANDLER_LATENCY.series.clear()
+                drive(args.calls, args.candidates)
+                stop_listener()
+            print(f'{name:<28}' + ''.join(f'{mean_latency(event) * 1e6:>16.1f}' for event in EVENTS))
+
+
+if __name__ == '__main__':
+    main()
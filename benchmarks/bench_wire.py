@@ -0,0 +1,143 @@
+# NetStream - signaling wire format benchmark
+#
+# Encodes the messages of one call setup (offer, answer and batched candidates
+# in both directions) the way the server puts them on the wire, once as plain
+# JSON and once with the negotiated binary envelope (wirecodec.py), and reports
+# the websocket payload bytes and the server CPU to decode what it receives
+# and encode what it relays.
+#
+#   python benchmarks/bench_wire.py [--setups 2000]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from socketio import packet  # noqa: E402
+
+import wirecodec  # noqa: E402
+
+VIDEO_CODECS = [('VP8', ''), ('VP9', 'profile-id=0'), ('VP9', 'profile-id=2'),
+                ('H264', 'level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42001f'),
+                ('H264', 'level-asymmetry-allowed=1;packetization-mode=0;profile-level-id=42001f'),
+                ('H264', 'level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42e01f'),
+                ('H264', 'level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=4d001f'),
+                ('AV1', 'level-idx=5;profile=0;tier=0')]
+
+
+def make_candidate(rng, index, mid):
+    address = f'192.168.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+    kind = ('host', 'srflx', 'relay')[index % 3]
+    return {
+        'candidate': f'candidate:{rng.getrandbits(32)} 1 udp {rng.getrandbits(31)} {address} '
+                     f'{rng.randint(1024, 65535)} typ {kind} generation 0 ufrag Ab3d network-id 1',
+        'sdpMid': mid,
+        'sdpMLineIndex': int(mid),
+        'usernameFragment': 'Ab3d',
+    }
+
+
+def make_sdp(rng, kind):
+    """A Chrome-like audio + video session description of realistic size"""
+    lines = ['v=0', f'o=- {rng.getrandbits(62)} 2 IN IP4 127.0.0.1', 's=-', 't=0 0',
+             'a=group:BUNDLE 0 1', 'a=extmap-allow-mixed', 'a=msid-semantic: WMS stream']
+    fingerprint = ':'.join(f'{rng.getrandbits(8):02X}' for _ in range(32))
+    for mid, media in enumerate(('audio', 'video')):
+        payloads = list(range(111, 127)) if media == 'audio' else list(range(96, 96 + 2 * len(VIDEO_CODECS)))
+        lines += [f'm={media} 9 UDP/TLS/RTP/SAVPF ' + ' '.join(map(str, payloads)),
+                  'c=IN IP4 0.0.0.0', 'a=rtcp:9 IN IP4 0.0.0.0', 'a=ice-ufrag:Ab3d',
+                  f'a=ice-pwd:{rng.getrandbits(128):032x}', 'a=ice-options:trickle',
+                  f'a=fingerprint:sha-256 {fingerprint}', f'a=setup:{"actpass" if kind == "offer" else "active"}',
+                  f'a=mid:{mid}', 'a=sendrecv', 'a=rtcp-mux', 'a=rtcp-rsize']
+        for ext, uri in enumerate(('urn:ietf:params:rtp-hdrext:ssrc-audio-level',
+                                   'http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time',
+                                   'http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01',
+                                   'urn:ietf:params:rtp-hdrext:sdes:mid'), 1):
+            lines.append(f'a=extmap:{ext} {uri}')
+        if media == 'audio':
+            lines += ['a=rtpmap:111 opus/48000/2', 'a=rtcp-fb:111 transport-cc',
+                      'a=fmtp:111 minptime=10;useinbandfec=1']
+            lines += [f'a=rtpmap:{pt} telephone-event/8000' for pt in payloads[1:]]
+        else:
+            for index, (codec, params) in enumerate(VIDEO_CODECS):
+                pt, rtx = payloads[2 * index], payloads[2 * index + 1]
+                lines += [f'a=rtpmap:{pt} {codec}/90000', f'a=rtcp-fb:{pt} goog-remb',
+                          f'a=rtcp-fb:{pt} transport-cc', f'a=rtcp-fb:{pt} ccm fir',
+                          f'a=rtcp-fb:{pt} nack', f'a=rtcp-fb:{pt} nack pli']
+                if params:
+                    lines.append(f'a=fmtp:{pt} {params}')
+                lines += [f'a=rtpmap:{rtx} rtx/90000', f'a=fmtp:{rtx} apt={pt}']
+        ssrc = rng.getrandbits(32)
+        lines += [f'a=ssrc:{ssrc} cname:{rng.getrandbits(64):016x}', f'a=ssrc:{ssrc} msid:stream track{mid}']
+        lines += ['a=' + make_candidate(rng, i, str(mid))['candidate'] for i in range(3)]
+    return {'type': kind, 'sdp': '\r\n'.join(lines) + '\r\n'}
+
+
+def call_setup(rng, candidates, batch):
+    """(event, payload) pairs the server receives in one call setup, and those it relays"""
+    received = [('offer', {'offer': make_sdp(rng, 'offer')}), ('answer', {'answer': make_sdp(rng, 'answer')})]
+    relayed = list(received)
+    for _ in range(2):  # both sides trickle
+        side = [make_candidate(rng, i, str(i % 2)) for i in range(candidates)]
+        received += [('candidate', {'candidate': c}) for c in side] + [('candidate', {'candidate': None})]
+        for start in range(0, candidates, batch):
+            chunk = side[start:start + batch]
+            relayed.append(('candidates', {'candidates': chunk, 'done': start + batch >= candidates}))
+    return received, relayed
+
+
+def wire(event, payload):
+    encoded = packet.Packet(packet.EVENT, data=[event, payload], namespace='/').encode()
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+def wire_bytes(frames):
+    return sum(len(f.encode('utf-8')) if isinstance(f, str) else len(f) for f in frames)
+
+
+def decode(frames):
+    pkt = packet.Packet(encoded_packet=frames[0])
+    for attachment in frames[1:]:
+        pkt.add_attachment(attachment)
+    args = pkt.data[1:]
+    return [wirecodec.decode(arg) if isinstance(arg, bytes) else arg for arg in args]
+
+
+def run(received, relayed, binary, setups):
+    encode = wirecodec.encode if binary else (lambda data: data)
+    inbound = [wire(event, encode(payload)) for event, payload in received]  # what clients send
+    sent = sum(map(wire_bytes, inbound)) + sum(wire_bytes(wire(e, encode(p))) for e, p in relayed)
+    start = time.process_time()
+    for _ in range(setups):
+        for frames in inbound:
+            decode(frames)
+        for event, payload in relayed:
+            wire(event, encode(payload))
+    cpu = (time.process_time() - start) / setups
+    return sent, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark signaling bytes and CPU per call setup')
+    parser.add_argument('--setups', type=int, default=2000, help='call setups to time per format')
+    parser.add_argument('--candidates', type=int, default=12, help='ICE candidates per side')
+    parser.add_argument('--batch', type=int, default=4, help='candidates per relayed batch')
+    args = parser.parse_args()
+    if not wirecodec.available():
+        raise SystemExit('msgpack is not installed')
+
+    received, relayed = call_setup(random.Random(7), args.candidates, args.batch)
+    print(f'offer SDP {len(received[0][1]["offer"]["sdp"])} bytes, {args.candidates} candidates per side, '
+          f'threshold {wirecodec.COMPRESS_THRESHOLD} bytes')
+    print(f"{'format':<22}{'bytes/setup':>14}{'server CPU us/setup':>22}")
+    baseline = None
+    for name, binary in (('json', False), ('msgpack+deflate', True)):
+        sent, cpu = run(received, relayed, binary, args.setups)
+        baseline = baseline or sent
+        print(f'{name:<22}{sent:>14}{cpu * 1e6:>22.1f}   ({sent / baseline:.0%} of JSON bytes)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+# NetStream - signaling load test
+#
+# Starts videoapp.py on a free local port (or targets --url), then drives N
+# simulated two-party calls through the real Socket.IO signaling flow:
+# connect, ready-for-connection, offer/answer, then bursts of candidates,
+# chat messages and transcriptions. Reports the connect rate, relay latency
+# percentiles per event type and server CPU/RSS normalised per 1k sessions.
+#
+#   python benchmarks/loadtest.py --calls 500
+#   python benchmarks/loadtest.py --calls 500 --save baseline.json
+#   python benchmarks/loadtest.py --calls 500 --compare baseline.json
+#
+# Requires python-socketio's asyncio client: pip install "python-socketio[asyncio_client]"
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SDP_SIZE = 3000  # bytes of filler, roughly a real audio+video offer
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CONNECT_RATE = 100000  # --connect-rate for started servers, so the accept limit never shapes the results
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants (e.g. --workers processes)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def process_usage(pid):
+    """Return (cpu_seconds, rss_bytes) of a local process and its children from /proc"""
+    cpu = rss = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{current}/statm') as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK
+    return cpu, rss
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, extra_args, script='videoapp.py'):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, script), '--host', '127.0.0.1', '--port', str(port),
+         '--connect-rate', str(CONNECT_RATE)] + extra_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('server did not start listening')
+
+
+def wait_ready(url, timeout=20):
+    """Wait until the app answers HTTP, which with --workers means a worker is up"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not become ready')
+
+
+class Recorder:
+    """Collects relay latencies per event type"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, event, sent_at):
+        self.samples.setdefault(event, []).append(time.perf_counter() - sent_at)
+
+    def summary(self):
+        result = {}
+        for event, values in sorted(self.samples.items()):
+            values.sort()
+            result[event] = {
+                'count': len(values),
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p95_ms': percentile(values, 0.95) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+            }
+        return result
+
+
+class Participant:
+    """One simulated browser tab; every payload carries its send timestamp"""
+
+    def __init__(self, url, room_id, recorder):
+        self.url = url
+        self.room_id = room_id
+        self.recorder = recorder
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.role = asyncio.get_running_loop().create_future()
+        self.events = {}
+        self.sio.on('role-assigned', self.on_role)
+        self.sio.on('initiate-connection', self.on_initiate)
+        self.sio.on('offer', lambda data: self.on_relay('offer', data['offer']['ts']))
+        self.sio.on('answer', lambda data: self.on_relay('answer', data['answer']['ts']))
+        self.sio.on('candidates', self.on_candidates)
+        self.sio.on('chat-message', self.on_chat)
+        self.sio.on('transcription', self.on_transcription)
+
+    def expect(self, event, count=1):
+        self.events[event] = [count, asyncio.get_running_loop().create_future()]
+        if count <= 0:
+            self.events[event][1].set_result(None)
+        return self.events[event][1]
+
+    def arrived(self, event, count=1):
+        waiter = self.events.get(event)
+        if waiter is not None:
+            waiter[0] -= count
+            if waiter[0] <= 0 and not waiter[1].done():
+                waiter[1].set_result(None)
+
+    async def connect(self):
+        await self.sio.connect(f'{self.url}?room={self.room_id}', transports=['websocket'])
+        return await self.role
+
+    def on_role(self, data):
+        if not self.role.done():
+            self.role.set_result(data['isHost'])
+
+    def on_initiate(self, data):
+        self.arrived('initiate-connection')
+
+    def on_relay(self, event, sent_at):
+        self.recorder.record(event, sent_at)
+        self.arrived(event)
+
+    def on_candidates(self, data):
+        for candidate in data['candidates']:
+            self.recorder.record('candidate', candidate['ts'])
+        self.arrived('candidate', len(data['candidates']))
+
+    def on_chat(self, message, seq=None):
+        _, _, stamp = message.partition('ts=')
+        if self.sio.get_sid() not in message:
+            self.recorder.record('chat-message', float(stamp))
+            self.arrived('chat-message')
+
+    def on_transcription(self, data):
+        if data['sender'] != self.sio.get_sid():
+            self.recorder.record('transcription', float(data['text'].partition('ts=')[2]))
+            self.arrived('transcription')
+
+
+async def run_call(index, url, recorder, participants, args):
+    room_id = f'bench-{os.getpid()}-{index}'
+    host = Participant(url, room_id, recorder)
+    client = Participant(url, room_id, recorder)
+    participants += [host, client]
+    start = time.perf_counter()
+    await host.connect()
+    await client.connect()
+    connect_time = time.perf_counter() - start
+
+    initiated = client.expect('initiate-connection')
+    await host.sio.emit('ready-for-connection')
+    await initiated
+
+    filler = 'x' * SDP_SIZE
+    offered = client.expect('offer')
+    await host.sio.emit('offer', {'offer': {'type': 'offer', 'sdp': filler, 'ts': time.perf_counter()}})
+    await offered
+    answered = host.expect('answer')
+    await client.sio.emit('answer', {'answer': {'type': 'answer', 'sdp': filler, 'ts': time.perf_counter()}})
+    await answered
+
+    waits = [client.expect('candidate', args.candidates), host.expect('candidate', args.candidates)]
+    for sender in (host, client):
+        for i in range(args.candidates):
+            await sender.sio.emit('candidate', {'candidate': {'candidate': f'candidate:{i} 1 udp', 'ts': time.perf_counter()}})
+    waits += [client.expect('chat-message', args.chat), client.expect('transcription', args.transcriptions)]
+    for _ in range(args.chat):
+        await host.sio.emit('chat-message', f'{host.sio.get_sid()} ts={time.perf_counter()}')
+    for _ in range(args.transcriptions):
+        await host.sio.emit('transcription', {'text': f'hello world ts={time.perf_counter()}'})
+    await asyncio.wait_for(asyncio.gather(*waits), timeout=args.timeout)
+    return connect_time
+
+
+async def run(args, url, server_pid):
+    recorder = Recorder()
+    participants = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            return await run_call(index, url, recorder, participants, args)
+
+    cpu_before, rss_before = process_usage(server_pid) if server_pid else (0, 0)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited(i) for i in range(args.calls)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    cpu_after, rss_after = process_usage(server_pid) if server_pid else (0, 0)
+
+    calls = [r for r in results if not isinstance(r, BaseException)]
+    failures = [r for r in results if isinstance(r, BaseException)]
+    sessions = 2 * len(calls)
+    await asyncio.gather(*(p.sio.disconnect() for p in participants), return_exceptions=True)
+
+    report = {
+        'calls': args.calls,
+        'failed_calls': len(failures),
+        'elapsed_s': elapsed,
+        'connect_rate_per_s': sessions / sum(calls) * min(args.concurrency, args.calls) if calls else 0.0,
+        'latency': recorder.summary(),
+    }
+    if server_pid and sessions:
+        report['server_cpu_s_per_1k_sessions'] = (cpu_after - cpu_before) / sessions * 1000
+        report['server_rss_mb_per_1k_sessions'] = (rss_after - rss_before) / sessions * 1000 / 2**20
+        report['server_rss_mb'] = rss_after / 2**20
+    if failures:
+        report['first_failure'] = repr(failures[0])
+    return report
+
+
+def print_report(report):
+    print(f"calls: {report['calls']}  failed: {report['failed_calls']}  elapsed: {report['elapsed_s']:.2f}s")
+    print(f"connect rate: {report['connect_rate_per_s']:.0f} sessions/s")
+    if 'server_cpu_s_per_1k_sessions' in report:
+        print(f"server CPU: {report['server_cpu_s_per_1k_sessions']:.2f} s per 1k sessions")
+        print(f"server RSS: +{report['server_rss_mb_per_1k_sessions']:.1f} MB per 1k sessions "
+              f"({report['server_rss_mb']:.1f} MB total)")
+    print(f"{'event':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for event, stats in report['latency'].items():
+        print(f"{event:<16}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+    if 'first_failure' in report:
+        print(f"first failure: {report['first_failure']}")
+
+
+def compare(report, baseline, max_regression):
+    """Return a list of metrics that regressed by more than max_regression (a fraction)"""
+    regressions = []
+    if report['connect_rate_per_s'] < baseline['connect_rate_per_s'] * (1 - max_regression):
+        regressions.append('connect_rate_per_s')
+    for event, stats in report['latency'].items():
+        base = baseline['latency'].get(event)
+        if base and stats['p95_ms'] > base['p95_ms'] * (1 + max_regression):
+            regressions.append(f'{event} p95')
+    for key in ('server_cpu_s_per_1k_sessions', 'server_rss_mb_per_1k_sessions'):
+        if key in report and key in baseline and report[key] > baseline[key] * (1 + max_regression):
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NetStream signaling load test')
+    parser.add_argument('--calls', type=int, default=200, help='number of two-party calls')
+    parser.add_argument('--concurrency', type=int, default=50, help='calls set up at the same time')
+    parser.add_argument('--candidates', type=int, default=12, help='candidates sent by each side')
+    parser.add_argument('--chat', type=int, default=5, help='chat messages per call')
+    parser.add_argument('--transcriptions', type=int, default=5, help='transcriptions per call')
+    parser.add_argument('--timeout', type=float, default=30.0, help='per-call timeout in seconds')
+    parser.add_argument('--url', help='target a running server instead of starting one')
+    parser.add_argument('--pid', type=int, help='pid of the --url server, for CPU/RSS figures')
+    parser.add_argument('--server-arg', action='append', default=[], help='extra videoapp.py argument')
+    parser.add_argument('--workers', type=int, help='start the server with this many worker processes')
+    parser.add_argument('--save', help='write the JSON report to this file')
+    parser.add_argument('--compare', help='baseline JSON report to check for regressions')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='tolerated regression fraction')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = None
+    if args.url:
+        url, pid = args.url, args.pid
+    else:
+        port = free_port()
+        server_args = args.server_arg + (['--workers', str(args.workers)] if args.workers else [])
+        server = start_server(port, server_args)
+        url, pid = f'http://127.0.0.1:{port}', server.pid
+        wait_ready(url)
+    try:
+        report = asyncio.run(run(args, url, pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print('REGRESSIONS: ' + ', '.join(regressions))
+            sys.exit(1)
+        print('no regressions against baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+# NetStream - SFU loopback test
+#
+# Starts videoapp.py --sfu on a free local port (or targets --url) and joins N
+# headless participants to one room. Each publishes what the browser page
+# does in SFU mode (silence, a camera layer and a smaller low layer, all
+# synthetic) and subscribes to everyone else through the server. Reports,
+# per subscriber and publisher, the frames decoded, how many of them came from
+# the low layer (told apart by resolution) and the layer forwarded at the
+# end, then the server's forwarding counters.
+#
+#   python benchmarks/sfu_loopback.py --peers 3 --duration 20
+#   python benchmarks/sfu_loopback.py --peers 3 --cap-kbps 6   # first peer on a thin link
+#
+# --cap-kbps clamps the bandwidth estimates the first participant reports to
+# the server (aiortc sends one per received video), which should move the
+# videos it receives to the low layer apart from the occasional probe. The
+# synthetic layers are cheap to encode: expect roughly 9 and 5 kbit/s.
+#
+# Requires aiortc and python-socketio's asyncio client.
+import argparse
+import asyncio
+import fractions
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+import socketio
+from aiortc import RTCBundlePolicy, RTCConfiguration, RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from aiortc.mediastreams import AudioStreamTrack, MediaStreamError
+from av import VideoFrame
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import free_port, start_server, wait_ready  # noqa: E402
+
+LAYERS = {'high': (320, 240), 'low': (160, 120)}
+VIDEO_CLOCK = 90000
+
+
+class SyntheticVideo(VideoStreamTrack):
+    """A moving gradient at a fixed size and frame rate"""
+
+    def __init__(self, width, height, fps):
+        super().__init__()
+        self.width = width
+        self.height = height
+        self.interval = 1 / fps
+        self.count = 0
+        self.started = None
+
+    async def recv(self):
+        if self.started is None:
+            self.started = time.monotonic()
+        delay = self.started + self.count * self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        frame = VideoFrame(width=self.width, height=self.height, format='yuv420p')
+        shade = (self.count * 4) % 256
+        for plane in frame.planes:
+            plane.update(bytes([shade]) * plane.buffer_size)
+        frame.pts = int(self.count * self.interval * VIDEO_CLOCK)
+        frame.time_base = fractions.Fraction(1, VIDEO_CLOCK)
+        self.count += 1
+        return frame
+
+
+def cap_bandwidth(receiver, bits_per_second):
+    """Clamp the REMB this receiver sends, as a congested downlink would"""
+    estimator = receiver._RTCRtpReceiver__remote_bitrate_estimator
+    if estimator is None:
+        return
+    add = estimator.add
+
+    def capped(*args, **kwargs):
+        remb = add(*args, **kwargs)
+        if remb is not None:
+            remb = (min(remb[0], int(bits_per_second)), remb[1])
+        return remb
+    estimator.add = capped
+
+
+class Participant:
+    def __init__(self, index, url, room_id, fps, cap):
+        self.index = index
+        self.url = url
+        self.room_id = room_id
+        self.fps = fps
+        self.cap = cap
+        self.sio = socketio.AsyncClient(reconnection=False)
+        # As a browser does; aiortc's default would leave the second camera layer unconnected
+        self.pc = RTCPeerConnection(RTCConfiguration(bundlePolicy=RTCBundlePolicy.MAX_BUNDLE))
+        self.sid = None
+        self.layout = {}
+        self.published = False
+        self.received = {}  # mid -> [frames, low layer frames, last size, first frame at, last frame at]
+        self.tasks = []
+        self.role = asyncio.get_running_loop().create_future()
+        self.sio.on('role-assigned', self.on_role)
+        self.sio.on('sfu-offer', self.on_offer)
+        self.sio.on('sfu-layout', self.on_layout)
+        self.pc.on('track', self.on_track)
+
+    def on_role(self, data):
+        if not self.role.done():
+            self.role.set_result(data)
+
+    async def join(self):
+        await self.sio.connect(f'{self.url}?room={self.room_id}', transports=['websocket'])
+        await asyncio.wait_for(self.role, 10)  # sent while connecting, before emitting is allowed
+        self.sid = self.sio.get_sid()
+        await self.sio.emit('sfu-join')
+
+    async def on_offer(self, data):
+        self.layout = data['layout']
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp=data['sdp'], type='offer'))
+        if not self.published:
+            audio, high, low = self.pc.getTransceivers()[:3]
+            tracks = [AudioStreamTrack(), SyntheticVideo(*LAYERS['high'], self.fps),
+                      SyntheticVideo(*LAYERS['low'], self.fps)]
+            for transceiver, track in zip((audio, high, low), tracks):
+                transceiver.direction = 'sendonly'
+                transceiver.sender.replaceTrack(track)
+            self.published = True
+        if self.cap:
+            for transceiver in self.pc.getTransceivers()[3:]:
+                cap_bandwidth(transceiver.receiver, self.cap)
+        await self.pc.setLocalDescription(await self.pc.createAnswer())
+        await self.sio.emit('sfu-answer', {'sdp': self.pc.localDescription.sdp})
+
+    async def on_layout(self, data):
+        self.layout = data['layout']
+
+    def on_track(self, track):
+        if track.kind != 'video':
+            return
+        transceiver = next(t for t in self.pc.getTransceivers() if t.receiver.track is track)
+        self.tasks.append(asyncio.ensure_future(self.consume(transceiver.mid, track)))
+
+    async def consume(self, mid, track):
+        stats = self.received.setdefault(mid, [0, 0, None, None, None])
+        try:
+            while True:
+                frame = await track.recv()
+                now = time.monotonic()
+                size = (frame.width, frame.height)
+                stats[0] += 1
+                stats[1] += size == LAYERS['low']
+                stats[2], stats[4] = size, now
+                if stats[3] is None:
+                    stats[3] = now
+        except MediaStreamError:
+            pass
+
+    def by_publisher(self):
+        """publisher sid -> (frames, low, size, first, last) of the video forwarded from it"""
+        return {self.layout[mid]: tuple(stats) for mid, stats in self.received.items() if mid in self.layout}
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await self.pc.close()
+        await self.sio.disconnect()
+
+
+def layer_of(size):
+    return next((name for name, layer_size in LAYERS.items() if layer_size == size), '-')
+
+
+async def run(args, url):
+    room_id = f'sfu-loopback-{os.getpid()}'
+    participants = [Participant(i, url, room_id, args.fps, args.cap_kbps * 1000 if i == 0 else None)
+                    for i in range(args.peers)]
+    for participant in participants:
+        await participant.join()
+        await asyncio.sleep(args.join_interval)
+    await asyncio.sleep(args.duration)
+
+    names = {p.sid: f'peer{p.index}' for p in participants}
+    print(f"{'subscriber':<12}{'publisher':<12}{'frames':>8}{'fps':>8}{'low':>8}{'now':>7}")
+    for participant in participants:
+        for publisher, (frames, low, size, first, last) in sorted(participant.by_publisher().items(),
+                                                                  key=lambda item: names.get(item[0], '')):
+            fps = (frames - 1) / (last - first) if frames > 1 and last > first else 0.0
+            print(f'{names[participant.sid]:<12}{names.get(publisher, publisher):<12}{frames:>8}'
+                  f'{fps:>8.1f}{low:>8}{layer_of(size):>7}')
+    for participant in participants:
+        await participant.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Forward synthetic media through the SFU and report what arrives')
+    parser.add_argument('--url', help='target a running server started with --sfu instead of starting one')
+    parser.add_argument('--peers', type=int, default=3)
+    parser.add_argument('--duration', type=float, default=20, help='seconds of media after the last join')
+    parser.add_argument('--fps', type=float, default=10, help='frame rate of each published layer')
+    parser.add_argument('--join-interval', type=float, default=1.0, help='seconds between joins')
+    parser.add_argument('--cap-kbps', type=float, default=0,
+                        help="clamp the first peer's bandwidth estimate per received video")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        scratch = tempfile.mkdtemp(prefix='netstream-sfu-')
+        os.environ['NETSTREAM_CHAT_DIR'] = os.path.join(scratch, 'chat')
+        os.environ['NETSTREAM_TRANSCRIPT_DIR'] = os.path.join(scratch, 'transcripts')
+        server = start_server(port, ['--sfu'])
+        url = f'http://127.0.0.1:{port}'
+        wait_ready(url)
+    try:
+        asyncio.run(run(args, url))
+        with urllib.request.urlopen(f'{url}/metrics', timeout=5) as response:
+            lines = response.read().decode().splitlines()
+        print()
+        for line in lines:
+            if line.startswith('netstream_sfu_'):
+                print(line)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# NetStream - per-room chat history
+#
+# Recent messages of an active room sit in a fixed-size ring buffer. Every
+# message is also appended to an on-disk log, one directory per room, split
+# into segment files named after the first sequence number they hold:
+#
+#   <directory>/<room id>/0000000000000001.seg
+#
+# A record is a RECORD header (seq, timestamp, payload length) followed by a
+# JSON [sender, text] payload. Older pages are read by mapping the segments
+# that cover the requested range, so a history fetch never loads a whole log.
+# Segments beyond `max_segments` are deleted oldest first.
+from bisect import bisect_right
+from collections import deque
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('!QdI')  # seq, unix timestamp, payload length
+SEGMENT_SUFFIX = '.seg'
+
+
+def _scan(buf, start=0):
+    """Yield (offset, seq, ts, payload) for each complete record in buf"""
+    offset = start
+    while offset + RECORD.size <= len(buf):
+        seq, ts, length = RECORD.unpack_from(buf, offset)
+        end = offset + RECORD.size + length
+        if end > len(buf):
+            return  # torn write at the tail
+        yield offset, seq, ts, buf[offset + RECORD.size:end]
+        offset = end
+
+
+def _entry(seq, ts, payload):
+    sender, text = json.loads(payload)
+    return {'seq': seq, 'ts': ts, 'sender': sender, 'text': text}
+
+
+class SegmentLog:
+    """Append-only record log for one room, split into size-bounded segment files"""
+
+    def __init__(self, directory, segment_bytes=1 << 20, max_segments=16):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.file = None
+        self.segments = []  # first seq of each segment, ascending
+        if os.path.isdir(directory):
+            self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                   if name.endswith(SEGMENT_SUFFIX))
+
+    def path(self, first_seq):
+        return os.path.join(self.directory, f'{first_seq:016d}{SEGMENT_SUFFIX}')
+
+    def recover(self, repair=True):
+        """Return the last seq on disk (0 if none); with `repair`, cut off a torn record at the tail"""
+        if not self.segments:
+            return 0
+        path = self.path(self.segments[-1])
+        last_seq, good, size = self.segments[-1] - 1, 0, os.path.getsize(path)
+        if size:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for offset, seq, _, payload in _scan(buf):
+                    last_seq, good = seq, offset + RECORD.size + len(payload)
+        if repair and good < size:
+            logger.warning('Truncating %d torn bytes from %s', size - good, path)
+            os.truncate(path, good)
+        return last_seq
+
+    def append(self, seq, ts, payload):
+        if self.file is None or self.file.tell() >= self.segment_bytes:
+            self._roll(seq)
+        self.file.write(RECORD.pack(seq, ts, len(payload)) + payload)
+        self.file.flush()
+
+    def _roll(self, seq):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.segments and os.path.getsize(self.path(self.segments[-1])) < self.segment_bytes:
+            self.file = open(self.path(self.segments[-1]), 'ab')
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments.append(seq)
+        self.file = open(self.path(seq), 'ab')
+        while len(self.segments) > self.max_segments:
+            os.unlink(self.path(self.segments.pop(0)))
+
+    def read(self, lo, hi):
+        """Yield (seq, ts, payload) for lo <= seq < hi"""
+        index = max(0, bisect_right(self.segments, lo) - 1)
+        for first_seq in self.segments[index:]:
+            if first_seq >= hi:
+                return
+            try:
+                with open(self.path(first_seq), 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        for _, seq, ts, payload in _scan(buf):
+                            if seq >= hi:
+                                return
+                            if seq >= lo:
+                                yield seq, ts, bytes(payload)
+            except FileNotFoundError:
+                continue  # dropped by retention while we were reading
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RoomChat:
+    __slots__ = ('log', 'recent', 'last_seq')
+
+    def __init__(self, log, history):
+        self.log = log
+        self.last_seq = log.recover()
+        self.recent = deque((_entry(*record) for record in log.read(self.last_seq - history + 1,
+                                                                     self.last_seq + 1)),
+                            maxlen=history)
+
+
+class ChatStore:
+    """Chat history for every room: ring buffers for active rooms, segment logs on disk"""
+
+    def __init__(self, directory, history=200, segment_bytes=1 << 20, max_segments=16):
+        self.directory = directory
+        self.history = history
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.rooms = {}
+
+    def _log(self, room_id):
+        return SegmentLog(os.path.join(self.directory, room_id), self.segment_bytes, self.max_segments)
+
+    def _open(self, room_id):
+        chat = self.rooms.get(room_id)
+        if chat is None:
+            chat = self.rooms[room_id] = RoomChat(self._log(room_id), self.history)
+        return chat
+
+    def append(self, room_id, sender, text):
+        """Record a message and return its entry"""
+        chat = self._open(room_id)
+        chat.last_seq += 1
+        entry = {'seq': chat.last_seq, 'ts': time.time(), 'sender': sender, 'text': text}
+        chat.recent.append(entry)
+        try:
+            chat.log.append(entry['seq'], entry['ts'], json.dumps([sender, text]).encode('utf-8'))
+        except OSError as exc:
+            logger.error('Cannot append to chat log of room %s: %s', room_id, exc)
+        return entry
+
+    def recent(self, room_id, limit):
+        """The last `limit` messages of a room, oldest first"""
+        chat = self._open(room_id)
+        if limit <= 0:
+            return []
+        if limit >= len(chat.recent):
+            return list(chat.recent)
+        return list(chat.recent)[-limit:]
+
+    def page(self, room_id, before=None, limit=50):
+        """Up to `limit` messages with seq < before (default: the newest), oldest first"""
+        chat = self.rooms.get(room_id)
+        if chat is not None:
+            hi = chat.last_seq + 1 if before is None else min(before, chat.last_seq + 1)
+            lo = max(1, hi - limit)
+            if chat.recent and chat.recent[0]['seq'] <= lo:
+                start = lo - chat.recent[0]['seq']
+                return [chat.recent[i] for i in range(start, start + hi - lo)]
+            log = chat.log
+        else:
+            log = self._log(room_id)
+            if before is None:
+                before = log.recover(repair=False) + 1
+            hi = before
+            lo = max(1, hi - limit)
+        return [_entry(*record) for record in log.read(lo, hi)]
+
+    def close(self, room_id):
+        """Drop a room's ring buffer and close its log; its history stays on disk"""
+        chat = self.rooms.pop(room_id, None)
+        if chat is not None:
+            chat.log.close()
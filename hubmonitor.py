@@ -0,0 +1,159 @@
+# NetStream - event loop lag and greenlet blocking monitor
+#
+# Every greenlet shares the one gevent hub, so a handler that runs long without
+# yielding (a slow computation, a synchronous log write) stalls signaling for
+# every call in the process. Three measurements, all running continuously:
+# - lag: a probe greenlet asks to wake every LAG_INTERVAL and records how late
+#   it actually ran;
+# - run time: a greenlet switch tracer times every stretch a greenlet runs
+#   before it yields, labelled with the Socket.IO event or HTTP route it serves;
+# - blocking: a watchdog OS thread notices when a greenlet has held the hub for
+#   `threshold` seconds and takes its stack right then, while it still blocks.
+#   The longest stretches are kept with their stacks for /debug/hub.
+#
+# The watchdog is a real thread because gevent is not monkey-patched here: it
+# keeps running while the hub is stuck, which a greenlet could not.
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import gevent
+import greenlet
+
+from metrics import Counter, Histogram
+
+LAG_INTERVAL = 0.05  # seconds between wake-ups of the lag probe
+BLOCK_THRESHOLD = 0.1  # seconds a greenlet may run without yielding before it counts as blocking
+WORST_BLOCKS = 20  # longest blocking stretches kept
+RECENT_BLOCKS = 50  # latest blocking stretches kept
+STACK_DEPTH = 30  # frames kept of a blocking greenlet's stack
+
+
+def greenlet_name(glet):
+    """What a greenlet runs, for telling untagged ones apart"""
+    run = getattr(glet, '_run', None) or getattr(glet, 'run', None)
+    return getattr(run, '__qualname__', None) or type(glet).__name__
+
+
+class Block:
+    __slots__ = ('duration', 'tag', 'name', 'stack', 'at')
+
+    def __init__(self, duration, tag, name, stack, at):
+        self.duration = duration
+        self.tag = tag
+        self.name = name
+        self.stack = stack
+        self.at = at
+
+    def as_dict(self):
+        return {'duration_ms': round(self.duration * 1000, 3), 'event': self.tag, 'greenlet': self.name,
+                'at': self.at, 'stack': self.stack}
+
+
+class HubMonitor:
+    """Hub lag, greenlet run time and blocking stretches of the thread it is started on"""
+
+    def __init__(self, threshold=BLOCK_THRESHOLD):
+        self.threshold = threshold
+        self.hub = None
+        self.thread_id = None
+        self.tags = {}  # greenlet -> Socket.IO event or route it is serving
+        self.leaving = set()  # greenlets whose tag ends with the stretch they are running
+        self.switches = 0
+        self.running = None
+        self.switched_at = time.perf_counter()
+        self.captured = None  # (switch count, stack) taken by the watchdog during the current stretch
+        self.worst = []  # min-heap of (duration, seq, Block)
+        self.recent = deque(maxlen=RECENT_BLOCKS)
+        self.sequence = itertools.count()
+        self.previous_trace = None
+        self.lag = Histogram('netstream_hub_lag_seconds', 'How late the hub woke a sleeping greenlet')
+        self.run_time = Histogram('netstream_greenlet_run_seconds',
+                                  'Time a greenlet ran before yielding to the hub', ['event'])
+        self.blocks = Counter('netstream_hub_blocks_total',
+                              'Greenlets that held the hub longer than the blocking threshold', ['event'])
+
+    @property
+    def metrics(self):
+        return (self.lag, self.run_time, self.blocks)
+
+    def start(self):
+        self.hub = gevent.get_hub()
+        self.thread_id = threading.get_ident()
+        self.running = greenlet.getcurrent()
+        self.previous_trace = greenlet.settrace(self._trace)
+        gevent.spawn(self._probe_lag)
+        threading.Thread(target=self._watch, name='hub-watchdog', daemon=True).start()
+
+    def enter(self, tag):
+        """Label the current greenlet's run time with `tag` until leave()"""
+        current = greenlet.getcurrent()
+        self.tags[current] = tag
+        self.leaving.discard(current)
+
+    def leave(self):
+        """End the label; the stretch in progress, which ran the tagged code, still counts towards it"""
+        self.leaving.add(greenlet.getcurrent())
+
+    def _trace(self, event, args):
+        now = time.perf_counter()
+        origin, target = args
+        elapsed = now - self.switched_at
+        if origin is not self.hub:
+            tag = self.tags.get(origin, 'other')
+            if origin in self.leaving:
+                self.leaving.discard(origin)
+                del self.tags[origin]
+            self.run_time.observe(elapsed, tag)
+            if elapsed >= self.threshold:
+                captured = self.captured
+                stack = captured[1] if captured is not None and captured[0] == self.switches else None
+                self._record(Block(elapsed, tag, greenlet_name(origin), stack, time.time()))
+        self.switches += 1
+        self.switched_at = now
+        self.running = target
+        if self.previous_trace is not None:
+            self.previous_trace(event, args)
+
+    def _record(self, block):
+        self.blocks.inc(block.tag)
+        self.recent.append(block)
+        entry = (block.duration, next(self.sequence), block)
+        if len(self.worst) < WORST_BLOCKS:
+            heapq.heappush(self.worst, entry)
+        elif entry > self.worst[0]:
+            heapq.heapreplace(self.worst, entry)
+
+    def _probe_lag(self):
+        while True:
+            start = time.perf_counter()
+            gevent.sleep(LAG_INTERVAL)
+            self.lag.observe(max(0.0, time.perf_counter() - start - LAG_INTERVAL))
+
+    def _watch(self):
+        """Watchdog thread: take the stack of a greenlet that has held the hub too long"""
+        while True:
+            time.sleep(self.threshold / 2)
+            switches, running = self.switches, self.running
+            # The hub itself runs while it waits for I/O, so a quiet process is not a blocked one
+            if running is self.hub or time.perf_counter() - self.switched_at < self.threshold:
+                continue
+            if self.captured is not None and self.captured[0] == switches:
+                continue  # already taken during this stretch
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None and switches == self.switches:
+                self.captured = (switches, traceback.format_stack(frame, limit=STACK_DEPTH))
+
+    def report(self):
+        """Lag and run time histograms and the blocking stretches, for /debug/hub"""
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'lag': self.lag.snapshot(),
+            'run_time': self.run_time.snapshot(),
+            'worst_blocks': [block.as_dict() for _, _, block in sorted(self.worst, reverse=True)],
+            'recent_blocks': [block.as_dict() for block in reversed(self.recent)],
+        }
@@ -0,0 +1,159 @@
+# NetStream - per-session ICE server configuration (/ice-config)
+#
+# A browser gathers candidates against every ICE server it is given, so a long
+# list slows down call setup. The directory holds the candidate servers,
+# probes each from this server now and then (a STUN binding request, or for a
+# relay an unauthenticated Allocate, which a live one answers with a 401) and
+# hands out a short list: the best few STUN and TURN servers by recent success
+# rate, then round-trip time. The ranking is cached for CONFIG_TTL. Credentials
+# for the built-in relay (see turn.py) are minted for every request.
+import logging
+import os
+import time
+
+import gevent
+from gevent import socket
+
+import turn
+
+logger = logging.getLogger(__name__)
+
+STUN_LIMIT = 2  # STUN servers handed out
+TURN_LIMIT = 2  # TURN server URLs handed out
+CONFIG_TTL = 30  # seconds a ranking is served before it is recomputed
+PROBE_INTERVAL = 60  # seconds between probe rounds
+PROBE_TIMEOUT = 2.0  # seconds a probe waits for its answer
+PROBE_SMOOTHING = 0.3  # weight of the latest probe in the success rate and RTT averages
+MIN_SUCCESS = 0.5  # success rate below which a server is left out, unless no server of its kind does better
+
+
+def parse_url(url):
+    """(scheme, host, port, transport) of a stun: or turn: URL"""
+    scheme, _, rest = url.partition(':')
+    address, _, query = rest.partition('?')
+    host, _, port = address.rpartition(':')
+    if not host:
+        host, port = address, ''
+    transport = 'tcp' if 'transport=tcp' in query or scheme == 'turns' else 'udp'
+    return scheme, host, int(port) if port else (5349 if scheme == 'turns' else 3478), transport
+
+
+class IceServer:
+    """One ICE server URL and how its probes went"""
+    __slots__ = ('url', 'username', 'credential', 'relay', 'scheme', 'host', 'port', 'transport', 'success', 'rtt')
+
+    def __init__(self, url, username=None, credential=None, relay=False):
+        self.url = url
+        self.username = username
+        self.credential = credential
+        self.relay = relay  # the built-in relay, whose credentials are minted per session
+        self.scheme, self.host, self.port, self.transport = parse_url(url)
+        self.success = None  # averaged over probes; None until the first one
+        self.rtt = None
+
+    def record(self, rtt):
+        """Fold the outcome of a probe in; rtt is None when it went unanswered"""
+        outcome = 0.0 if rtt is None else 1.0
+        if self.success is None:
+            self.success = outcome
+        else:
+            self.success += PROBE_SMOOTHING * (outcome - self.success)
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt + PROBE_SMOOTHING * (rtt - self.rtt)
+
+    def rank(self):
+        """Sort key: servers that answer first, then the fastest; unprobed ones keep their place after them"""
+        if self.success is None:
+            return (1, 0.0, 0.0)
+        return (0 if self.success >= MIN_SUCCESS else 2, -self.success, self.rtt or PROBE_TIMEOUT)
+
+
+def probe(server):
+    """Round-trip time of one request to `server` in seconds, or None if it went unanswered"""
+    txid = os.urandom(12)
+    if server.scheme == 'stun':
+        request = turn.build(turn.BINDING, turn.REQUEST, txid, [])
+    else:
+        request = turn.build(turn.ALLOCATE, turn.REQUEST, txid,
+                             [(turn.ATTR_REQUESTED_TRANSPORT, bytes((turn.TRANSPORT_UDP, 0, 0, 0)))])
+    kind = socket.SOCK_STREAM if server.transport == 'tcp' else socket.SOCK_DGRAM
+    try:
+        with gevent.Timeout(PROBE_TIMEOUT):
+            family, _, _, _, address = socket.getaddrinfo(server.host, server.port, socket.AF_INET, kind)[0]
+            with socket.socket(family, kind) as sock:
+                sock.connect(address)
+                start = time.perf_counter()
+                sock.sendall(request)
+                while True:
+                    response = sock.recv(2048)
+                    if not response:
+                        return None
+                    message = turn.parse(memoryview(response))
+                    if message is not None and message.txid == txid:
+                        return time.perf_counter() - start
+    except (OSError, gevent.Timeout):
+        return None
+
+
+class IceDirectory:
+    """The candidate ICE servers, ranked by how their probes go"""
+
+    def __init__(self, servers):
+        self.servers = [IceServer(url, entry.get('username'), entry.get('credential'))
+                        for entry in servers
+                        for url in ([entry['urls']] if isinstance(entry['urls'], str) else entry['urls'])
+                        if parse_url(url)[0] != 'turns']  # not probed: the handshake is more than one request
+        self.relay_secret = None
+        self.relay_ttl = None
+        self.ranking = None
+        self.ranked_at = 0.0
+        self.prober = None
+
+    def add_relay(self, urls, secret, ttl):
+        """Offer the built-in relay too, and its STUN service, with credentials minted from `secret`"""
+        self.relay_secret = secret
+        self.relay_ttl = ttl
+        stun_urls = sorted({'stun:' + url.partition(':')[2].partition('?')[0] for url in urls})
+        self.servers[:0] = [IceServer(url, relay=True) for url in urls] + [IceServer(url) for url in stun_urls]
+
+    def start(self):
+        self.prober = gevent.spawn(self._probe_forever)
+
+    def _probe_forever(self):
+        while True:
+            probes = [(server, gevent.spawn(probe, server)) for server in self.servers]
+            gevent.joinall([greenlet for _, greenlet in probes])
+            for server, greenlet in probes:
+                server.record(greenlet.value)
+            self.ranking = None
+            logger.debug('ICE server probes: %s', ', '.join(
+                f'{s.url} {s.success:.2f} {s.rtt * 1000 if s.rtt else 0:.0f}ms' for s in self.servers))
+            gevent.sleep(PROBE_INTERVAL)
+
+    def ranked(self):
+        """(STUN servers, TURN servers) to hand out, recomputed at most every CONFIG_TTL"""
+        now = time.monotonic()
+        if self.ranking is None or now - self.ranked_at >= CONFIG_TTL:
+            ordered = sorted(self.servers, key=IceServer.rank)
+            self.ranking = (self._shortlist([s for s in ordered if s.scheme == 'stun'], STUN_LIMIT),
+                            self._shortlist([s for s in ordered if s.scheme != 'stun'], TURN_LIMIT))
+            self.ranked_at = now
+        return self.ranking
+
+    @staticmethod
+    def _shortlist(ordered, limit):
+        """The first `limit` servers, leaving out failing ones unless no other is left"""
+        answering = [server for server in ordered if server.success is None or server.success >= MIN_SUCCESS]
+        return (answering or ordered)[:limit]
+
+    def config(self, user):
+        """The iceServers list for one session; relay credentials are minted for `user`"""
+        stun, relays = self.ranked()
+        entries = [{'urls': [server.url for server in stun]}] if stun else []
+        for server in relays:
+            if server.relay:
+                username, credential = turn.rest_credentials(self.relay_secret, user, self.relay_ttl)
+            else:
+                username, credential = server.username, server.credential
+            entries.append({'urls': server.url, 'username': username, 'credential': credential})
+        return entries
@@ -0,0 +1,90 @@
+# NetStream - hashed timing wheel for session liveness and other coarse timers
+#
+# A timer is a key in one of `slots` buckets. Scheduling and cancelling touch a
+# single dict and set, and each tick only visits the bucket under the cursor,
+# so the cost of a tick is proportional to the timers that are due (plus those
+# parked for a later revolution), not to every live session.
+import logging
+import math
+import time
+
+import gevent
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """Hashed timing wheel with `slots` buckets of `tick` seconds each.
+
+    Callbacks run on the wheel's greenlet with the timer key as their only argument.
+    A callback that returns a number of seconds is rescheduled that far ahead.
+    """
+
+    def __init__(self, slots=64, tick=1.0):
+        self.tick = tick
+        self.buckets = [set() for _ in range(slots)]
+        self.timers = {}  # key -> [bucket index, remaining revolutions, callback]
+        self.cursor = 0
+        self.greenlet = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, delay, callback):
+        """Run callback(key) in about `delay` seconds, replacing any timer with the same key"""
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks, len(self.buckets))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.buckets)
+        index = (self.cursor + offset) % len(self.buckets)
+        self.buckets[index].add(key)
+        self.timers[key] = [index, rounds, callback]
+
+    def cancel(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            self.buckets[timer[0]].discard(key)
+
+    def advance(self):
+        """Move the cursor one bucket and return the (key, callback) pairs that are due"""
+        self.cursor = (self.cursor + 1) % len(self.buckets)
+        bucket = self.buckets[self.cursor]
+        due = []
+        for key in list(bucket):
+            timer = self.timers[key]
+            if timer[1] > 0:
+                timer[1] -= 1
+                continue
+            bucket.discard(key)
+            del self.timers[key]
+            due.append((key, timer[2]))
+        return due
+
+    def run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            gevent.sleep(max(0.0, next_tick - time.monotonic()))
+            next_tick = self.catch_up(next_tick)
+
+    def catch_up(self, next_tick):
+        """Run every tick due by now, the first at `next_tick`; returns when the next one is due"""
+        # Catch up on ticks missed while the loop was busy instead of drifting
+        while next_tick <= time.monotonic():
+            next_tick += self.tick
+            for key, callback in self.advance():
+                try:
+                    delay = callback(key)
+                except Exception:
+                    logger.exception('Timer callback for %r failed', key)
+                    continue
+                if delay is not None:
+                    self.schedule(key, delay, callback)
+        return next_tick
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
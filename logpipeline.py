@@ -0,0 +1,111 @@
+# NetStream - logging pipeline for the signaling hot path
+#
+# In 'queue' mode the handlers attached to the root logger only put the raw
+# LogRecord on a SimpleQueue; formatting and the write itself happen on a
+# QueueListener OS thread, off the gevent hub. Records can carry an `event`
+# attribute (logger.info(..., extra={'event': 'candidate'})) which drives
+# per-event sampling and shows up as a field in JSON output.
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock prepare() formats the record in the caller, which is exactly the work
+    the hot path should not pay for.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keep one in every round(1 / rate) records per event; records without an event pass"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.every = {event: max(1, round(1 / rate)) for event, rate in rates.items() if rate > 0}
+        self.muted = {event for event, rate in rates.items() if rate <= 0}
+        self.seen = dict.fromkeys(self.every, 0)
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        every = self.every.get(event)
+        if every is None:
+            return event not in self.muted
+        seen = self.seen[event] = self.seen[event] + 1
+        if seen % every:
+            return False
+        record.sample_weight = every  # each kept record stands for this many events
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any `extra` fields carried as top-level keys"""
+
+    def format(self, record):
+        entry = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_sample_rates(spec):
+    """Parse 'candidate=0.1,chat-message=0.5' into {'candidate': 0.1, 'chat-message': 0.5}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        event, _, rate = item.partition('=')
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+def stop_listener():
+    """Flush queued records and stop the writer thread, if one is running"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_listener)
+
+
+def configure_logging(level=logging.INFO, mode='sync', fmt='text', sample_rates=None, stream=None):
+    """Replace the root logger's handlers with the requested pipeline"""
+    global _listener
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    stop_listener()
+
+    if mode == 'queue':
+        records = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records)
+        _listener = QueueListener(records, output, respect_handler_level=True)
+        _listener.start()
+    else:
+        handler = output
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,148 @@
+# NetStream - in-process metrics with Prometheus text exposition
+#
+# Every update is a plain attribute/dict write on the gevent hub, so nothing
+# here takes a lock: greenlets never switch in the middle of an update, and a
+# scrape renders from copies so it cannot observe a half-applied one.
+from bisect import bisect_left
+import json
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labelvalues, value in sorted(self.values.copy().items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time"""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge',
+                f'{self.name} {_format_value(self.callback())}']
+
+
+class Histogram:
+    """Fixed-bucket histogram; bucket counts are kept per bucket and cumulated on render"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labelvalues):
+        series = self.series.get(labelvalues)
+        if series is None:
+            # [per-bucket counts..., +Inf count, sum]
+            series = self.series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def snapshot(self):
+        """{label values joined by ',': {'buckets': {le: cumulative count}, 'count', 'sum'}} for JSON"""
+        result = {}
+        for labelvalues, series in sorted(self.series.items()):
+            series = list(series)
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                buckets[_format_value(bound)] = cumulative
+            result[','.join(labelvalues)] = {'buckets': buckets, 'count': cumulative, 'sum': series[-1]}
+        return result
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labelvalues, series in sorted(self.series.items()):
+            series = list(series)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {_format_value(series[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Ordered collection of metrics rendered together for a scrape"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class CountingJSON:
+    """JSON module for the Socket.IO packet encoder that counts outgoing events and bytes.
+
+    The server encodes each emit exactly once, so hooking dumps() measures the real wire
+    payload without serializing anything a second time.
+    """
+
+    def __init__(self, emits, emit_bytes):
+        self.emits = emits
+        self.emit_bytes = emit_bytes
+
+    def dumps(self, obj, *args, **kwargs):
+        encoded = json.dumps(obj, *args, **kwargs)
+        if isinstance(obj, dict) and 'method' in obj:
+            return encoded  # message bus traffic between workers, not an emit
+        event = obj[0] if isinstance(obj, list) and obj and isinstance(obj[0], str) else '_control'
+        self.emits.inc(event)
+        self.emit_bytes.inc(event, amount=len(encoded))
+        return encoded
+
+    def loads(self, *args, **kwargs):
+        return json.loads(*args, **kwargs)
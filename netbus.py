@@ -0,0 +1,192 @@
+# NetStream - cross-process message bus for Socket.IO emits
+#
+# When several worker processes serve signaling, an emit addressed to a sid or
+# room owned by another worker has to travel between processes. python-socketio
+# does that through a PubSubManager; this module supplies a self-contained local
+# broker (a Unix-socket fan-out, no outside services) and picks the backend from
+# a URL:
+#
+#   local:///path/to/bus.sock   in-repo LocalBroker, single host
+#   redis://host:6379/0         socketio.RedisManager, multi-node
+#   anything else               socketio.KombuManager (amqp://, ...)
+#
+# Emits addressed to a sid connected to the emitting process skip the bus.
+import logging
+import os
+import struct
+from urllib.parse import urlsplit
+
+import gevent
+from gevent import socket
+from gevent.lock import Semaphore
+from gevent.queue import Full, Queue
+from gevent.server import StreamServer
+import socketio
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME = 16 * 2**20
+SUBSCRIBER_QUEUE = 10000  # frames buffered for a slow subscriber before it is dropped
+
+
+def _read_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('bus connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock):
+    (size,) = FRAME_HEADER.unpack(_read_exactly(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError(f'bus frame of {size} bytes exceeds the limit')
+    return _read_exactly(sock, size)
+
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class LocalBroker:
+    """Unix-socket pub/sub broker: each frame is fanned out to every other connection"""
+
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = {}
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen(128)
+        self.server = StreamServer(listener, self.handle)
+        self.server.start()
+        logger.info('Local message bus listening on %s', self.path)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def handle(self, sock, address):
+        outbox = Queue(maxsize=SUBSCRIBER_QUEUE)
+        self.subscribers[sock] = outbox
+        writer = gevent.spawn(self._write_loop, sock, outbox)
+        try:
+            while True:
+                frame = encode_frame(read_frame(sock))
+                for subscriber, queue in list(self.subscribers.items()):
+                    if subscriber is sock:
+                        continue
+                    try:
+                        queue.put_nowait(frame)
+                    except Full:
+                        logger.error('Dropping bus subscriber that stopped reading')
+                        self.subscribers.pop(subscriber, None)
+                        subscriber.close()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.subscribers.pop(sock, None)
+            writer.kill()
+
+    def _write_loop(self, sock, outbox):
+        try:
+            for frame in outbox:
+                sock.sendall(frame)
+        except OSError:
+            self.subscribers.pop(sock, None)
+
+
+class LocalDeliveryMixin:
+    """Deliver emits addressed to a sid connected to this process without using the bus.
+
+    A sid lives in exactly one process, so publishing such an emit would only make
+    every other worker decode and discard it.
+    """
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None,
+             **kwargs):
+        target = to or room
+        if target is not None and callback is None and self.is_connected(target, namespace or '/'):
+            kwargs['ignore_queue'] = True
+        return super().emit(event, data, namespace=namespace, room=target, skip_sid=skip_sid,
+                            callback=callback, **kwargs)
+
+
+class LocalBusManager(LocalDeliveryMixin, socketio.PubSubManager):
+    """Client manager that shares emits with sibling workers through a LocalBroker"""
+    name = 'localbus'
+
+    def __init__(self, url='local:///tmp/netstream-bus.sock', channel='socketio', write_only=False,
+                 logger=None, json=None):
+        self.path = urlsplit(url).path
+        self.sock = None
+        self.connect_lock = Semaphore()
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+
+    def _connect(self):
+        with self.connect_lock:
+            if self.sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                self.sock = sock
+            return self.sock
+
+    def _drop(self, sock):
+        if self.sock is sock:
+            self.sock = None
+        sock.close()
+
+    def _publish(self, data):
+        frame = encode_frame(self.json.dumps(data).encode('utf-8'))
+        for retries_left in range(1, -1, -1):  # 2 attempts
+            try:
+                return self._connect().sendall(frame)
+            except OSError as exc:
+                if self.sock is not None:
+                    self._drop(self.sock)
+                if not retries_left:
+                    self._get_logger().error('Cannot publish to local bus... giving up (%s)', exc)
+
+    def _listen(self):
+        retry_sleep = 0.1
+        while True:
+            try:
+                sock = self._connect()
+                retry_sleep = 0.1
+                while True:
+                    yield read_frame(sock)
+            except (ConnectionError, OSError) as exc:
+                if self.sock is not None:
+                    self._drop(self.sock)
+                self._get_logger().error('Cannot receive from local bus... retrying in %s secs (%s)',
+                                         retry_sleep, exc)
+                gevent.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 5)
+
+
+class RedisBusManager(LocalDeliveryMixin, socketio.RedisManager):
+    """Redis-backed client manager for multi-node deployments"""
+
+
+class KombuBusManager(LocalDeliveryMixin, socketio.KombuManager):
+    """Kombu-backed client manager (AMQP and other Kombu transports)"""
+
+
+def create_manager(url):
+    """Return the Socket.IO client manager for a message bus URL"""
+    scheme = urlsplit(url).scheme
+    if scheme == 'local':
+        return LocalBusManager(url)
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBusManager(url)
+    return KombuBusManager(url)
@@ -0,0 +1,94 @@
+# NetStream - on-demand sampling profiler (/debug/profile)
+#
+# A thread of the hub's pool takes the stack of whatever runs on the hub
+# thread every 1/hz seconds, for as long as the request asks, and counts the
+# stacks in collapsed form (root;...;leaf count), the input of flamegraph.pl,
+# speedscope and friends. Nothing is installed or running in between: a
+# process that is not being profiled pays nothing.
+#
+# The stack a sample sees belongs to the greenlet running at that moment, and
+# ends where that greenlet started, so stacks of different greenlets never
+# mix. Each stack is rooted at the Socket.IO handler it runs under
+# (handle_offer, handle_candidate, ...), found by the handlers' code objects;
+# samples outside any handler are rooted at 'other', and samples of the hub
+# waiting for I/O count as 'idle'.
+import os
+import sys
+import time
+from collections import Counter
+
+from gevent.hub import Hub
+
+DEFAULT_HZ = 100
+MAX_HZ = 1000
+MAX_SECONDS = 60
+
+HUB_RUN = Hub.run.__code__
+
+
+def frame_label(code):
+    return f'{getattr(code, "co_qualname", code.co_name)} ({os.path.basename(code.co_filename)})'
+
+
+class Profile:
+    """Collapsed stacks counted over one profiling run"""
+
+    def __init__(self, handlers, thread_id, seconds, hz):
+        self.handlers = handlers  # code object -> handler name
+        self.thread_id = thread_id
+        self.seconds = seconds
+        self.interval = 1 / hz
+        self.stacks = Counter()
+        self.samples = 0
+        self.labels = {}  # code object -> frame label, so each code is formatted once
+
+    def run(self):
+        """Sample until the run is over; meant for a thread other than the hub's"""
+        deadline = time.monotonic() + self.seconds
+        next_sample = time.monotonic()
+        while True:
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if time.monotonic() >= deadline:
+                return self
+            self.sample(sys._current_frames().get(self.thread_id))
+
+    def sample(self, frame):
+        self.samples += 1
+        if frame is None or (frame.f_code is HUB_RUN and frame.f_back is None):
+            self.stacks['idle'] += 1
+            return
+        codes = []
+        root = 'other'
+        while frame is not None:
+            code = frame.f_code
+            name = self.handlers.get(code)
+            if name is not None:
+                codes.append(code)
+                root = name
+                break  # what runs the handler is the same Socket.IO plumbing for every event
+            if code is HUB_RUN:
+                root = 'hub'
+                break
+            codes.append(code)
+            frame = frame.f_back
+        labels = [root]
+        for code in reversed(codes):
+            label = self.labels.get(code)
+            if label is None:
+                label = self.labels[code] = frame_label(code)
+            labels.append(label)
+        self.stacks[';'.join(labels)] += 1
+
+    def collapsed(self):
+        """One `root;...;leaf count` line per distinct stack, most frequent first"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def by_handler(self):
+        """Samples per root: handler name, 'other', 'hub' or 'idle'"""
+        roots = Counter()
+        for stack, count in self.stacks.items():
+            roots[stack.partition(';')[0]] += count
+        return dict(roots.most_common())
@@ -0,0 +1,53 @@
+# NetStream - token-bucket admission control
+#
+# Buckets refill lazily from the monotonic clock when they are checked, so a
+# check is a handful of float operations on a preallocated object: no timers,
+# no per-event allocation. Per-session buckets are created once, when the
+# session is opened, for every limited event.
+import time
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'rejected')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.rejected = 0  # consecutive rejections since the last admitted event
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.rejected = 0
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self):
+        """Seconds until the next token is available"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class SessionLimiter:
+    """Per-session, per-event token buckets; limits maps event -> (rate, burst)"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.sessions = {}
+
+    def open(self, sid):
+        self.sessions[sid] = {event: TokenBucket(rate, burst) for event, (rate, burst) in self.limits.items()}
+
+    def close(self, sid):
+        self.sessions.pop(sid, None)
+
+    def bucket(self, sid, event):
+        """The bucket limiting `event` for `sid`, or None if the event or session is unlimited"""
+        buckets = self.sessions.get(sid)
+        return buckets.get(event) if buckets is not None else None
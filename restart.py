@@ -0,0 +1,86 @@
+# NetStream - graceful restart plumbing
+#
+# On SIGHUP the running server stops accepting and starts a successor, the
+# same command line plus:
+#
+#   --listen-fd N   the listening socket, inherited, so the port never closes
+#   --restore PATH  a snapshot of the call state written by the old process
+#   --ready-fd W    write end of a pipe; one byte on it means "serving now"
+#
+# Only after the successor reports ready does the old process ask its clients
+# to move over; if it never does, the old process takes the port back.
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import gevent
+from gevent import os as gevent_os, socket, subprocess
+
+logger = logging.getLogger(__name__)
+
+READY_TIMEOUT = 30  # seconds the successor has to start serving
+SUCCESSOR_FLAGS = ('--listen-fd', '--restore', '--ready-fd')
+
+
+def write_snapshot(path, state):
+    """Write state as gzipped compact JSON, atomically and readable only by this user (it holds resume tokens)"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def successor_command(argv):
+    """This process's command line without the flags of an earlier handover"""
+    args = list(argv)
+    for flag in SUCCESSOR_FLAGS:
+        while flag in args:
+            index = args.index(flag)
+            del args[index:index + 2]
+    return [sys.executable, os.path.abspath(args[0])] + args[1:]
+
+
+def spawn_successor(listener, snapshot_path, argv=None):
+    """Start the next server process on our listening socket; returns it once it serves, else None"""
+    ready_read, ready_write = os.pipe()
+    command = successor_command(argv or sys.argv) + [
+        '--listen-fd', str(listener.fileno()), '--restore', snapshot_path, '--ready-fd', str(ready_write)]
+    process = subprocess.Popen(command, pass_fds=(listener.fileno(), ready_write))
+    os.close(ready_write)
+    try:
+        with gevent.Timeout(READY_TIMEOUT, False):
+            if gevent_os.tp_read(ready_read, 1):
+                logger.info('Successor process %d is serving', process.pid)
+                return process
+        logger.error('Successor process %d did not become ready', process.pid)
+        if process.poll() is None:
+            process.kill()
+        return None
+    finally:
+        os.close(ready_read)
+
+
+def inherit_listener(fd):
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(False)
+    return sock
+
+
+def signal_ready(fd):
+    """Tell the previous process that this one is serving"""
+    try:
+        os.write(fd, b'r')
+    finally:
+        os.close(fd)
@@ -0,0 +1,555 @@
+# NetStream - optional selective forwarding unit (--sfu)
+#
+# In SFU mode every participant runs one peer connection, to the server,
+# instead of one per peer. It publishes its microphone and two camera layers
+# once, and the server forwards each publisher's media to every subscriber.
+# Media is never decoded or re-encoded: receivers hand the depayloaded frames
+# straight to the forwarding tracks (forward_encoded replaces aiortc's decoder
+# worker), and senders only repacketize them. A forwarded track rebases the
+# timestamps of whatever it forwards, so they keep increasing across switches
+# between layers, whose clocks are unrelated, or between publishers.
+#
+# The server is always the offerer, so there is no glare: it offers three
+# recvonly transceivers (audio, high and low camera layer) for the participant
+# to publish on, plus one sendonly audio and video transceiver per publisher it
+# subscribes to. Transceivers freed by a publisher that left are reused for
+# the next one without renegotiating; 'sfu-layout' tells the page which
+# publisher each mid now carries.
+#
+# Layer selection: every video a subscriber receives gets at least its low
+# layer; what the subscriber's bandwidth estimate (REMB) leaves over buys high
+# layers, costed at the bitrate each publisher's layers are measured at. A
+# video keeps its high layer while LAYER_KEEP of its cost is covered and only
+# gets it back once LAYER_HYSTERESIS times its cost is. A REMB never runs far
+# ahead of what is being received, so a video on its low layer also probes
+# the high layer now and then, backing off exponentially while probes fail.
+# A switch takes effect on the next keyframe of the new layer, which is
+# requested right away.
+#
+# aiortc is asyncio-based, so the router runs its own event loop in a thread.
+# Signaling handlers submit work to it; events for clients come back to the
+# gevent hub through a HubBridge and are emitted from there.
+import asyncio
+from fractions import Fraction
+import logging
+import queue
+import threading
+
+import gevent
+
+try:
+    from aiortc import (RTCBundlePolicy, RTCConfiguration, RTCIceServer, RTCPeerConnection, RTCRtpSender,
+                        RTCSessionDescription, rtcrtpreceiver)
+    from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+    from aiortc.rtp import RTCP_PSFB_APP, RtcpPsfbPacket, unpack_remb_fci
+except ImportError:  # aiortc is optional; without it --sfu is unavailable
+    RTCPeerConnection = None
+    MediaStreamTrack = object
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_LAYERS = (('audio', 'audio'), ('video', 'high'), ('video', 'low'))
+# Codecs every transceiver is limited to, so a publisher's packets fit every subscriber's sender
+FORWARD_CODECS = {'audio': ('audio/opus',), 'video': ('video/VP8', 'video/rtx')}
+LAYER_KEEP = 0.8  # fraction of a high layer's extra bitrate the estimate must cover to keep it
+LAYER_HYSTERESIS = 1.25  # multiple of that extra bitrate the estimate must cover to switch up
+LAYER_INTERVAL = 1.0  # seconds between layer decisions
+LAYER_SETTLE = 10.0  # seconds a subscriber's estimate gets to catch up after an upgrade
+LAYER_PROBE_INTERVAL = 15.0  # seconds on the low layer before trying the high layer again
+LAYER_PROBE_MAX = 120.0  # longest probe backoff; holding high this long resets it
+BITRATE_SMOOTHING = 0.3  # weight of the latest interval in a layer's measured bitrate
+KEYFRAME_MIN_INTERVAL = 0.5  # seconds between keyframe requests sent to one publisher track
+FORWARD_QUEUE = 64  # packets buffered per forwarded track before the oldest are dropped
+SWITCH_GAP = 0.02  # seconds of timestamp between the last packet of a source and the first of the next
+
+
+def available():
+    return RTCPeerConnection is not None
+
+
+class EncodedPacket:
+    """One encoded frame; aiortc's senders packetize anything that is not a decoded Frame as-is"""
+    __slots__ = ('data', 'pts', 'time_base', 'is_keyframe')
+
+    def __init__(self, data, pts, time_base, is_keyframe):
+        self.data = data
+        self.pts = pts
+        self.time_base = time_base
+        self.is_keyframe = is_keyframe
+
+    def __bytes__(self):
+        return self.data
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+def forward_encoded(loop, input_q, output_q):
+    """Stand-in for aiortc's decoder worker: pass complete encoded frames on undecoded"""
+    while True:
+        task = input_q.get()
+        if task is None:
+            asyncio.run_coroutine_threadsafe(output_q.put(None), loop)
+            break
+        codec, encoded_frame = task
+        # VP8: bit 0 of the frame tag is the inverted keyframe flag; audio frames stand alone
+        is_keyframe = codec.mimeType.lower() != 'video/vp8' or not encoded_frame.data[0] & 0x01
+        packet = EncodedPacket(encoded_frame.data, encoded_frame.timestamp, Fraction(1, codec.clockRate),
+                               is_keyframe)
+        asyncio.run_coroutine_threadsafe(output_q.put(packet), loop)
+
+
+class HubBridge:
+    """Runs callables on the gevent hub on behalf of other OS threads"""
+
+    def __init__(self):
+        self.calls = queue.SimpleQueue()
+        self.watcher = gevent.get_hub().loop.async_()
+        self.watcher.start(self._drain)
+
+    def call(self, func, *args):
+        self.calls.put((func, args))
+        self.watcher.send()
+
+    def _drain(self):
+        while True:
+            try:
+                func, args = self.calls.get_nowait()
+            except queue.Empty:
+                return
+            gevent.spawn(func, *args)
+
+
+class PublishedTrack:
+    """One layer a participant publishes, fanned out to the forwarded tracks subscribed to it"""
+
+    def __init__(self, router, publisher, layer, track, receiver):
+        self.router = router
+        self.publisher = publisher
+        self.layer = layer
+        self.kind = track.kind
+        self.track = track
+        self.receiver = receiver
+        self.subscribers = set()
+        self.last_keyframe_request = 0.0
+        self.bytes = 0  # received since the last measure()
+        self.bitrate = 0.0  # bits/s, smoothed
+        self.task = asyncio.ensure_future(self.pump())
+
+    async def pump(self):
+        while True:
+            try:
+                packet = await self.track.recv()
+            except MediaStreamError:
+                return
+            self.router.received.inc(self.layer)
+            self.bytes += packet.size
+            for forwarded in list(self.subscribers):
+                forwarded.deliver(self, packet)
+
+    def measure(self, elapsed):
+        rate = self.bytes * 8 / elapsed
+        self.bitrate = rate if not self.bitrate else self.bitrate + BITRATE_SMOOTHING * (rate - self.bitrate)
+        self.bytes = 0
+
+    def request_keyframe(self):
+        if self.kind != 'video':
+            return
+        now = asyncio.get_event_loop().time()
+        if now - self.last_keyframe_request < KEYFRAME_MIN_INTERVAL:
+            return
+        self.last_keyframe_request = now
+        for source in self.receiver.getSynchronizationSources():
+            asyncio.ensure_future(self.receiver._send_rtcp_pli(source.source))
+
+    def stop(self):
+        self.task.cancel()
+        for forwarded in list(self.subscribers):
+            forwarded.select(None)
+
+
+class ForwardedTrack(MediaStreamTrack):
+    """What one subscriber's sender plays: packets of the selected publisher track, unmodified"""
+
+    def __init__(self, router, kind):
+        super().__init__()
+        self.router = router
+        self.kind = kind
+        self.current = None
+        self.pending = None  # layer switched to, waiting for its next keyframe
+        self.resync = False  # current layer skipped until its next keyframe
+        self.started = False
+        self.source = None  # what the last forwarded packet came from
+        self.offset = 0  # added to the timestamps of that source
+        self.last_pts = None
+        self.queue = asyncio.Queue(FORWARD_QUEUE)
+
+    @property
+    def target(self):
+        return self.pending or self.current
+
+    def select(self, source):
+        """Forward `source` from its next keyframe on, or nothing if it is None"""
+        if self.pending is not None and self.pending is not source:
+            self.pending.subscribers.discard(self)
+        self.pending = None
+        if source is self.current:
+            return
+        if source is None:
+            if self.current is not None:
+                self.current.subscribers.discard(self)
+            self.current = None
+            return
+        self.pending = source
+        source.subscribers.add(self)
+        source.request_keyframe()
+
+    def deliver(self, source, packet):
+        if source is self.pending:
+            if not packet.is_keyframe:
+                source.request_keyframe()  # again, should the last request have been lost
+                return
+            if self.current is not None:
+                self.current.subscribers.discard(self)
+                self.router.layer_switches.inc(source.layer)
+            self.current, self.pending = source, None
+        if source is not self.current:
+            return
+        if self.resync:
+            if not packet.is_keyframe:
+                source.request_keyframe()
+                return
+            self.resync = False
+        if self.queue.full():
+            self.restart()
+            return
+        if source is not self.source:
+            # A layer's timestamps may equal or trail those just sent from another, and a
+            # subscriber would merge or drop such frames: continue shortly after the last one
+            self.source = source
+            if self.last_pts is not None:
+                self.offset = self.last_pts + int(SWITCH_GAP / packet.time_base) - packet.pts
+        self.last_pts = packet.pts + self.offset
+        self.queue.put_nowait(EncodedPacket(packet.data, self.last_pts, packet.time_base, packet.is_keyframe))
+        self.router.forwarded.inc(self.kind)
+        self.router.forwarded_bytes.inc(self.kind, amount=packet.size)
+
+    def restart(self):
+        """Drop what is queued and resume from a keyframe; the subscriber's decoder needs a clean start"""
+        dropped = self.queue.qsize()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        if dropped:
+            self.router.dropped.inc(self.kind, amount=dropped)
+        self.resync = True
+        self.request_keyframe()
+
+    async def recv(self):
+        if not self.started:
+            # Packets queued before the sender started are stale by now
+            self.started = True
+            self.restart()
+        return await self.queue.get()
+
+    def request_keyframe(self):
+        if self.target is not None:
+            self.target.request_keyframe()
+
+
+class Subscription:
+    """A sendonly transceiver of a subscriber and the publisher it currently forwards"""
+    __slots__ = ('transceiver', 'track', 'publisher', 'settle_until', 'probe_at', 'backoff')
+
+    def __init__(self, transceiver, track):
+        self.transceiver = transceiver
+        self.track = track
+        self.publisher = None
+        self.assign(None, 0.0)
+
+    def assign(self, publisher, now):
+        self.publisher = publisher
+        self.settle_until = now + LAYER_SETTLE
+        self.probe_at = 0.0
+        self.backoff = LAYER_PROBE_INTERVAL
+
+
+class Session:
+    """One participant's peer connection to the server"""
+
+    def __init__(self, sid, room_id, pc):
+        self.sid = sid
+        self.room_id = room_id
+        self.pc = pc
+        self.layers = {}  # transceiver -> layer it publishes
+        self.published = {}  # layer -> PublishedTrack
+        self.subscriptions = []
+        self.estimates = {}  # sender -> (bits/s, ssrcs) of the latest REMB it got
+        self.negotiating = False
+        self.renegotiate = False
+
+    @property
+    def bandwidth(self):
+        """bits/s the participant estimates it can receive, None before its first REMB"""
+        if not self.estimates:
+            return None
+        # A browser sends one REMB for all its streams, which reaches every sender; aiortc one per stream
+        return sum({ssrcs: bitrate for bitrate, ssrcs in self.estimates.values()}.values())
+
+    def layout(self):
+        return {s.transceiver.mid: s.publisher for s in self.subscriptions
+                if s.publisher is not None and s.transceiver.mid is not None}
+
+
+class MediaRouter:
+    """Terminates every participant's peer connection and forwards media between them.
+
+    `emit(event, data, sid)` is called on the gevent hub to send signaling to a client.
+    Methods without a leading underscore may be called from the hub; the rest run on
+    the router's own event loop.
+    """
+
+    def __init__(self, emit, ice_servers=()):
+        self.emit = emit
+        self.ice_servers = list(ice_servers)
+        self.sessions = {}
+        self.loop = None
+        self.bridge = None
+        # Written only from the router thread; a scrape reads copies (see metrics.py)
+        self.received = Counter('netstream_sfu_received_packets_total',
+                                'Encoded frames received from publishers', ['layer'])
+        self.forwarded = Counter('netstream_sfu_forwarded_packets_total',
+                                 'Encoded frames forwarded to subscribers', ['kind'])
+        self.forwarded_bytes = Counter('netstream_sfu_forwarded_bytes_total',
+                                       'Encoded media bytes forwarded to subscribers', ['kind'])
+        self.dropped = Counter('netstream_sfu_dropped_packets_total',
+                               'Frames dropped because a subscriber fell behind', ['kind'])
+        self.layer_switches = Counter('netstream_sfu_layer_switches_total',
+                                      'Forwarded videos switched to another layer', ['layer'])
+
+    @property
+    def metrics(self):
+        return (self.received, self.forwarded, self.forwarded_bytes, self.dropped, self.layer_switches)
+
+    def start(self):
+        rtcrtpreceiver.decoder_worker = forward_encoded
+        self.bridge = HubBridge()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self._run, name='sfu', daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._balance_layers())
+        self.loop.run_forever()
+
+    def _submit(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('SFU task failed', exc_info=future.exception())
+
+    def _emit(self, event, data, sid):
+        self.bridge.call(self.emit, event, data, sid)
+
+    def join(self, sid, room_id):
+        self._submit(self._join(sid, room_id))
+
+    def answer(self, sid, sdp):
+        self._submit(self._answer(sid, sdp))
+
+    def leave(self, sid):
+        self._submit(self._leave(sid))
+
+    def rename(self, old_sid, new_sid):
+        self._submit(self._rename(old_sid, new_sid))
+
+    def _peers(self, session):
+        return [s for s in self.sessions.values() if s.room_id == session.room_id and s is not session]
+
+    @staticmethod
+    def _limit_codecs(transceiver):
+        capabilities = RTCRtpSender.getCapabilities(transceiver.kind).codecs
+        transceiver.setCodecPreferences([c for c in capabilities if c.mimeType in FORWARD_CODECS[transceiver.kind]])
+
+    async def _join(self, sid, room_id):
+        if sid in self.sessions:
+            return
+        # Everything on one transport: the number of m-lines grows with the room
+        config = RTCConfiguration(iceServers=[RTCIceServer(urls=url) for url in self.ice_servers],
+                                  bundlePolicy=RTCBundlePolicy.MAX_BUNDLE)
+        session = self.sessions[sid] = Session(sid, room_id, RTCPeerConnection(config))
+        for kind, layer in PUBLISH_LAYERS:
+            transceiver = session.pc.addTransceiver(kind, direction='recvonly')
+            self._limit_codecs(transceiver)
+            session.layers[transceiver] = layer
+
+        @session.pc.on('track')
+        def on_track(track):
+            transceiver = next(t for t in session.pc.getTransceivers() if t.receiver.track is track)
+            layer = session.layers.get(transceiver)
+            if layer is not None and layer not in session.published:
+                self._publish(session, layer, track, transceiver.receiver)
+
+        @session.pc.on('connectionstatechange')
+        async def on_state():
+            logger.info('SFU connection of %s is %s', session.sid, session.pc.connectionState)
+            # The seat may be held for a resume, but this media connection will not come back
+            if session.pc.connectionState in ('failed', 'closed') and self.sessions.get(session.sid) is session:
+                await self._leave(session.sid)
+
+        for publisher in self._peers(session):
+            self._subscribe(session, publisher)
+        await self._negotiate(session)
+
+    def _publish(self, session, layer, track, receiver):
+        logger.info('SFU: %s publishes %s', session.sid, layer)
+        session.published[layer] = PublishedTrack(self, session.sid, layer, track, receiver)
+        for subscriber in self._peers(session):
+            layout = subscriber.layout()
+            if self._subscribe(subscriber, session):
+                self.loop.create_task(self._negotiate(subscriber))
+            elif subscriber.layout() != layout:
+                self._emit('sfu-layout', {'layout': subscriber.layout()}, subscriber.sid)
+
+    def _subscribe(self, subscriber, publisher):
+        """Forward publisher's audio and video to subscriber; True if that needs a renegotiation"""
+        renegotiate = False
+        for kind in ('audio', 'video'):
+            sources = [t for layer, t in publisher.published.items() if t.kind == kind]
+            if not sources:
+                continue
+            slot = next((s for s in subscriber.subscriptions
+                         if s.publisher == publisher.sid and s.track.kind == kind), None)
+            if slot is None:
+                slot = next((s for s in subscriber.subscriptions
+                             if s.publisher is None and s.track.kind == kind), None)
+            if slot is None:
+                slot = self._add_subscription(subscriber, kind)
+                renegotiate = True
+            if slot.publisher != publisher.sid:
+                slot.assign(publisher.sid, self.loop.time())
+            if slot.track.target is None:
+                preferred = publisher.published.get('high' if kind == 'video' else 'audio')
+                slot.track.select(preferred or sources[0])
+        return renegotiate
+
+    def _add_subscription(self, subscriber, kind):
+        track = ForwardedTrack(self, kind)
+        transceiver = subscriber.pc.addTransceiver(track, direction='sendonly')
+        self._limit_codecs(transceiver)
+        sender = transceiver.sender
+        # Keyframe requests go to the publisher; nothing is encoded here
+        sender._send_keyframe = track.request_keyframe
+        handle_rtcp = sender._handle_rtcp_packet
+
+        async def observe_rtcp(packet):
+            if isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
+                try:
+                    bitrate, ssrcs = unpack_remb_fci(packet.fci)
+                    subscriber.estimates[sender] = (bitrate, frozenset(ssrcs))
+                except ValueError:
+                    pass
+            await handle_rtcp(packet)
+        sender._handle_rtcp_packet = observe_rtcp
+        slot = Subscription(transceiver, track)
+        subscriber.subscriptions.append(slot)
+        return slot
+
+    async def _negotiate(self, session):
+        if session.negotiating:
+            session.renegotiate = True
+            return
+        session.negotiating = True
+        await session.pc.setLocalDescription(await session.pc.createOffer())
+        self._emit('sfu-offer', {'sdp': session.pc.localDescription.sdp, 'layout': session.layout()}, session.sid)
+
+    async def _answer(self, sid, sdp):
+        session = self.sessions.get(sid)
+        if session is None or not session.negotiating:
+            return
+        await session.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type='answer'))
+        session.negotiating = False
+        if session.renegotiate:
+            session.renegotiate = False
+            await self._negotiate(session)
+
+    async def _leave(self, sid):
+        session = self.sessions.pop(sid, None)
+        if session is None:
+            return
+        for published in session.published.values():
+            published.stop()
+        for subscriber in self._peers(session):
+            for slot in subscriber.subscriptions:
+                if slot.publisher == sid:
+                    slot.publisher = None  # free for the next publisher
+            self._emit('sfu-layout', {'layout': subscriber.layout()}, subscriber.sid)
+        await session.pc.close()
+
+    async def _rename(self, old_sid, new_sid):
+        """A participant resumed its signaling session under a new sid; its media never stopped"""
+        session = self.sessions.pop(old_sid, None)
+        if session is None:
+            return
+        session.sid = new_sid
+        self.sessions[new_sid] = session
+        for published in session.published.values():
+            published.publisher = new_sid
+        for subscriber in self._peers(session):
+            for slot in subscriber.subscriptions:
+                if slot.publisher == old_sid:
+                    slot.publisher = new_sid
+            self._emit('sfu-layout', {'layout': subscriber.layout()}, subscriber.sid)
+
+    async def _balance_layers(self):
+        last = self.loop.time()
+        while True:
+            await asyncio.sleep(LAYER_INTERVAL)
+            now = self.loop.time()
+            sessions = list(self.sessions.values())
+            for session in sessions:
+                for published in session.published.values():
+                    published.measure(now - last)
+            last = now
+            for session in sessions:
+                self._select_layers(session, now)
+
+    def _select_layers(self, subscriber, now):
+        bandwidth = subscriber.bandwidth
+        if bandwidth is None:
+            return
+        videos = []
+        for slot in subscriber.subscriptions:
+            publisher = self.sessions.get(slot.publisher) if slot.track.kind == 'video' else None
+            if publisher is not None and 'high' in publisher.published and 'low' in publisher.published:
+                videos.append((slot, publisher.published['high'], publisher.published['low']))
+        spare = bandwidth - sum(low.bitrate for _, _, low in videos)
+        # Videos already on their high layer are served first, so a marginal estimate does not rotate them
+        videos.sort(key=lambda video: video[0].track.target is not video[1])
+        for slot, high, low in videos:
+            cost = max(high.bitrate - low.bitrate, 0.0)
+            if slot.track.target is high:
+                if now < slot.settle_until or spare >= cost * LAYER_KEEP:
+                    spare -= cost
+                    if now > slot.settle_until + LAYER_PROBE_MAX:
+                        slot.backoff = LAYER_PROBE_INTERVAL
+                else:
+                    slot.track.select(low)
+                    slot.probe_at = now + slot.backoff
+                    slot.backoff = min(slot.backoff * 2, LAYER_PROBE_MAX)
+            elif spare >= cost * LAYER_HYSTERESIS or now >= slot.probe_at:
+                slot.track.select(high)
+                slot.settle_until = now + LAYER_SETTLE
+                spare -= cost
+
+    def layers(self):
+        """sid -> {publisher sid: layer forwarded to it}, for inspection"""
+        return {session.sid: {slot.publisher: slot.track.target.layer for slot in session.subscriptions
+                              if slot.publisher is not None and slot.track.kind == 'video'
+                              and slot.track.target is not None}
+                for session in list(self.sessions.values())}
@@ -0,0 +1,167 @@
+# NetStream - call quality telemetry
+#
+# Pages sample their peer connections' getStats() and send the samples in
+# batches ('call-stats'). Each call (room) gets a slot in one preallocated
+# array, slots x SAMPLES_PER_CALL x fields, used as a ring buffer per slot;
+# rows never written hold NaN. A summary is a handful of NumPy reductions
+# over that array, so percentiles for every call, and for the whole fleet,
+# take no Python loop over calls or samples. Slots of calls that stopped
+# reporting are reclaimed after IDLE_TIMEOUT.
+#
+# Summaries copy what they need on the hub, which is a memcpy, and sort in a
+# thread of the hub's pool: NumPy releases the GIL while it sorts, so even a
+# summary of thousands of calls does not hold up signaling.
+import time
+
+import gevent
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; without it telemetry is not collected
+    np = None
+
+FIELDS = ('rtt_ms', 'jitter_ms', 'loss_pct', 'outbound_kbps', 'fps', 'frames_dropped', 'quality_limited',
+          'send_loss_pct', 'available_kbps', 'cpu_limited')
+SAMPLES_PER_CALL = 256  # ring buffer length per call
+INITIAL_SLOTS = 64  # doubled whenever every slot is taken
+MAX_BATCH = 32  # samples accepted per batch
+IDLE_TIMEOUT = 600  # seconds without samples after which a call's slot is reclaimed
+PERCENTILES = (50, 95, 99)
+# Sane bounds per field; values outside are clipped, anything not a number is recorded as missing
+LIMITS = {'rtt_ms': (0, 60000), 'jitter_ms': (0, 60000), 'loss_pct': (0, 100), 'outbound_kbps': (0, 1000000),
+          'fps': (0, 240), 'frames_dropped': (0, 100000), 'quality_limited': (0, 1),
+          'send_loss_pct': (0, 100), 'available_kbps': (0, 1000000), 'cpu_limited': (0, 1)}
+
+
+def available():
+    return np is not None
+
+
+def _number(value):
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else float('nan')
+
+
+def nan_percentiles(values, percentiles, axis):
+    """Percentiles along `axis` that skip NaN, linearly interpolated like np.nanpercentile.
+
+    np.nanpercentile falls back to a Python loop over every lane along the other axes;
+    this sorts once (NaN sorts last) and gathers from the sorted lanes in one step.
+    Lanes without a value give NaN. Returns an array of len(percentiles) x the other axes.
+    """
+    ordered = np.moveaxis(np.sort(values, axis=axis), axis, -1)
+    counts = np.count_nonzero(~np.isnan(ordered), axis=-1)
+    if ordered.shape[-1] == 0:
+        return np.full((len(percentiles),) + counts.shape, np.nan)
+    results = []
+    for q in percentiles:
+        rank = np.maximum(counts - 1, 0) * (q / 100)
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(counts - 1, 0))
+        low = np.take_along_axis(ordered, lower[..., None], axis=-1)[..., 0]
+        high = np.take_along_axis(ordered, upper[..., None], axis=-1)[..., 0]
+        result = low + (high - low) * (rank - lower)
+        result[counts == 0] = np.nan
+        results.append(result)
+    return np.stack(results)
+
+
+def _by_field(result):
+    """{field: {pN: value}} from nan_percentiles over samples x FIELDS; None where nothing was sampled"""
+    return {field: {f'p{q}': None if np.isnan(result[i, j]) else round(float(result[i, j]), 2)
+                    for i, q in enumerate(PERCENTILES)}
+            for j, field in enumerate(FIELDS)}
+
+
+class StatsStore:
+    """Ring buffers of call quality samples, one slot per call"""
+
+    def __init__(self, slots=INITIAL_SLOTS):
+        self.samples = np.full((slots, SAMPLES_PER_CALL, len(FIELDS)), np.nan, dtype=np.float32)
+        self.times = np.full((slots, SAMPLES_PER_CALL), np.nan)  # when each sample arrived (epoch seconds)
+        self.positions = np.zeros(slots, dtype=np.int64)  # next row to write, per slot
+        self.last_seen = np.zeros(slots)
+        self.slots = {}  # call id -> slot
+        self.free = list(range(slots - 1, -1, -1))
+        self.low = np.array([LIMITS[field][0] for field in FIELDS], dtype=np.float32)
+        self.high = np.array([LIMITS[field][1] for field in FIELDS], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _slot(self, call_id, now):
+        slot = self.slots.get(call_id)
+        if slot is not None:
+            return slot
+        if not self.free:
+            self._reclaim(now)
+        if not self.free:
+            self._grow()
+        slot = self.slots[call_id] = self.free.pop()
+        self.samples[slot] = np.nan
+        self.times[slot] = np.nan
+        self.positions[slot] = 0
+        return slot
+
+    def _reclaim(self, now):
+        for call_id, slot in list(self.slots.items()):
+            if now - self.last_seen[slot] > IDLE_TIMEOUT:
+                del self.slots[call_id]
+                self.free.append(slot)
+
+    def _grow(self):
+        slots = len(self.positions)
+        self.samples = np.concatenate([self.samples, np.full_like(self.samples, np.nan)])
+        self.times = np.concatenate([self.times, np.full_like(self.times, np.nan)])
+        self.positions = np.concatenate([self.positions, np.zeros(slots, dtype=np.int64)])
+        self.last_seen = np.concatenate([self.last_seen, np.zeros(slots)])
+        self.free.extend(range(2 * slots - 1, slots - 1, -1))
+
+    def add(self, call_id, batch, now=None):
+        """Record a batch of samples (dicts of FIELDS) for a call; returns how many were kept"""
+        now = time.time() if now is None else now
+        batch = batch[:MAX_BATCH]
+        if not batch:
+            return 0
+        rows = np.array([[_number(sample.get(field)) for field in FIELDS] for sample in batch], dtype=np.float32)
+        np.clip(rows, self.low, self.high, out=rows)
+        slot = self._slot(call_id, now)
+        indices = (self.positions[slot] + np.arange(len(rows))) % SAMPLES_PER_CALL
+        self.times[slot, indices] = now
+        self.samples[slot, indices] = rows
+        self.positions[slot] += len(rows)
+        self.last_seen[slot] = now
+        return len(rows)
+
+    def _window(self, slots, window, now):
+        """The sample fields of `slots`, with rows older than `window` seconds blanked out"""
+        values = self.samples[slots]  # fancy indexing copies, so blanking rows is safe
+        values[~(self.times[slots] >= now - window)] = np.nan  # also blanks rows never written
+        return values
+
+    def call_summary(self, call_id, window, now=None):
+        """Sample count and percentiles of one call over the last `window` seconds, or None if unknown"""
+        now = time.time() if now is None else now
+        slot = self.slots.get(call_id)
+        if slot is None:
+            return None
+        values = self._window([slot], window, now)[0]
+        return {'samples': int(np.count_nonzero(~np.isnan(values).all(axis=1))),
+                'percentiles': _by_field(nan_percentiles(values, PERCENTILES, axis=0))}
+
+    def fleet_summary(self, window, now=None):
+        """Percentiles over every sample of every call, and over the calls' own p95s"""
+        now = time.time() if now is None else now
+        slots = np.fromiter(self.slots.values(), dtype=np.int64, count=len(self.slots))
+        values = self._window(slots, window, now)  # calls x samples x fields
+        return gevent.get_hub().threadpool.apply(self._fleet_percentiles, (values,))
+
+    @staticmethod
+    def _fleet_percentiles(values):
+        reporting = ~np.isnan(values).all(axis=2)
+        active = reporting.any(axis=1)
+        values = values[active]
+        # Each call's p95 at once; a call without a value for a field gives NaN there, which is then skipped
+        per_call = nan_percentiles(values, (95,), axis=1)[0]
+        return {'calls': int(active.sum()), 'samples': int(reporting.sum()),
+                'percentiles': _by_field(nan_percentiles(values.reshape(-1, len(FIELDS)), PERCENTILES, axis=0)),
+                'call_p95_percentiles': _by_field(nan_percentiles(per_call, PERCENTILES, axis=0))}
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+from werkzeug.http import parse_accept_header
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import assets  # noqa: E402
+
+VARIANTS = {'identity': b'', 'gzip': b'', 'br': b''}
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('gzip, br', 'br'),
+    ('br;q=0, gzip', 'gzip'),
+    ('br;q=0.1, gzip', 'gzip'),
+    ('gzip;q=0', 'identity'),
+    ('*;q=0.5, br;q=0', 'gzip'),
+    ('', 'identity'),
+])
+def test_negotiate_honours_q_values(header, expected):
+    assert assets.negotiate(VARIANTS, parse_accept_header(header)) == expected
+
+
+def test_prune_keeps_current_and_previous_build(tmp_path):
+    names = []
+    for generation in range(3):
+        bundle = assets.AssetBundle(str(tmp_path))
+        bundle.add('app.js', b'build %d' % generation, 'application/javascript')
+        names.append(bundle.logical['app.js'].name)
+        for name in os.listdir(tmp_path):  # older builds look older, whatever the file system's time resolution
+            if name.startswith(names[-1]):
+                os.utime(tmp_path / name, (generation + 1, generation + 1))
+        bundle.prune()
+    remaining = {name.split('.')[1] for name in os.listdir(tmp_path)}
+    assert remaining == {names[2].split('.')[1], names[1].split('.')[1]}
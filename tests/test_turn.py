@@ -0,0 +1,109 @@
+import hashlib
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import turn  # noqa: E402
+
+SECRET = b'test-secret'
+CLIENT = ('198.51.100.20', 40000)
+
+
+class RecordingClient:
+    """Stands in for a UDP client of the relay; keeps what it was sent"""
+    padded = False
+
+    def __init__(self):
+        self.address = CLIENT
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+
+@pytest.fixture
+def relay():
+    def make(allowed_peers=()):
+        server = turn.TurnServer(('127.0.0.1', 0), SECRET, '127.0.0.1', allowed_peers=allowed_peers)
+        made.append(server)
+        return server
+    made = []
+    yield make
+    for server in made:
+        for allocation in list(server.allocations.values()):
+            server._close(allocation)
+
+
+def request(server, client, method, attributes=(), cls=turn.REQUEST):
+    """Send an authenticated request from `client`; returns the parsed reply, if any"""
+    username, password = turn.rest_credentials(SECRET, 'tester', 3600)
+    key = hashlib.md5(f'{username}:{turn.REALM}:{password}'.encode()).digest()
+    attributes = [(turn.ATTR_USERNAME, username.encode()), (turn.ATTR_REALM, turn.REALM.encode()),
+                  (turn.ATTR_NONCE, server._nonce()), *attributes]
+    data = turn.build(method, cls, os.urandom(12), attributes, key)
+    client.sent.clear()
+    server._handle(memoryview(data), ('udp', client.address), client)
+    return turn.parse(memoryview(client.sent[-1])) if client.sent else None
+
+
+def error_code(reply):
+    value = reply.attributes.get(turn.ATTR_ERROR_CODE)
+    return None if value is None else value[2] * 100 + value[3]
+
+
+def allocate(server, client):
+    reply = request(server, client, turn.ALLOCATE, [(turn.ATTR_REQUESTED_TRANSPORT, bytes([turn.TRANSPORT_UDP, 0, 0, 0]))])
+    assert reply.cls == turn.SUCCESS
+    return server.allocations[('udp', client.address)]
+
+
+def peer(address):
+    return (turn.ATTR_XOR_PEER_ADDRESS, turn._xor_address_value(address))
+
+
+@pytest.mark.parametrize('address', ['10.1.2.3', '192.168.1.10', '172.16.0.5', '100.64.0.1', '127.0.0.1'])
+def test_create_permission_to_internal_peer_is_forbidden(relay, address):
+    server, client = relay(), RecordingClient()
+    allocation = allocate(server, client)
+    reply = request(server, client, turn.CREATE_PERMISSION, [peer((address, 5000))])
+    assert reply.cls == turn.ERROR and error_code(reply) == 403
+    assert address not in allocation.permissions
+
+
+@pytest.mark.parametrize('address', ['10.1.2.3', '192.168.1.10'])
+def test_channel_bind_to_private_peer_is_forbidden(relay, address):
+    server, client = relay(), RecordingClient()
+    allocate(server, client)
+    reply = request(server, client, turn.CHANNEL_BIND,
+                    [(turn.ATTR_CHANNEL_NUMBER, struct.pack('!HH', turn.CHANNEL_MIN, 0)), peer((address, 5000))])
+    assert reply.cls == turn.ERROR and error_code(reply) == 403
+
+
+def test_send_to_private_peer_is_dropped(relay):
+    server, client = relay(), RecordingClient()
+    allocate(server, client)
+    request(server, client, turn.CREATE_PERMISSION, [peer(('10.1.2.3', 5000))])
+    request(server, client, turn.SEND, [peer(('10.1.2.3', 5000)), (turn.ATTR_DATA, b'probe')], cls=turn.INDICATION)
+    assert server.dropped.get('no_permission') == 1
+    assert server.packets.get('to_peer') == 0
+
+
+def test_public_peer_is_permitted(relay):
+    server, client = relay(), RecordingClient()
+    allocation = allocate(server, client)
+    reply = request(server, client, turn.CREATE_PERMISSION, [peer(('93.184.216.34', 5000))])
+    assert reply.cls == turn.SUCCESS
+    assert '93.184.216.34' in allocation.permissions
+
+
+def test_allowed_private_network_is_permitted(relay):
+    server, client = relay(allowed_peers=['10.0.0.0/8']), RecordingClient()
+    allocation = allocate(server, client)
+    assert request(server, client, turn.CREATE_PERMISSION, [peer(('10.1.2.3', 5000))]).cls == turn.SUCCESS
+    assert '10.1.2.3' in allocation.permissions
+    reply = request(server, client, turn.CREATE_PERMISSION, [peer(('192.168.1.10', 5000))])
+    assert error_code(reply) == 403
@@ -0,0 +1,122 @@
+# NetStream - per-room transcripts with phrase search
+#
+# Final speech recognition results are numbered per room and appended to a
+# segment log (the same on-disk format as the chat history). A positional
+# inverted index is updated with every entry, so a phrase query only looks at
+# the entries that contain its rarest word instead of scanning the transcript.
+# Indexes of rooms that went quiet stay cached until `max_idle` newer rooms
+# push them out; after that they are rebuilt from disk on the next query.
+from collections import OrderedDict
+import json
+import os
+import re
+import time
+
+from chatstore import SegmentLog
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def _entry(seq, ts, payload):
+    role, text = json.loads(payload)
+    return {'seq': seq, 'ts': ts, 'role': role, 'text': text}
+
+
+class Transcript:
+    """One room's transcript: its log, its entries and a positional inverted index"""
+
+    def __init__(self, log):
+        self.log = log
+        self.entries = {}
+        self.postings = {}  # token -> {seq: [positions]}, seqs in ascending order
+        self.last_seq = log.recover()
+        for record in log.read(1, self.last_seq + 1):
+            self._index(_entry(*record))
+
+    def _index(self, entry):
+        self.entries[entry['seq']] = entry
+        for position, token in enumerate(tokenize(entry['text'])):
+            self.postings.setdefault(token, {}).setdefault(entry['seq'], []).append(position)
+
+    def append(self, role, text):
+        self.last_seq += 1
+        entry = {'seq': self.last_seq, 'ts': time.time(), 'role': role, 'text': text}
+        self.log.append(entry['seq'], entry['ts'], json.dumps([role, text]).encode('utf-8'))
+        self._index(entry)
+        return entry
+
+    def search(self, phrase, limit=50):
+        """Entries containing the words of `phrase` consecutively, oldest first"""
+        tokens = tokenize(phrase)
+        if not tokens:
+            return []
+        lists = [self.postings.get(token) for token in tokens]
+        if not all(lists):
+            return []
+        rarest = min(lists, key=len)
+        hits = []
+        for seq in rarest:
+            if not all(seq in postings for postings in lists):
+                continue
+            following = [set(postings[seq]) for postings in lists[1:]]
+            if any(all(start + offset in positions for offset, positions in enumerate(following, 1))
+                   for start in lists[0][seq]):
+                hits.append(self.entries[seq])
+                if len(hits) >= limit:
+                    break
+        return hits
+
+
+class TranscriptStore:
+    """Transcripts for every room, stored under `directory`/<room id>"""
+
+    def __init__(self, directory, max_idle=32):
+        self.directory = directory
+        self.max_idle = max_idle
+        self.active = {}
+        self.idle = OrderedDict()
+
+    def _log(self, room_id):
+        return SegmentLog(os.path.join(self.directory, room_id))
+
+    def _get(self, room_id):
+        transcript = self.active.get(room_id)
+        if transcript is None:
+            transcript = self.idle.get(room_id)
+            if transcript is None:
+                transcript = Transcript(self._log(room_id))
+                self._park(room_id, transcript)
+            else:
+                self.idle.move_to_end(room_id)
+        return transcript
+
+    def _park(self, room_id, transcript):
+        self.idle[room_id] = transcript
+        while len(self.idle) > self.max_idle:
+            self.idle.popitem(last=False)
+
+    def append(self, room_id, role, text):
+        """Record a final transcription and return its entry"""
+        transcript = self.active.get(room_id)
+        if transcript is None:
+            transcript = self.active[room_id] = self.idle.pop(room_id, None) or Transcript(self._log(room_id))
+        return transcript.append(role, text)
+
+    def search(self, room_id, phrase, limit=50):
+        return self._get(room_id).search(phrase, limit)
+
+    def export(self, room_id):
+        """Yield the transcript as JSON lines, read from disk one record at a time"""
+        for record in self._log(room_id).read(1, float('inf')):
+            yield json.dumps(_entry(*record)) + '\n'
+
+    def close(self, room_id):
+        """Close a room's log; its index stays cached with the other idle rooms"""
+        transcript = self.active.pop(room_id, None)
+        if transcript is not None:
+            transcript.log.close()
+            self._park(room_id, transcript)
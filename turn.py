@@ -0,0 +1,702 @@
+# NetStream - optional built-in TURN relay (--turn)
+#
+# A relay (RFC 5766) for the calls whose peers cannot reach each other
+# directly, e.g. both behind symmetric NATs. Clients reach it over UDP or TCP
+# on one port, which also answers plain STUN binding requests; each allocation
+# relays over UDP from a socket of its own. Only IPv4 is relayed.
+#
+# Requests are authenticated with the long-term credential mechanism, using
+# time-limited credentials derived from a shared secret (the TURN REST API
+# scheme): the username is "<expiry>:<user>" and the password an HMAC of it,
+# so the signaling server mints them and the relay keeps no user table.
+#
+# Relayed data stays off the STUN parser. ChannelData from a client is looked
+# up by channel number and sent on from the view it arrived in. Each
+# allocation's reader receives from peers into a buffer allocated once, at an
+# offset that leaves room to write the ChannelData or Data indication header
+# in place in front of the payload, so a relayed packet costs no copies.
+# Everything runs on the gevent hub, next to the WSGIServer.
+import base64
+import hashlib
+import hmac
+import ipaddress
+import logging
+import os
+import random
+import struct
+import time
+
+import gevent
+from gevent import socket
+from gevent.lock import Semaphore
+from gevent.server import StreamServer
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+REALM = 'netstream'
+DEFAULT_LIFETIME = 600  # seconds an allocation lives unless refreshed
+MAX_LIFETIME = 3600
+PERMISSION_LIFETIME = 300
+CHANNEL_LIFETIME = 600
+NONCE_LIFETIME = 3600  # seconds before a nonce goes stale (438) and the client retries with a new one
+SWEEP_INTERVAL = 10  # seconds between expiry sweeps
+MAX_ALLOCATIONS = 500  # per relay
+MAX_USER_ALLOCATIONS = 10  # per credential
+MAX_DATAGRAM = 65535
+SOFTWARE = b'NetStream'
+CGNAT = ipaddress.ip_network('100.64.0.0/10')  # shared address space (RFC 6598), not covered by is_private
+
+MAGIC_COOKIE = 0x2112A442
+HEADER = 20
+STUN_HEADER = struct.Struct('!HHI')
+ATTR_HEADER = struct.Struct('!HH')
+CHANNEL_HEADER = struct.Struct('!HH')
+# Data indication up to its DATA value: STUN header, XOR-PEER-ADDRESS (IPv4), DATA attribute header
+INDICATION_HEADER = struct.Struct('!HHI12sHHBBHIHH')
+DATA_OFFSET = INDICATION_HEADER.size  # where a relay buffer receives the payload
+CHANNEL_OFFSET = DATA_OFFSET - CHANNEL_HEADER.size
+PADDING = (b'', b'\0', b'\0\0', b'\0\0\0')
+
+# Methods
+BINDING = 0x001
+ALLOCATE = 0x003
+REFRESH = 0x004
+SEND = 0x006
+DATA = 0x007
+CREATE_PERMISSION = 0x008
+CHANNEL_BIND = 0x009
+METHOD_NAMES = {BINDING: 'binding', ALLOCATE: 'allocate', REFRESH: 'refresh',
+                CREATE_PERMISSION: 'create_permission', CHANNEL_BIND: 'channel_bind'}
+
+# Classes
+REQUEST = 0x000
+INDICATION = 0x010
+SUCCESS = 0x100
+ERROR = 0x110
+
+# Attributes
+ATTR_USERNAME = 0x0006
+ATTR_MESSAGE_INTEGRITY = 0x0008
+ATTR_ERROR_CODE = 0x0009
+ATTR_UNKNOWN_ATTRIBUTES = 0x000A
+ATTR_CHANNEL_NUMBER = 0x000C
+ATTR_LIFETIME = 0x000D
+ATTR_XOR_PEER_ADDRESS = 0x0012
+ATTR_DATA = 0x0013
+ATTR_REALM = 0x0014
+ATTR_NONCE = 0x0015
+ATTR_XOR_RELAYED_ADDRESS = 0x0016
+ATTR_REQUESTED_ADDRESS_FAMILY = 0x0017
+ATTR_REQUESTED_TRANSPORT = 0x0019
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+ATTR_SOFTWARE = 0x8022
+# Comprehension-required attributes this relay understands; others get a 420. EVEN-PORT,
+# RESERVATION-TOKEN and DONT-FRAGMENT are not supported, which is how RFC 5766 says to refuse them.
+KNOWN_ATTRIBUTES = frozenset((ATTR_USERNAME, ATTR_MESSAGE_INTEGRITY, ATTR_ERROR_CODE, ATTR_UNKNOWN_ATTRIBUTES,
+                              ATTR_CHANNEL_NUMBER, ATTR_LIFETIME, ATTR_XOR_PEER_ADDRESS, ATTR_DATA, ATTR_REALM,
+                              ATTR_NONCE, ATTR_XOR_RELAYED_ADDRESS, ATTR_REQUESTED_ADDRESS_FAMILY,
+                              ATTR_REQUESTED_TRANSPORT, ATTR_XOR_MAPPED_ADDRESS))
+TRANSPORT_UDP = 17
+FAMILY_IPV4 = 0x01
+CHANNEL_MIN = 0x4000
+CHANNEL_MAX = 0x7FFF
+
+REASONS = {400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden', 420: 'Unknown Attribute',
+           437: 'Allocation Mismatch', 438: 'Stale Nonce', 440: 'Address Family not Supported',
+           441: 'Wrong Credentials', 442: 'Unsupported Transport Protocol', 486: 'Allocation Quota Reached',
+           508: 'Insufficient Capacity'}
+
+
+def rest_password(secret, username):
+    """The password the relay expects with `username`, for a shared secret (bytes)"""
+    return base64.b64encode(hmac.new(secret, username.encode(), hashlib.sha1).digest()).decode()
+
+
+def rest_credentials(secret, user, ttl):
+    """(username, password) for `user`, valid for `ttl` seconds"""
+    username = f'{int(time.time() + ttl)}:{user}'
+    return username, rest_password(secret, username)
+
+
+def local_address():
+    """This host's address on its default route: what to relay from when listening on every interface"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(('192.0.2.1', 9))  # only picks a route; nothing is sent
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
+
+
+def _message_type(method, cls):
+    return (method & 0x000F) | ((method & 0x0070) << 1) | ((method & 0x0F80) << 2) | cls
+
+
+def _xor_address(value):
+    """(ip, port) from an IPv4 XOR-*-ADDRESS value, or None"""
+    if len(value) != 8 or value[1] != FAMILY_IPV4:
+        return None
+    port, ip = struct.unpack_from('!HI', value, 2)
+    return socket.inet_ntoa(struct.pack('!I', ip ^ MAGIC_COOKIE)), port ^ (MAGIC_COOKIE >> 16)
+
+
+def _xor_address_value(address):
+    ip = struct.unpack('!I', socket.inet_aton(address[0]))[0]
+    return struct.pack('!BBHI', 0, FAMILY_IPV4, address[1] ^ (MAGIC_COOKIE >> 16), ip ^ MAGIC_COOKIE)
+
+
+def _lifetime(message):
+    value = message.attributes.get(ATTR_LIFETIME)
+    requested = struct.unpack('!I', value)[0] if value is not None and len(value) == 4 else DEFAULT_LIFETIME
+    return requested and max(DEFAULT_LIFETIME, min(requested, MAX_LIFETIME))
+
+
+def _relayable(ip, allowed=()):
+    """Whether peers at `ip` may be relayed to.
+
+    Never the relay host's loopback or special addresses. Private and carrier-grade NAT
+    addresses only if one of the `allowed` networks holds them: any page gets credentials
+    from /ice-config, and must not reach into the network the relay sits in.
+    """
+    address = ipaddress.ip_address(ip)
+    if (address.is_loopback or address.is_unspecified or address.is_multicast
+            or address.is_link_local or address.is_reserved):
+        return False
+    if address.is_private or address in CGNAT:
+        return any(address in network for network in allowed)
+    return True
+
+
+def build(method, cls, txid, attributes, key=None):
+    """Encode a STUN message; with `key`, signed with MESSAGE-INTEGRITY"""
+    body = bytearray()
+    for kind, value in attributes:
+        body += ATTR_HEADER.pack(kind, len(value))
+        body += value
+        body += PADDING[-len(value) % 4]
+    kind = _message_type(method, cls)
+    if key is not None:
+        header = STUN_HEADER.pack(kind, len(body) + 24, MAGIC_COOKIE) + txid
+        body += ATTR_HEADER.pack(ATTR_MESSAGE_INTEGRITY, 20)
+        body += hmac.new(key, header + body[:-4], hashlib.sha1).digest()
+    return STUN_HEADER.pack(kind, len(body), MAGIC_COOKIE) + txid + body
+
+
+class Message:
+    """A parsed STUN message; attribute values are views into the buffer it arrived in"""
+    __slots__ = ('method', 'cls', 'txid', 'attributes', 'peers', 'unknown', 'integrity', 'view')
+
+    def __init__(self, method, cls, txid, view):
+        self.method = method
+        self.cls = cls
+        self.txid = txid
+        self.attributes = {}
+        self.peers = []  # every XOR-PEER-ADDRESS, which CreatePermission may repeat
+        self.unknown = []
+        self.integrity = None  # offset of MESSAGE-INTEGRITY
+        self.view = view
+
+    def verify(self, key):
+        """Whether MESSAGE-INTEGRITY matches `key`"""
+        offset = self.integrity
+        header = bytearray(self.view[:HEADER])
+        struct.pack_into('!H', header, 2, offset + 24 - HEADER)
+        digest = hmac.new(key, header + self.view[HEADER:offset], hashlib.sha1).digest()
+        return hmac.compare_digest(digest, bytes(self.view[offset + 4:offset + 24]))
+
+
+def parse(view):
+    """The STUN message in `view`, or None if it is not one"""
+    if len(view) < HEADER:
+        return None
+    kind, length, cookie = STUN_HEADER.unpack_from(view)
+    if kind & 0xC000 or cookie != MAGIC_COOKIE or length % 4 or HEADER + length > len(view):
+        return None
+    method = (kind & 0x000F) | ((kind & 0x00E0) >> 1) | ((kind & 0x3E00) >> 2)
+    message = Message(method, kind & 0x0110, bytes(view[8:HEADER]), view)
+    offset, end = HEADER, HEADER + length
+    while offset + 4 <= end:
+        attribute, size = ATTR_HEADER.unpack_from(view, offset)
+        value_end = offset + 4 + size
+        if value_end > end:
+            return None
+        # Everything after MESSAGE-INTEGRITY (a FINGERPRINT, if anything) is not covered by it
+        if message.integrity is None:
+            if attribute == ATTR_MESSAGE_INTEGRITY:
+                if size != 20:
+                    return None
+                message.integrity = offset
+            elif attribute == ATTR_XOR_PEER_ADDRESS:
+                message.peers.append(view[offset + 4:value_end])
+            elif attribute not in KNOWN_ATTRIBUTES and attribute < 0x8000:
+                message.unknown.append(attribute)
+            message.attributes.setdefault(attribute, view[offset + 4:value_end])
+        offset = value_end + (-size % 4)
+    return message
+
+
+class UdpClient:
+    __slots__ = ('sock', 'address')
+    padded = False
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+
+    def send(self, data):
+        self.sock.sendto(data, self.address)
+
+
+class TcpClient:
+    """A client connection; the lock keeps messages from greenlets sharing it whole on the stream"""
+    __slots__ = ('sock', 'address', 'lock')
+    padded = True  # ChannelData over a stream is padded to a multiple of four bytes
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.lock = Semaphore()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+
+class Allocation:
+    """A relayed transport address and the permissions and channels installed on it"""
+
+    def __init__(self, relay, client_key, client, username, key, sock, lifetime):
+        self.relay = relay
+        self.client_key = client_key
+        self.client = client
+        self.username = username
+        self.key = key
+        self.sock = sock
+        self.address = (relay.relay_ip, sock.getsockname()[1])
+        self.expires = time.monotonic() + lifetime
+        self.permissions = {}  # peer ip -> expiry
+        self.channels = {}  # channel number -> [peer address, expiry]
+        self.peer_channels = {}  # peer address -> channel number
+        self.buffer = bytearray(DATA_OFFSET + MAX_DATAGRAM + 3)
+        self.sequence = 0
+        self.txid = b''  # the Allocate request's transaction and response, for retransmissions
+        self.response = b''
+        self.reader = gevent.spawn(self._relay_to_client)
+
+    def close(self):
+        self.reader.kill(block=False)
+        self.sock.close()
+
+    def permit(self, ip, now):
+        self.permissions[ip] = now + PERMISSION_LIFETIME
+
+    def bind(self, channel, peer, now):
+        self.channels[channel] = [peer, now + CHANNEL_LIFETIME]
+        self.peer_channels[peer] = channel
+        self.permit(peer[0], now)
+
+    def expire(self, now):
+        for ip in [ip for ip, expires in self.permissions.items() if expires < now]:
+            del self.permissions[ip]
+        for channel in [channel for channel, (_, expires) in self.channels.items() if expires < now]:
+            del self.peer_channels[self.channels.pop(channel)[0]]
+
+    def from_client(self, view):
+        """Relay a ChannelData message from the client"""
+        channel, length = CHANNEL_HEADER.unpack_from(view)
+        binding = self.channels.get(channel)
+        if binding is None or length > len(view) - CHANNEL_HEADER.size:
+            self.relay.dropped.inc('no_channel')
+            return
+        self.send_to_peer(view[CHANNEL_HEADER.size:CHANNEL_HEADER.size + length], binding[0])
+
+    def send_to_peer(self, data, peer):
+        try:
+            self.sock.sendto(data, peer)
+        except OSError:
+            self.relay.dropped.inc('send_failed')
+            return
+        self.relay.packets.inc('to_peer')
+        self.relay.bytes.inc('to_peer', amount=len(data))
+
+    def _relay_to_client(self):
+        buffer = self.buffer
+        view = memoryview(buffer)
+        payload = view[DATA_OFFSET:DATA_OFFSET + MAX_DATAGRAM]
+        client = self.client
+        txid_prefix = os.urandom(4)
+        while True:
+            try:
+                size, peer = self.sock.recvfrom_into(payload)
+            except OSError:
+                return
+            expires = self.permissions.get(peer[0])
+            if expires is None or expires < time.monotonic():
+                self.relay.dropped.inc('no_permission')
+                continue
+            padding = -size % 4
+            channel = self.peer_channels.get(peer)
+            if channel is not None:
+                CHANNEL_HEADER.pack_into(buffer, CHANNEL_OFFSET, channel, size)
+                start, end = CHANNEL_OFFSET, DATA_OFFSET + size
+                if client.padded:
+                    buffer[end:end + padding] = PADDING[padding]
+                    end += padding
+            else:
+                self.sequence += 1
+                ip = struct.unpack('!I', socket.inet_aton(peer[0]))[0]
+                INDICATION_HEADER.pack_into(
+                    buffer, 0, _message_type(DATA, INDICATION), DATA_OFFSET - HEADER + size + padding,
+                    MAGIC_COOKIE, txid_prefix + self.sequence.to_bytes(8, 'big'),
+                    ATTR_XOR_PEER_ADDRESS, 8, 0, FAMILY_IPV4, peer[1] ^ (MAGIC_COOKIE >> 16), ip ^ MAGIC_COOKIE,
+                    ATTR_DATA, size)
+                buffer[DATA_OFFSET + size:DATA_OFFSET + size + padding] = PADDING[padding]
+                start, end = 0, DATA_OFFSET + size + padding
+            try:
+                client.send(view[start:end])
+            except OSError:
+                self.relay.dropped.inc('send_failed')
+                continue
+            self.relay.packets.inc('to_client')
+            self.relay.bytes.inc('to_client', amount=size)
+
+
+class TurnServer:
+    """TURN over UDP and TCP on `address`, relaying from `relay_ip`.
+
+    `relay_ip` is the address given out for relayed transports; pass the public
+    one when the host sits behind a 1:1 NAT. `relay_ports` (low, high) confines
+    relay sockets to a range that a firewall can open. Peers in private or
+    carrier-grade NAT ranges are refused (403) unless `allowed_peers`, a list of
+    networks, holds them.
+    """
+
+    def __init__(self, address, secret, relay_ip, relay_ports=None, realm=REALM, allowed_peers=()):
+        self.address = address
+        self.secret = secret
+        self.relay_ip = relay_ip
+        self.relay_ports = relay_ports
+        self.allowed_peers = tuple(ipaddress.ip_network(network) for network in allowed_peers)
+        self.realm = realm
+        self.nonce_key = os.urandom(16)
+        self.allocations = {}  # (transport, client address) -> Allocation
+        self.udp = None
+        self.tcp = None
+        self.greenlets = []
+        self.requests = Counter('netstream_turn_requests_total', 'TURN requests answered', ['method', 'result'])
+        self.packets = Counter('netstream_turn_relayed_packets_total', 'Packets relayed', ['direction'])
+        self.bytes = Counter('netstream_turn_relayed_bytes_total', 'Payload bytes relayed', ['direction'])
+        self.dropped = Counter('netstream_turn_dropped_packets_total', 'Packets the relay dropped', ['reason'])
+        self.active = Gauge('netstream_turn_allocations', 'Allocations currently open',
+                            lambda: len(self.allocations))
+
+    @property
+    def metrics(self):
+        return (self.requests, self.packets, self.bytes, self.dropped, self.active)
+
+    def start(self):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp.bind(self.address)
+        self.tcp = StreamServer(self.address, self._serve_tcp)
+        self.tcp.start()
+        self.greenlets = [gevent.spawn(self._serve_udp), gevent.spawn(self._sweep)]
+        logger.info('TURN relay on %s:%d (udp, tcp), relaying from %s', *self.address, self.relay_ip)
+
+    def stop(self):
+        gevent.killall(self.greenlets, block=False)
+        self.tcp.stop(timeout=0)
+        self.udp.close()
+        for allocation in list(self.allocations.values()):
+            self._close(allocation)
+
+    def _serve_udp(self):
+        # One buffer for every datagram: a message is handled before the next is received
+        buffer = bytearray(MAX_DATAGRAM)
+        view = memoryview(buffer)
+        while True:
+            try:
+                size, address = self.udp.recvfrom_into(buffer)
+            except OSError:
+                return
+            if size >= CHANNEL_HEADER.size and 0x40 <= buffer[0] < 0x80:
+                allocation = self.allocations.get(('udp', address))
+                if allocation is not None:
+                    allocation.from_client(view[:size])
+                else:
+                    self.dropped.inc('no_allocation')
+            else:
+                self._handle(view[:size], ('udp', address), UdpClient(self.udp, address))
+
+    def _serve_tcp(self, sock, address):
+        key = ('tcp', address)
+        client = TcpClient(sock, address)
+        buffer = bytearray(HEADER + MAX_DATAGRAM + 1)
+        view = memoryview(buffer)
+        filled = 0
+        try:
+            while True:
+                received = sock.recv_into(view[filled:])
+                if not received:
+                    return
+                filled += received
+                start = 0
+                while filled - start >= 4:
+                    kind, length = CHANNEL_HEADER.unpack_from(buffer, start)
+                    if kind < 0x4000:
+                        size = HEADER + length
+                    elif kind < 0x8000:
+                        size = CHANNEL_HEADER.size + length + (-length % 4)
+                    else:
+                        return  # neither STUN nor ChannelData: the stream cannot be resynchronized
+                    if filled - start < size:
+                        break
+                    message = view[start:start + size]
+                    if kind < 0x4000:
+                        self._handle(message, key, client)
+                    else:
+                        allocation = self.allocations.get(key)
+                        if allocation is not None:
+                            allocation.from_client(message)
+                    start += size
+                if start:
+                    buffer[:filled - start] = buffer[start:filled]
+                    filled -= start
+        except OSError:
+            pass
+        finally:
+            allocation = self.allocations.get(key)
+            if allocation is not None:
+                self._close(allocation)
+            sock.close()
+
+    def _sweep(self):
+        while True:
+            gevent.sleep(SWEEP_INTERVAL)
+            now = time.monotonic()
+            for allocation in list(self.allocations.values()):
+                if allocation.expires < now:
+                    self._close(allocation)
+                else:
+                    allocation.expire(now)
+
+    def _open(self, client_key, client, username, hmac_key, lifetime):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._bind_relay(sock)
+        except OSError:
+            sock.close()
+            raise
+        allocation = Allocation(self, client_key, client, username, hmac_key, sock, lifetime)
+        self.allocations[client_key] = allocation
+        return allocation
+
+    def _bind_relay(self, sock):
+        host = self.address[0]
+        if self.relay_ports is None:
+            sock.bind((host, 0))
+            return
+        low, high = self.relay_ports
+        first = random.randint(low, high)
+        for port in range(first, first + high - low + 1):
+            try:
+                sock.bind((host, low + (port - low) % (high - low + 1)))
+                return
+            except OSError:
+                continue
+        raise OSError('no free relay port')
+
+    def _close(self, allocation):
+        if self.allocations.get(allocation.client_key) is allocation:
+            del self.allocations[allocation.client_key]
+        allocation.close()
+
+    # Control messages
+
+    def _handle(self, view, key, client):
+        message = parse(view)
+        if message is None:
+            self.dropped.inc('malformed')
+            return
+        if message.cls == INDICATION:
+            if message.method == SEND:
+                allocation = self.allocations.get(key)
+                if allocation is not None:
+                    self._send_indication(allocation, message)
+            return
+        if message.cls != REQUEST:
+            return
+        method = METHOD_NAMES.get(message.method)
+        if method is None:
+            self._reply_error(client, message, 400, 'unknown')
+        elif message.unknown:
+            attributes = b''.join(struct.pack('!H', attribute) for attribute in message.unknown)
+            self._reply_error(client, message, 420, method, [(ATTR_UNKNOWN_ATTRIBUTES, attributes)])
+        elif message.method == BINDING:
+            self._reply(client, message, method, [(ATTR_XOR_MAPPED_ADDRESS, _xor_address_value(client.address))])
+        else:
+            credentials = self._authenticate(client, message, method)
+            if credentials is not None:
+                getattr(self, f'_{method}')(client, key, message, *credentials)
+
+    def _reply(self, client, message, method, attributes, key=None):
+        self.requests.inc(method, 'ok')
+        client.send(build(message.method, SUCCESS, message.txid, attributes + [(ATTR_SOFTWARE, SOFTWARE)], key))
+
+    def _reply_error(self, client, message, code, method, attributes=(), key=None):
+        self.requests.inc(method, str(code))
+        error = struct.pack('!HBB', 0, code // 100, code % 100) + REASONS[code].encode()
+        client.send(build(message.method, ERROR, message.txid,
+                          [(ATTR_ERROR_CODE, error), *attributes, (ATTR_SOFTWARE, SOFTWARE)], key))
+
+    def _nonce(self):
+        stamp = f'{int(time.time()):x}'
+        return (stamp + hmac.new(self.nonce_key, stamp.encode(), hashlib.sha1).hexdigest()[:16]).encode()
+
+    def _nonce_fresh(self, nonce):
+        stamp, signature = nonce[:-16], nonce[-16:]
+        expected = hmac.new(self.nonce_key, stamp, hashlib.sha1).hexdigest()[:16].encode()
+        if not hmac.compare_digest(signature, expected):
+            return False
+        try:
+            return time.time() - int(stamp, 16) < NONCE_LIFETIME
+        except ValueError:
+            return False
+
+    def _long_term_key(self, username):
+        """MD5(username:realm:password) for a REST credential that has not expired, else None"""
+        expiry, _, _ = username.partition(':')
+        try:
+            if int(expiry) < time.time():
+                return None
+        except ValueError:
+            return None
+        password = rest_password(self.secret, username)
+        return hashlib.md5(f'{username}:{self.realm}:{password}'.encode()).digest()
+
+    def _authenticate(self, client, message, method):
+        """(username, key) of an authentic request; anything else is answered with an error here"""
+        challenge = [(ATTR_REALM, self.realm.encode()), (ATTR_NONCE, self._nonce())]
+        attributes = message.attributes
+        if message.integrity is None:
+            self._reply_error(client, message, 401, method, challenge)
+            return None
+        if ATTR_USERNAME not in attributes or ATTR_REALM not in attributes or ATTR_NONCE not in attributes:
+            self._reply_error(client, message, 400, method)
+            return None
+        if not self._nonce_fresh(bytes(attributes[ATTR_NONCE])):
+            self._reply_error(client, message, 438, method, challenge)
+            return None
+        username = bytes(attributes[ATTR_USERNAME]).decode('utf-8', 'replace')
+        key = self._long_term_key(username)
+        if key is None or not message.verify(key):
+            self._reply_error(client, message, 401, method, challenge)
+            return None
+        return username, key
+
+    def _allocation_of(self, client, key, message, method, username, hmac_key):
+        """The client's allocation, answering 437 or 441 if it has none or it is someone else's"""
+        allocation = self.allocations.get(key)
+        if allocation is None:
+            self._reply_error(client, message, 437, method, key=hmac_key)
+        elif allocation.username != username:
+            self._reply_error(client, message, 441, method, key=hmac_key)
+        else:
+            return allocation
+        return None
+
+    def _allocate(self, client, key, message, username, hmac_key):
+        existing = self.allocations.get(key)
+        if existing is not None:
+            if existing.txid == message.txid:
+                client.send(existing.response)  # a retransmission of the request that created it
+            else:
+                self._reply_error(client, message, 437, 'allocate', key=hmac_key)
+            return
+        transport = message.attributes.get(ATTR_REQUESTED_TRANSPORT)
+        family = message.attributes.get(ATTR_REQUESTED_ADDRESS_FAMILY)
+        if transport is None or len(transport) != 4:
+            self._reply_error(client, message, 400, 'allocate', key=hmac_key)
+        elif transport[0] != TRANSPORT_UDP:
+            self._reply_error(client, message, 442, 'allocate', key=hmac_key)
+        elif family is not None and (len(family) != 4 or family[0] != FAMILY_IPV4):
+            self._reply_error(client, message, 440, 'allocate', key=hmac_key)
+        elif len(self.allocations) >= MAX_ALLOCATIONS:
+            self._reply_error(client, message, 508, 'allocate', key=hmac_key)
+        elif sum(a.username == username for a in self.allocations.values()) >= MAX_USER_ALLOCATIONS:
+            self._reply_error(client, message, 486, 'allocate', key=hmac_key)
+        else:
+            lifetime = _lifetime(message) or DEFAULT_LIFETIME
+            try:
+                allocation = self._open(key, client, username, hmac_key, lifetime)
+            except OSError as e:
+                logger.warning('TURN relay could not open a relay socket: %s', e)
+                self._reply_error(client, message, 508, 'allocate', key=hmac_key)
+                return
+            allocation.txid = message.txid
+            allocation.response = build(ALLOCATE, SUCCESS, message.txid, [
+                (ATTR_XOR_RELAYED_ADDRESS, _xor_address_value(allocation.address)),
+                (ATTR_LIFETIME, struct.pack('!I', lifetime)),
+                (ATTR_XOR_MAPPED_ADDRESS, _xor_address_value(client.address)),
+                (ATTR_SOFTWARE, SOFTWARE)], hmac_key)
+            self.requests.inc('allocate', 'ok')
+            client.send(allocation.response)
+
+    def _refresh(self, client, key, message, username, hmac_key):
+        allocation = self._allocation_of(client, key, message, 'refresh', username, hmac_key)
+        if allocation is None:
+            return
+        lifetime = _lifetime(message)
+        if lifetime:
+            allocation.expires = time.monotonic() + lifetime
+        else:
+            self._close(allocation)
+        self._reply(client, message, 'refresh', [(ATTR_LIFETIME, struct.pack('!I', lifetime))], hmac_key)
+
+    def _create_permission(self, client, key, message, username, hmac_key):
+        allocation = self._allocation_of(client, key, message, 'create_permission', username, hmac_key)
+        if allocation is None:
+            return
+        peers = [_xor_address(value) for value in message.peers]
+        if not peers or None in peers:
+            self._reply_error(client, message, 400, 'create_permission', key=hmac_key)
+        elif not all(_relayable(ip, self.allowed_peers) for ip, _ in peers):
+            self._reply_error(client, message, 403, 'create_permission', key=hmac_key)
+        else:
+            now = time.monotonic()
+            for ip, _ in peers:
+                allocation.permit(ip, now)
+            self._reply(client, message, 'create_permission', [], hmac_key)
+
+    def _channel_bind(self, client, key, message, username, hmac_key):
+        allocation = self._allocation_of(client, key, message, 'channel_bind', username, hmac_key)
+        if allocation is None:
+            return
+        number = message.attributes.get(ATTR_CHANNEL_NUMBER)
+        channel = struct.unpack_from('!H', number)[0] if number is not None and len(number) == 4 else 0
+        peer = _xor_address(message.peers[0]) if len(message.peers) == 1 else None
+        if not CHANNEL_MIN <= channel <= CHANNEL_MAX or peer is None:
+            self._reply_error(client, message, 400, 'channel_bind', key=hmac_key)
+        elif not _relayable(peer[0], self.allowed_peers):
+            self._reply_error(client, message, 403, 'channel_bind', key=hmac_key)
+        elif (allocation.channels.get(channel, [peer])[0] != peer
+              or allocation.peer_channels.get(peer, channel) != channel):
+            # Bound, to another peer or as another number: a binding cannot be moved before it expires
+            self._reply_error(client, message, 400, 'channel_bind', key=hmac_key)
+        else:
+            allocation.bind(channel, peer, time.monotonic())
+            self._reply(client, message, 'channel_bind', [], hmac_key)
+
+    def _send_indication(self, allocation, message):
+        peer = _xor_address(message.peers[0]) if message.peers else None
+        data = message.attributes.get(ATTR_DATA)
+        if peer is None or data is None:
+            self.dropped.inc('malformed')
+            return
+        expires = allocation.permissions.get(peer[0])
+        if expires is None or expires < time.monotonic():
+            self.dropped.inc('no_permission')
+            return
+        allocation.send_to_peer(data, peer)
@@ -1,35 +1,604 @@
 # NetStream - Host & Client Video Chat Application
-from flask import Flask, render_template_string, request
-from flask_socketio import SocketIO
+from flask import Flask, Response, render_template_string, request
+from flask_socketio import SocketIO, join_room
 from gevent.pywsgi import WSGIServer
 from geventwebsocket.handler import WebSocketHandler
 from flask_cors import CORS
+from metrics import Counter, CountingJSON, Gauge, Histogram, Registry
+from netbus import LocalBroker, create_manager
+from liveness import TimingWheel
+from chatstore import ChatStore
+from transcripts import TranscriptStore
+import wirecodec
+import sfu
+import turn
+import iceservers
+import telemetry
+import abr
+import hubmonitor
+import profiler
+from ratelimit import SessionLimiter, TokenBucket
+from assets import ETAG_SUFFIXES, IMMUTABLE, AssetBundle, negotiate, precompress
+from restart import inherit_listener, read_snapshot, signal_ready, spawn_successor, write_snapshot
+from logpipeline import configure_logging, parse_sample_rates
+import gevent
+import functools
+import inspect
+import ipaddress
 import os
+import random
+import re
+import secrets
+import signal
+import tempfile
+import threading
+import hashlib
 import logging
 import time
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+configure_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)  # static/ holds built assets, served by static_asset
 app.config['SECRET_KEY'] = 'secret!'
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, async_mode='gevent', cors_allowed_origins="*", ping_timeout=30, ping_interval=5)
+
+metrics_registry = Registry()
+HANDLER_LATENCY = metrics_registry.register(Histogram(
+    'netstream_handler_latency_seconds', 'Time spent in Socket.IO event handlers', ['event']))
+EMITS = metrics_registry.register(Counter(
+    'netstream_emits_total', 'Socket.IO events emitted by the server', ['event']))
+EMIT_BYTES = metrics_registry.register(Counter(
+    'netstream_emit_bytes_total', 'Encoded payload bytes of Socket.IO events emitted', ['event']))
+HOST_PROMOTIONS = metrics_registry.register(Counter(
+    'netstream_host_promotions_total', 'Clients promoted to host after the host disconnected'))
+CONNECTION_FAILURES = metrics_registry.register(Counter(
+    'netstream_connection_failures_total', 'WebRTC connection failures reported by clients', ['reason']))
+KNOWN_FAILURE_REASONS = {'timeout', 'ice-failed', 'offer-error'}
+RESUMES = metrics_registry.register(Counter(
+    'netstream_session_resumes_total', 'Dropped participants that reclaimed their seat with a resume token', ['role']))
+LIVENESS_EVICTIONS = metrics_registry.register(Counter(
+    'netstream_liveness_evictions_total', 'Sessions evicted for not answering Engine.IO pings', ['role']))
+RATE_LIMITED = metrics_registry.register(Counter(
+    'netstream_rate_limited_total', 'Events and connections rejected by rate limits', ['event']))
+
+socketio = SocketIO(app, async_mode='gevent', cors_allowed_origins="*", ping_timeout=30, ping_interval=5,
+                    json=CountingJSON(EMITS, EMIT_BYTES))
 
 static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-os.makedirs(static_folder, exist_ok=True)
+vendor_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vendor')
 
-connected_users = []
-host_id = None
-user_roles = {} 
-connection_timestamps = {} 
+DEFAULT_ROOM = 'lobby'
+MAX_PARTICIPANTS = 6  # seats per room; every pair runs its own peer connection (full mesh)
+OFFER_STAGGER = 0.5  # seconds between new negotiations a participant is asked to take part in
+SFU_MAX_PARTICIPANTS = 16  # seats per room when media goes through the server (--sfu)
+ROOM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+CANDIDATE_FLUSH_WINDOW = 0.02  # seconds of trickled candidates coalesced into one emit
+CAPTION_FLUSH_INTERVAL = 0.15  # seconds of interim caption updates coalesced per speaker
+LIVENESS_CHECK_INTERVAL = 5  # seconds between liveness checks of a healthy session
+LIVENESS_TIMEOUT = 10  # seconds an Engine.IO ping may go unanswered before eviction
+CHAT_DIR = os.environ.get('NETSTREAM_CHAT_DIR') or os.path.join(tempfile.gettempdir(), 'netstream-chat')
+CHAT_HISTORY = 200  # messages kept in memory per active room
+CHAT_BACKFILL = 50  # messages replayed to a participant on connect
+CHAT_PAGE_LIMIT = 200  # largest page served by /chat-history
+# Token buckets per session: event -> (events per second, burst)
+EVENT_RATE_LIMITS = {
+    'chat-message': (2, 10),
+    'transcription': (5, 20),
+    'caption': (10, 20),
+    'candidate': (20, 60),
+    'offer': (1, 5),
+    'answer': (1, 5),
+    'ready-for-connection': (1, 5),
+    'request-offer': (1, 5),
+    'connection-failed': (0.2, 3),
+    'sfu-join': (1, 5),
+    'sfu-answer': (2, 10),
+    'call-stats': (0.5, 3),
+}
+RESUME_GRACE = 15  # seconds a dropped participant's seat is held for it to resume
+RESUME_CANDIDATES = 64  # candidates kept per side of a pair for replaying to a resumed participant
+ICE_UFRAG = re.compile(r'^a=ice-ufrag:(\S+)', re.MULTILINE)
+DRAIN_WINDOW = 10  # seconds over which clients are moved to a successor process, at least
+DRAIN_LINGER = 5  # seconds the old process stays up after the last reconnect was scheduled
+CONNECT_RATE_LIMIT = (50, 100)  # connections accepted per second across the process, burst
+RATE_LIMIT_DISCONNECT = 200  # consecutive rejections of one event before the session is dropped
+TRANSCRIPT_DIR = (os.environ.get('NETSTREAM_TRANSCRIPT_DIR') or
+                  os.path.join(tempfile.gettempdir(), 'netstream-transcripts'))
+# Bearer token for admin endpoints that change or inspect the live process; unset disables them
+ADMIN_TOKEN = os.environ.get('NETSTREAM_ADMIN_TOKEN')
+TURN_PORT = 3478  # UDP and TCP port of the built-in relay (--turn)
+TURN_CREDENTIAL_TTL = 24 * 3600  # seconds the relay credentials handed to a session stay valid
+STATS_INTERVAL = 5  # seconds between the getStats() samples a page takes of its calls
+STATS_WINDOW = 300  # seconds of samples /call-stats summarizes by default
+# Candidates for /ice-config, which hands each session the best few of them (see iceservers.py)
+ICE_SERVERS = [
+    {'urls': 'stun:stun.l.google.com:19302'},
+    {'urls': 'stun:stun1.l.google.com:19302'},
+    {'urls': 'stun:stun2.l.google.com:19302'},
+    {'urls': 'stun:stun3.l.google.com:19302'},
+    {'urls': 'stun:stun4.l.google.com:19302'},
+    {'urls': 'turn:openrelay.metered.ca:80', 'username': 'openrelayproject', 'credential': 'openrelayproject'},
+    {'urls': 'turn:openrelay.metered.ca:443', 'username': 'openrelayproject', 'credential': 'openrelayproject'},
+]
 
-HTML = '''
-<html>
-  <head>
-    <title>NetStream - Host & Client Video Chat</title>
-    <link href="https://fonts.googleapis.com/css2?family=Bebas+Neue&display=swap" rel="stylesheet">
-    <style>
+
+def pair_key(a, b):
+    """Key of the negotiation between two sids, the same whichever side asks"""
+    return (a, b) if a < b else (b, a)
+
+
+class Link:
+    """The latest negotiation between two participants, replayed to either side when it resumes"""
+    __slots__ = ('offerer', 'offer', 'answer', 'candidates', 'done')
+
+    def __init__(self):
+        self.offerer = None
+        self.offer = None
+        self.answer = None
+        self.candidates = {}  # sid -> candidates it trickled to the other side
+        self.done = set()  # sids that signalled end-of-candidates
+
+    def record_offer(self, offerer, offer):
+        # The offerer trickles candidates before its offer goes out; keep those of this ICE session
+        match = ICE_UFRAG.search(offer.get('sdp', '')) if isinstance(offer, dict) else None
+        previous = self.candidates.get(offerer, [])
+        kept = [c for c in previous
+                if match is None or not isinstance(c, dict) or c.get('usernameFragment') in (None, match.group(1))]
+        done = offerer in self.done and len(kept) == len(previous)
+        self.offerer = offerer
+        self.offer = offer
+        self.answer = None
+        self.candidates = {offerer: kept}
+        self.done = {offerer} if done else set()
+
+    def record_candidate(self, sender, candidate):
+        if candidate is None:
+            self.done.add(sender)
+        else:
+            sent = self.candidates.setdefault(sender, [])
+            if len(sent) < RESUME_CANDIDATES:
+                sent.append(candidate)
+
+    def replay_for(self, user_id, peer_id):
+        """The peer's side of the negotiation that `user_id` still needs, for re-priming it after a resume.
+
+        That is an offer still waiting for our answer, or the answer to our own offer,
+        with the peer's candidates. A finished negotiation offers nothing to a page that
+        lost its peer connection, so then only empty state is returned.
+        """
+        state = {'candidates': [], 'done': False}
+        if self.offer is not None and self.offerer == peer_id and self.answer is None:
+            state['offer'] = self.offer
+        elif self.offer is not None and self.offerer == user_id and self.answer is not None:
+            state['answer'] = self.answer
+        else:
+            return state
+        state['candidates'] = list(self.candidates.get(peer_id, ()))
+        state['done'] = peer_id in self.done
+        return state
+
+    def replace(self, old_id, new_id):
+        if self.offerer == old_id:
+            self.offerer = new_id
+        if old_id in self.candidates:
+            self.candidates[new_id] = self.candidates.pop(old_id)
+        if old_id in self.done:
+            self.done.discard(old_id)
+            self.done.add(new_id)
+
+    def to_state(self):
+        return {'offerer': self.offerer, 'offer': self.offer, 'answer': self.answer,
+                'candidates': self.candidates, 'done': sorted(self.done)}
+
+    @classmethod
+    def from_state(cls, state):
+        link = cls()
+        link.offerer, link.offer, link.answer = state['offerer'], state['offer'], state['answer']
+        link.candidates, link.done = state['candidates'], set(state['done'])
+        return link
+
+
+class Room:
+    """One call of up to MAX_PARTICIPANTS in a full mesh and the Socket.IO room they share.
+
+    Every pair of participants negotiates its own peer connection; the one seated
+    first offers. The first seat is the host.
+    """
+    __slots__ = ('room_id', 'channel', 'capacity', 'seats', 'created_at', 'links',
+                 'pending_candidates', 'described', 'candidates_done', 'flush_scheduled',
+                 'captions', 'caption_scheduled', 'away', 'next_negotiation')
+
+    def __init__(self, room_id, capacity=MAX_PARTICIPANTS):
+        self.room_id = room_id
+        # Prefixed so a room id can never collide with a sid's personal room
+        self.channel = f'room:{room_id}'
+        self.capacity = capacity
+        self.seats = []  # sids in the order they joined
+        self.created_at = time.time()
+        self.links = {}  # pair_key -> Link
+        # ICE candidates are held per (sender, recipient) until the recipient has been sent
+        # the sender's description
+        self.pending_candidates = {}
+        self.described = set()
+        self.candidates_done = set()
+        self.flush_scheduled = set()
+        # Interim captions per speaker: [text the peers last received, newer text waiting for a flush]
+        self.captions = {}
+        self.caption_scheduled = set()
+        # Seated sids whose socket dropped; their seats are held for a resume (see RESUME_GRACE)
+        self.away = set()
+        # sid -> monotonic time before which it is not introduced to another peer (see OFFER_STAGGER)
+        self.next_negotiation = {}
+
+    @property
+    def host_id(self):
+        return self.seats[0] if self.seats else None
+
+    @property
+    def members(self):
+        return list(self.seats)
+
+    def is_empty(self):
+        return not self.seats
+
+    def role_of(self, user_id):
+        if not self.seats:
+            return None
+        if user_id == self.seats[0]:
+            return 'host'
+        if user_id in self.seats:
+            return 'client'
+        return None
+
+    def peers_of(self, user_id):
+        """The other participants of the call"""
+        return [uid for uid in self.seats if uid != user_id]
+
+    def offerer_of(self, a, b):
+        """The side of a pair that sends the offer: the one seated first"""
+        return a if self.seats.index(a) < self.seats.index(b) else b
+
+    def link(self, a, b):
+        key = pair_key(a, b)
+        link = self.links.get(key)
+        if link is None:
+            link = self.links[key] = Link()
+        return link
+
+    def add(self, user_id):
+        """Seat a user and return its role, or None if the room is full"""
+        if len(self.seats) >= self.capacity:
+            return None
+        self.seats.append(user_id)
+        return self.role_of(user_id)
+
+    def stagger(self, a, b):
+        """Seconds to wait before a and b start negotiating, so neither starts more than one
+        new peer connection per OFFER_STAGGER"""
+        now = time.monotonic()
+        start = max(now, self.next_negotiation.get(a, now), self.next_negotiation.get(b, now))
+        self.next_negotiation[a] = self.next_negotiation[b] = start + OFFER_STAGGER
+        return start - now
+
+    def restart_link(self, sender, target):
+        """A new offer starts a new negotiation: anything still queued for the offerer came
+        from the peer's previous connection, and it now waits for a fresh answer"""
+        self.described.discard((target, sender))
+        self.pending_candidates.pop((target, sender), None)
+        self.candidates_done.discard((target, sender))
+
+    def _forget_signaling(self, user_id):
+        """Drop buffered candidates and description state of every pair that includes user_id"""
+        for key in [key for key in self.pending_candidates if user_id in key]:
+            del self.pending_candidates[key]
+        for pairs in (self.described, self.candidates_done):
+            pairs.difference_update([key for key in pairs if user_id in key])
+
+    def replace(self, old_id, new_id):
+        """Give a held seat to the new sid of a participant that resumed"""
+        self.seats[self.seats.index(old_id)] = new_id
+        self.away.discard(old_id)
+        self.captions.pop(old_id, None)
+        self._forget_signaling(old_id)
+        if old_id in self.next_negotiation:
+            self.next_negotiation[new_id] = self.next_negotiation.pop(old_id)
+        for key in [key for key in self.links if old_id in key]:
+            link = self.links.pop(key)
+            link.replace(old_id, new_id)
+            self.links[pair_key(*(new_id if uid == old_id else uid for uid in key))] = link
+
+    def remove(self, user_id):
+        """Unseat a user; returns the sid promoted to host if the host left"""
+        was_host = user_id == self.host_id
+        self.seats.remove(user_id)
+        self.captions.pop(user_id, None)
+        self.away.discard(user_id)
+        self.next_negotiation.pop(user_id, None)
+        self._forget_signaling(user_id)
+        for key in [key for key in self.links if user_id in key]:
+            del self.links[key]
+        return self.host_id if was_host else None
+
+
+class RoomRegistry:
+    """Maps room ids to rooms and sids to the room they joined"""
+
+    def __init__(self, capacity=MAX_PARTICIPANTS):
+        self.capacity = capacity
+        self.rooms = {}
+        self.sessions = {}
+
+    def room_of(self, user_id):
+        return self.sessions.get(user_id)
+
+    def join(self, user_id, room_id):
+        """Seat a user in a room, creating it on first use; returns (room, role)"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = Room(room_id, self.capacity)
+        role = room.add(user_id)
+        if role is not None:
+            self.sessions[user_id] = room
+        elif room.is_empty():
+            del self.rooms[room_id]
+        return room, role
+
+    def leave(self, user_id):
+        """Unseat a user; returns (room, promoted_host) or (None, None) if unknown"""
+        room = self.sessions.pop(user_id, None)
+        if room is None:
+            return None, None
+        new_host = room.remove(user_id)
+        if room.is_empty():
+            self.rooms.pop(room.room_id, None)
+        return room, new_host
+
+    def resume(self, old_id, new_id):
+        """Move a held seat from a dropped sid to its successor; returns the room"""
+        room = self.sessions.pop(old_id)
+        room.replace(old_id, new_id)
+        self.sessions[new_id] = room
+        return room
+
+
+registry = RoomRegistry()
+# Resume tokens, issued with role-assigned: token -> sid and sid -> token
+resume_tokens = {}
+session_tokens = {}
+timers = TimingWheel(slots=64, tick=1.0)
+chat_store = ChatStore(CHAT_DIR, history=CHAT_HISTORY)
+limiter = SessionLimiter(EVENT_RATE_LIMITS)
+connect_bucket = TokenBucket(*CONNECT_RATE_LIMIT)
+transcripts = TranscriptStore(TRANSCRIPT_DIR)
+metrics_registry.register(Gauge(
+    'netstream_active_sessions', 'Connected Socket.IO sessions seated in a room', lambda: len(registry.sessions)))
+metrics_registry.register(Gauge(
+    'netstream_active_rooms', 'Rooms with at least one participant', lambda: len(registry.rooms)))
+metrics_registry.register(Gauge(
+    'netstream_stats_calls', 'Calls with connection quality samples in memory',
+    lambda: len(stats_store) if stats_store is not None else 0))
+metrics_registry.register(Gauge(
+    'netstream_timers', 'Timers pending on the timing wheel', lambda: len(timers)))
+
+
+def check_liveness(user_id):
+    """Timer callback: evict a session whose Engine.IO ping has gone unanswered too long.
+
+    Engine.IO pings every client (ping_interval) but only notices a silent one on its next
+    send or after ping_interval + ping_timeout; a half-dead host would hold its room hostage
+    that long. Returns the delay until the next check, or None to stop watching.
+    """
+    room = registry.room_of(user_id)
+    eio_sid = socketio.server.manager.eio_sid_from_sid(user_id, '/')
+    eio_socket = socketio.server.eio.sockets.get(eio_sid) if eio_sid else None
+    if room is None or eio_socket is None or eio_socket.closed:
+        return None
+    if eio_socket.last_ping is None:
+        return LIVENESS_CHECK_INTERVAL  # the last ping was answered
+    waiting = time.time() - eio_socket.last_ping
+    if waiting < LIVENESS_TIMEOUT:
+        return LIVENESS_TIMEOUT - waiting
+    role = room.role_of(user_id)
+    logger.warning("Evicting %s %s: ping unanswered for %.1fs", role, user_id, waiting,
+                   extra={'event': 'liveness', 'sid': user_id})
+    LIVENESS_EVICTIONS.inc(role)
+    revoke_resume_token(user_id)  # a dead session frees its seat now instead of after RESUME_GRACE
+    socketio.server.disconnect(user_id)
+    return None
+
+
+def snapshot_state():
+    """Seats, resume tokens and cached negotiation of every room, for a successor process"""
+    rooms = []
+    for room in registry.rooms.values():
+        seats = [{'sid': sid, 'token': session_tokens[sid]} for sid in room.seats if sid in session_tokens]
+        if seats:
+            links = [dict(link.to_state(), pair=list(key)) for key, link in room.links.items()]
+            rooms.append({'room': room.room_id, 'seats': seats, 'links': links})
+    return {'version': 2, 'created': time.time(), 'rooms': rooms}
+
+
+def restore_state(state, grace):
+    """Seat a predecessor's sessions as away, each holding its seat for `grace` seconds to resume"""
+    for entry in state['rooms']:
+        for seat in entry['seats']:
+            room, _ = registry.join(seat['sid'], entry['room'])
+            room.away.add(seat['sid'])
+            session_tokens[seat['sid']] = seat['token']
+            resume_tokens[seat['token']] = seat['sid']
+            timers.schedule(('resume', seat['sid']), grace, release_seat)
+        for link in entry['links']:
+            if all(sid in room.seats for sid in link['pair']):
+                room.links[pair_key(*link['pair'])] = Link.from_state(link)
+    timers.start()
+    logger.info("Restored %d rooms from snapshot", len(state['rooms']))
+
+
+def drain_window():
+    """Seconds to spread reconnects over, so the successor's connect limit is never the bottleneck"""
+    return max(DRAIN_WINDOW, len(registry.sessions) / (0.8 * connect_bucket.rate))
+
+
+def drain_sessions(window):
+    """Ask every connected participant to reconnect, and so resume on the successor.
+
+    Both sides of a call get the same delay so a room moves as one; the delays of
+    different rooms are spread uniformly over the window.
+    """
+    for room in list(registry.rooms.values()):
+        delay = round(random.uniform(0, window), 3)
+        for user_id in room.members:
+            if user_id not in room.away:
+                socketio.emit('try-reconnect', {'resume': True, 'delay': delay}, to=user_id)
+
+
+restarting = False
+
+
+def graceful_restart(server, snapshot_path):
+    """Hand the listening socket and call state to a new process, then drain this one"""
+    global restarting
+    if restarting:
+        return
+    restarting = True
+    logger.info("Graceful restart: handing over to a new process")
+    server.stop_accepting()
+    window = drain_window()
+    state = snapshot_state()
+    state['grace'] = window + RESUME_GRACE
+    write_snapshot(snapshot_path, state)
+    if turn_server is not None:
+        turn_server.stop()  # the successor binds the relay port; relayed calls recover by restarting ICE
+    if spawn_successor(server.socket, snapshot_path) is None:
+        logger.error("Handover failed, this process keeps serving")
+        os.unlink(snapshot_path)
+        if turn_server is not None:
+            turn_server.start()
+        server.start_accepting()
+        restarting = False
+        return
+    logger.info("Draining %d sessions over %.1fs", len(registry.sessions), window)
+    drain_sessions(window)
+    gevent.sleep(window + DRAIN_LINGER)
+    server.stop(timeout=5)
+
+
+def attach_message_bus(url):
+    """Route emits through a cross-process message bus; call before serving starts"""
+    manager = create_manager(url)
+    manager.set_server(socketio.server)
+    socketio.server.manager = manager
+    logger.info('Using message bus %s', url)
+
+
+# Media router of --sfu mode (see sfu.py); None while calls are peer-to-peer
+sfu_router = None
+
+# Hub lag and blocking monitor of a serving process (see hubmonitor.py); None if turned off
+hub_monitor = None
+
+
+def start_hub_monitor(threshold):
+    """Watch this process's hub, counting greenlets that run `threshold` seconds without yielding; 0 turns it off"""
+    global hub_monitor
+    if threshold <= 0:
+        return
+    hub_monitor = hubmonitor.HubMonitor(threshold)
+    for metric in hub_monitor.metrics:
+        metrics_registry.register(metric)
+    hub_monitor.start()
+
+
+# Built-in relay of --turn (see turn.py), in the process that runs it
+turn_server = None
+ice_directory = iceservers.IceDirectory(ICE_SERVERS)
+
+# Connection quality samples reported by pages, per room (see telemetry.py); None without numpy
+stats_store = telemetry.StatsStore() if telemetry.available() else None
+# Encoding rung of every sender, decided from the same samples (see abr.py)
+abr_controller = abr.BitrateController()
+for metric in abr_controller.metrics:
+    metrics_registry.register(metric)
+
+# Sids that negotiated the binary envelope for large payloads (see wirecodec.py)
+wire_codecs = set()
+
+
+def for_wire(event, user_id, data):
+    """Wrap data in the binary envelope if user_id negotiated it and the payload is large"""
+    if user_id not in wire_codecs:
+        return data
+    encoded = wirecodec.encode(data)
+    if encoded is not data:
+        EMIT_BYTES.inc(event, amount=len(encoded))  # attachments bypass the counting JSON encoder
+    return encoded
+
+
+def reject_event(event, user_id, bucket):
+    """Drop a rate-limited event, telling the client once per run of rejections"""
+    RATE_LIMITED.inc(event)
+    if bucket.rejected == 1:
+        socketio.emit('rate-limited', {'event': event, 'retryAfter': round(bucket.retry_after(), 3)}, to=user_id)
+    elif bucket.rejected == RATE_LIMIT_DISCONNECT:
+        logger.warning("Disconnecting %s: kept sending %s past its rate limit", user_id, event,
+                       extra={'event': event, 'sid': user_id})
+        socketio.emit('error', {'message': 'Rate limit exceeded'}, to=user_id)
+        revoke_resume_token(user_id)
+        socketio.server.disconnect(user_id)
+
+
+# Server loop the handlers run on: 'gevent', or 'asyncio' when served by asgiapp.py
+server_loop = 'gevent'
+
+
+def call_later(seconds, func, *args):
+    """Run func(*args) on the server loop after `seconds`; asgiapp.py swaps in an asyncio version"""
+    gevent.spawn_later(seconds, func, *args)
+
+
+# Code objects of the Socket.IO handlers -> their names, which /debug/profile roots its stacks at
+signaling_handlers = {}
+# Event -> wrapped handler, for serving the same events from another server (asgiapp.py)
+signaling_events = {}
+
+
+def signaling_event(event):
+    """Register a Socket.IO handler and record its run time in HANDLER_LATENCY"""
+    def decorator(func):
+        signaling_handlers[func.__code__] = func.__name__
+        # Socket.IO passes optional extras (auth on connect, reason on disconnect) positionally
+        arity = len(inspect.signature(func).parameters)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            start = time.perf_counter()
+            if hub_monitor is not None:
+                hub_monitor.enter(event)
+            try:
+                bucket = limiter.bucket(request.sid, event)
+                if bucket is not None and not bucket.take():
+                    reject_event(event, request.sid, bucket)
+                    return None
+                if any(isinstance(arg, bytes) for arg in args):
+                    try:
+                        args = tuple(wirecodec.decode(arg) if isinstance(arg, bytes) else arg for arg in args)
+                    except Exception as e:
+                        logger.warning("Dropping undecodable %s from %s: %s", event, request.sid, e,
+                                       extra={'event': event, 'sid': request.sid})
+                        return None
+                return func(*args[:arity])
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - start, event)
+                if hub_monitor is not None:
+                    hub_monitor.leave()
+        signaling_events[event] = wrapper
+        return socketio.on(event)(wrapper)
+    return decorator
+
+
+# The page's stylesheet and script, served as content-hashed static assets (see assets.py)
+PAGE_STYLE = '''
       * {
         margin: 0;
         padding: 0;
@@ -37,7 +606,7 @@ HTML = '''
       }
       body {
         background-color: #141414;
-        font-family: 'Bebas Neue', sans-serif;
+        font-family: 'Bebas Neue', Impact, 'Arial Narrow Bold', sans-serif;  /* system fonts: nothing to fetch */
         min-height: 100vh;
         display: flex;
         flex-direction: column;
@@ -60,7 +629,7 @@ HTML = '''
       }
       .video-container {
         display: grid;
-        grid-template-columns: repeat(2, 1fr);
+        grid-template-columns: repeat(auto-fit, minmax(320px, 1fr));
         gap: 20px;
         margin-bottom: 20px;
       }
@@ -232,7 +801,15 @@ HTML = '''
         margin-top: 10px;
         display: block;
       }
-    </style>
+'''
+
+HTML = '''
+<html>
+  <head>
+    <title>NetStream - Host & Client Video Chat</title>
+    <link rel="preload" href="{{ assets.url('socket.io.min.js') }}" as="script">
+    <link rel="preload" href="{{ assets.url('app.js') }}" as="script">
+    <link rel="stylesheet" href="{{ assets.url('app.css') }}">
   </head>
   <body>
     <div class="container">
@@ -272,10 +849,28 @@ HTML = '''
       <div id="status"></div>
     </div>
 
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
-    <script>
+    <script src="{{ assets.url('socket.io.min.js') }}"></script>
+    <script src="{{ assets.url('app.js') }}"></script>
+  </body>
+</html>
+'''
+
+PAGE_SCRIPT = '''
       // Improved socket connection with automatic reconnect
+      // Calls are keyed by the room id in the URL (/room/<id>); the bare URL joins the lobby
+      const pathParts = window.location.pathname.split('/');
+      const roomId = pathParts[1] === 'room' && pathParts[2] ? pathParts[2] : 'lobby';
+      // Large signaling payloads travel as deflated msgpack when both ends support it (see wirecodec.py)
+      const WIRE_FORMAT_MSGPACK_DEFLATE = 1;
+      const WIRE_COMPRESS_THRESHOLD = 512;
+      const wireCodecSupported = 'CompressionStream' in window && 'DecompressionStream' in window;
+      let wireCodec = false;
+      // A resume token lets a reconnect (or a reload of this tab) reclaim our seat and role
+      const resumeKey = `netstream-resume-${roomId}`;
+      const socketQuery = wireCodecSupported ? { room: roomId, codec: 'msgpack' } : { room: roomId };
+      if (sessionStorage.getItem(resumeKey)) socketQuery.resume = sessionStorage.getItem(resumeKey);
       const socket = io(window.location.origin, { 
+        query: socketQuery,
         transports: ['websocket'], 
         upgrade: false,
         reconnection: true,
@@ -286,27 +881,190 @@ HTML = '''
       
       let localStream;
       let screenStream;
-      let peerConnection = null;
+      // One peer connection per remote participant (full mesh), by their sid
+      const peers = {};
+      // SFU mode (server started with --sfu): a single peer connection to the server instead
+      let sfuMode = false;
+      let sfuConnection = null;
+      let sfuJoinSent = false;
+      let sfuPublished = false;
+      let sfuLowLayer = null;
+      let sfuLayout = {};  // mid -> sid of the publisher the server forwards on it
+      const sfuTiles = {};  // publisher sid -> video tile
       let isHost = false;
-      let isConnected = false;
-      let connectionAttempts = 0;
       let maxConnectionAttempts = 5;
       let isReconnecting = false;
+
+      const textEncoder = new TextEncoder();
+      const textDecoder = new TextDecoder();
+
+      function msgpackEncode(value) {
+        const bytes = [];
+        const scratch = new DataView(new ArrayBuffer(8));
+        const pushScratch = (n) => { for (let i = 0; i < n; i++) bytes.push(scratch.getUint8(i)); };
+        const header = (length, fixBase, fixLimit, code8, code16, code32) => {
+          if (fixBase !== null && length < fixLimit) {
+            bytes.push(fixBase | length);
+          } else if (code8 !== null && length < 0x100) {
+            bytes.push(code8, length);
+          } else if (length < 0x10000) {
+            bytes.push(code16);
+            scratch.setUint16(0, length);
+            pushScratch(2);
+          } else {
+            bytes.push(code32);
+            scratch.setUint32(0, length);
+            pushScratch(4);
+          }
+        };
+        const write = (v) => {
+          if (v === null || v === undefined) {
+            bytes.push(0xc0);
+          } else if (typeof v === 'boolean') {
+            bytes.push(v ? 0xc3 : 0xc2);
+          } else if (typeof v === 'number') {
+            if (Number.isInteger(v) && v >= 0 && v < 0x80) {
+              bytes.push(v);
+            } else if (Number.isInteger(v) && v < 0 && v >= -32) {
+              bytes.push(v & 0xff);
+            } else if (Number.isInteger(v) && v >= 0 && v <= 0xffffffff) {
+              bytes.push(0xce);
+              scratch.setUint32(0, v);
+              pushScratch(4);
+            } else if (Number.isInteger(v) && v < 0 && v >= -0x80000000) {
+              bytes.push(0xd2);
+              scratch.setInt32(0, v);
+              pushScratch(4);
+            } else {
+              bytes.push(0xcb);
+              scratch.setFloat64(0, v);
+              pushScratch(8);
+            }
+          } else if (typeof v === 'string') {
+            const encoded = textEncoder.encode(v);
+            header(encoded.length, 0xa0, 32, 0xd9, 0xda, 0xdb);
+            for (const b of encoded) bytes.push(b);
+          } else if (v instanceof Uint8Array) {
+            header(v.length, null, 0, 0xc4, 0xc5, 0xc6);
+            for (const b of v) bytes.push(b);
+          } else if (Array.isArray(v)) {
+            header(v.length, 0x90, 16, null, 0xdc, 0xdd);
+            v.forEach(write);
+          } else if (typeof v.toJSON === 'function') {
+            write(v.toJSON());  // RTCSessionDescription, RTCIceCandidate
+          } else {
+            const entries = Object.entries(v).filter(([, item]) => item !== undefined && typeof item !== 'function');
+            header(entries.length, 0x80, 16, null, 0xde, 0xdf);
+            entries.forEach(([key, item]) => { write(key); write(item); });
+          }
+        };
+        write(value);
+        return Uint8Array.from(bytes);
+      }
+
+      function msgpackDecode(buffer) {
+        const view = new DataView(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+        let pos = 0;
+        const take = (n) => { pos += n; return pos - n; };
+        const str = (n) => textDecoder.decode(buffer.subarray(take(n), pos));
+        const bin = (n) => buffer.slice(take(n), pos);
+        const arr = (n) => Array.from({ length: n }, () => read());
+        const map = (n) => {
+          const out = {};
+          for (let i = 0; i < n; i++) {
+            const key = read();
+            out[key] = read();
+          }
+          return out;
+        };
+        const read = () => {
+          const t = view.getUint8(take(1));
+          if (t < 0x80) return t;
+          if (t < 0x90) return map(t & 0x0f);
+          if (t < 0xa0) return arr(t & 0x0f);
+          if (t < 0xc0) return str(t & 0x1f);
+          if (t >= 0xe0) return t - 0x100;
+          switch (t) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(view.getUint8(take(1)));
+            case 0xc5: return bin(view.getUint16(take(2)));
+            case 0xc6: return bin(view.getUint32(take(4)));
+            case 0xca: return view.getFloat32(take(4));
+            case 0xcb: return view.getFloat64(take(8));
+            case 0xcc: return view.getUint8(take(1));
+            case 0xcd: return view.getUint16(take(2));
+            case 0xce: return view.getUint32(take(4));
+            case 0xcf: return Number(view.getBigUint64(take(8)));
+            case 0xd0: return view.getInt8(take(1));
+            case 0xd1: return view.getInt16(take(2));
+            case 0xd2: return view.getInt32(take(4));
+            case 0xd3: return Number(view.getBigInt64(take(8)));
+            case 0xd9: return str(view.getUint8(take(1)));
+            case 0xda: return str(view.getUint16(take(2)));
+            case 0xdb: return str(view.getUint32(take(4)));
+            case 0xdc: return arr(view.getUint16(take(2)));
+            case 0xdd: return arr(view.getUint32(take(4)));
+            case 0xde: return map(view.getUint16(take(2)));
+            case 0xdf: return map(view.getUint32(take(4)));
+          }
+          throw new Error('Unsupported msgpack type ' + t);
+        };
+        return read();
+      }
+
+      async function pipeBytes(bytes, transform) {
+        const stream = new Blob([bytes]).stream().pipeThrough(transform);
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+      }
+
+      // Binary attachments arrive as ArrayBuffers; anything else is a plain JSON payload
+      async function decodeWire(data) {
+        if (!(data instanceof ArrayBuffer)) return data;
+        const bytes = new Uint8Array(data);
+        if (bytes[0] !== WIRE_FORMAT_MSGPACK_DEFLATE) throw new Error('Unknown wire format ' + bytes[0]);
+        return msgpackDecode(await pipeBytes(bytes.subarray(1), new DecompressionStream('deflate')));
+      }
+
+      // Wire-encoded signaling is handled in arrival order. A compressed offer takes several
+      // ticks to decode and a small candidates batch one microtask, so without the queue the
+      // candidates would reach a peer the offer has not created yet
+      let inboundQueue = Promise.resolve();
+      function onSignal(event, handler) {
+        socket.on(event, (data) => {
+          inboundQueue = inboundQueue
+            .then(() => decodeWire(data))
+            .then(decoded => { handler(decoded); })
+            .catch(e => console.error(`Error receiving ${event}:`, e));
+        });
+      }
+
+      async function encodeWire(data) {
+        if (!wireCodec) return data;
+        const packed = msgpackEncode(data);
+        if (packed.length < WIRE_COMPRESS_THRESHOLD) return data;
+        const compressed = await pipeBytes(packed, new CompressionStream('deflate'));
+        const envelope = new Uint8Array(compressed.length + 1);
+        envelope[0] = WIRE_FORMAT_MSGPACK_DEFLATE;
+        envelope.set(compressed, 1);
+        return envelope;
+      }
+
+      // Signaling emits leave in order even while an earlier one is still being compressed
+      let signalQueue = Promise.resolve();
+      function emitSignal(event, data) {
+        signalQueue = signalQueue
+          .then(() => encodeWire(data))
+          .then(payload => socket.emit(event, payload))
+          .catch(e => console.error(`Error sending ${event}:`, e));
+      }
       
-      // Enhanced ICE server configuration with additional STUN/TURN servers
+      // ICE servers come from /ice-config, a short list the server ranks by probing (see iceservers.py);
+      // these stand in until it answers, or if it cannot be reached
       const configuration = {
         iceServers: [
           { urls: 'stun:stun.l.google.com:19302' },
-          { urls: 'stun:stun1.l.google.com:19302' },
-          { urls: 'stun:stun2.l.google.com:19302' },
-          { urls: 'stun:stun3.l.google.com:19302' },
-          { urls: 'stun:stun4.l.google.com:19302' },
-          // Free TURN servers (add your own TURN server for production)
-          { 
-            urls: 'turn:openrelay.metered.ca:80',
-            username: 'openrelayproject',
-            credential: 'openrelayproject'
-          },
           {
             urls: 'turn:openrelay.metered.ca:443',
             username: 'openrelayproject',
@@ -320,16 +1078,14 @@ HTML = '''
         bundlePolicy: 'max-bundle'
       };
 
-      // Connection timeout handler
-      let connectionTimeoutId;
-      
-      function setupConnectionTimeout() {
-        clearTimeout(connectionTimeoutId);
-        connectionTimeoutId = setTimeout(() => {
-          if (!isConnected && peerConnection) {
-            console.warn('Connection timeout - attempting reconnect');
-            resetConnection();
-            socket.emit('connection-failed', { reason: 'timeout' });
+      // Connection timeout handler, per peer
+      function setupConnectionTimeout(peer) {
+        clearTimeout(peer.timeout);
+        peer.timeout = setTimeout(() => {
+          if (!peer.connected && peer.pc && peers[peer.id] === peer) {
+            console.warn(`Connection to ${peer.id} timed out - attempting reconnect`);
+            resetConnection(peer.id);
+            socket.emit('connection-failed', { reason: 'timeout', target: peer.id });
             showConnectionStatus('Connection timeout. Trying again...', true);
           }
         }, 30000); // 30 second timeout
@@ -348,6 +1104,14 @@ HTML = '''
         }
       }
 
+      // Fetched while the camera and microphone are being opened rather than after
+      const iceConfigReady = fetch('/ice-config')
+        .then(response => response.json())
+        .then(config => {
+          if (config.iceServers.length) configuration.iceServers = config.iceServers;
+        })
+        .catch(e => console.warn('Using the fallback ICE servers:', e));
+
       async function init() {
         try {
           // Request with constraints for better initial quality
@@ -366,6 +1130,8 @@ HTML = '''
           
           document.getElementById('localVideo').srcObject = localStream;
           showConnectionStatus('Camera and microphone initialized');
+          await iceConfigReady;
+          joinSfu();
           
           // Signal to server we're ready
           setTimeout(() => {
@@ -377,12 +1143,54 @@ HTML = '''
         }
       }
 
+      // A video tile for one remote participant; the waiting placeholder hides while there are any
+      function createPeerTile() {
+        const box = document.createElement('div');
+        box.className = 'video-box';
+        const video = document.createElement('video');
+        video.className = 'video-feed';
+        video.autoplay = true;
+        video.playsInline = true;
+        const label = document.createElement('div');
+        label.className = 'video-label';
+        label.textContent = 'Remote User';
+        const status = document.createElement('div');
+        status.className = 'connection-status';
+        status.textContent = 'Connecting...';
+        status.style.display = 'block';
+        box.append(video, label, status);
+        document.querySelector('.video-container').appendChild(box);
+        document.getElementById('remoteVideoBox').style.display = 'none';
+        return { box, video, status };
+      }
+
+      function peerEntry(peerId) {
+        if (!peers[peerId]) {
+          peers[peerId] = {
+            id: peerId,
+            pc: null,
+            offerer: false,
+            connected: false,
+            attempts: 0,
+            timeout: null,
+            // Candidates that arrive before the remote description is applied wait here
+            pending: [],
+            complete: false,
+            tile: createPeerTile()
+          };
+        }
+        return peers[peerId];
+      }
+
+      function connectedPeers() {
+        return Object.values(peers).filter(peer => peer.connected).length;
+      }
+
       // Improved WebRTC connection handling for proper video feed display
-      async function initiateOffer() {
-        if (!isHost) return;
-        
-        const pc = createPeerConnection();
+      async function initiateOffer(peerId) {
+        const pc = createPeerConnection(peerId, true);
         if (!pc) return;
+        const peer = peers[peerId];
         
         try {
           showConnectionStatus('Creating connection offer...');
@@ -400,44 +1208,49 @@ HTML = '''
           const offer = await pc.createOffer({
             offerToReceiveAudio: true,
             offerToReceiveVideo: true,
-            iceRestart: connectionAttempts > 1
+            iceRestart: peer.attempts > 1
           });
           
           await pc.setLocalDescription(offer);
           
           // Wait a bit for initial ICE candidates before sending offer
           await new Promise(resolve => setTimeout(resolve, 1000));
+          if (peer.pc !== pc) return;  // superseded while we waited
           
-          socket.emit('offer', { offer: pc.localDescription });
-          console.log('Offer sent to client');
+          emitSignal('offer', { target: peer.id, offer: pc.localDescription });
+          console.log('Offer sent to', peer.id);
         } catch (e) {
           console.error('Error creating offer:', e);
           showConnectionStatus('Failed to create offer. Retrying...', true);
           
-          if (connectionAttempts < maxConnectionAttempts) {
-            setTimeout(initiateOffer, 2000);
+          if (peer.attempts < maxConnectionAttempts) {
+            setTimeout(() => {
+              if (peers[peer.id] === peer) initiateOffer(peer.id);
+            }, 2000);
           }
         }
       }
       
       // Fix for createPeerConnection to ensure tracks are properly handled
-      function createPeerConnection() {
+      function createPeerConnection(peerId, offerer) {
         try {
-          if (peerConnection) {
-            resetConnection();
+          const peer = peerEntry(peerId);
+          if (peer.pc) {
+            resetConnection(peerId);
           }
           
-          connectionAttempts++;
-          console.log(`Creating peer connection (attempt ${connectionAttempts}/${maxConnectionAttempts})`);
+          peer.offerer = offerer;
+          peer.attempts++;
+          console.log(`Creating peer connection to ${peerId} (attempt ${peer.attempts}/${maxConnectionAttempts})`);
           
-          peerConnection = new RTCPeerConnection(configuration);
+          const pc = peer.pc = new RTCPeerConnection(configuration);
+          const remoteVideo = peer.tile.video;
           
           // Local tracks will be added either here or in initiateOffer
           
           // Fix: Be more explicit about how remote tracks are added
-          peerConnection.ontrack = event => {
+          pc.ontrack = event => {
             console.log('Remote track received:', event.track.kind);
-            const remoteVideo = document.getElementById('remoteVideo');
             
             // Use the first stream from the first track
             if (event.streams && event.streams[0]) {
@@ -461,7 +1274,7 @@ HTML = '''
             }
             
             // Hide the connection status overlay
-            document.getElementById('remoteConnectionStatus').style.display = 'none';
+            peer.tile.status.style.display = 'none';
             
             // Make sure video autoplay works even if browser blocks it
             remoteVideo.play().catch(e => {
@@ -478,52 +1291,54 @@ HTML = '''
                 remoteVideo.play();
                 playButton.remove();
               };
-              document.getElementById('remoteVideoBox').appendChild(playButton);
+              peer.tile.box.appendChild(playButton);
             });
           };
 
           // Handle ICE candidates
-          peerConnection.onicecandidate = event => {
+          pc.onicecandidate = event => {
             if (event.candidate) {
               console.log('Sending ICE candidate:', event.candidate.candidate.substr(0, 50) + '...');
-              socket.emit('candidate', { candidate: event.candidate });
+              emitSignal('candidate', { target: peer.id, candidate: event.candidate });
             } else {
               console.log('All ICE candidates gathered');
+              emitSignal('candidate', { target: peer.id, candidate: null });
             }
           };
           
           // Additional ICE gathering state tracking
-          peerConnection.onicegatheringstatechange = () => {
-            console.log('ICE gathering state:', peerConnection.iceGatheringState);
+          pc.onicegatheringstatechange = () => {
+            console.log('ICE gathering state:', pc.iceGatheringState);
           };
           
           // Connection state monitoring with more detailed logging
-          peerConnection.oniceconnectionstatechange = () => {
-            console.log('ICE Connection State:', peerConnection.iceConnectionState);
+          pc.oniceconnectionstatechange = () => {
+            console.log(`ICE Connection State (${peer.id}):`, pc.iceConnectionState);
             
             document.getElementById('status').textContent = 
-              `Connection state: ${peerConnection.iceConnectionState}`;
+              `Connection state: ${pc.iceConnectionState}`;
               
-            switch(peerConnection.iceConnectionState) {
+            switch(pc.iceConnectionState) {
               case 'checking':
                 showConnectionStatus('Establishing connection...');
                 break;
               case 'connected':
               case 'completed':
-                isConnected = true;
-                clearTimeout(connectionTimeoutId);
-                showConnectionStatus(isHost ? 'Connected to client' : 'Connected to host');
-                document.getElementById('remoteConnectionStatus').style.display = 'none';
-                connectionAttempts = 0;
+                peer.connected = true;
+                clearTimeout(peer.timeout);
+                applyEncodingParams(pc.getSenders().filter(s => s.track && s.track.kind === 'video'));
+                showConnectionStatus(`Connected to ${connectedPeers()} of ${Object.keys(peers).length} participants`);
+                peer.tile.status.style.display = 'none';
+                peer.attempts = 0;
                 break;
               case 'failed':
-                if (connectionAttempts < maxConnectionAttempts) {
+                if (peer.attempts < maxConnectionAttempts) {
                   console.warn('Connection failed, retrying...');
-                  resetConnection();
-                  if (isHost) {
-                    initiateOffer();
+                  resetConnection(peer.id);
+                  if (peer.offerer) {
+                    initiateOffer(peer.id);
                   } else {
-                    socket.emit('connection-failed', { reason: 'ice-failed' });
+                    socket.emit('connection-failed', { reason: 'ice-failed', target: peer.id });
                   }
                 } else {
                   showConnectionStatus('Connection failed after multiple attempts. Try reloading the page.', true);
@@ -533,10 +1348,10 @@ HTML = '''
                 showConnectionStatus('Connection interrupted. Trying to reconnect...', true);
                 // Try to recover automatically
                 setTimeout(() => {
-                  if (peerConnection.iceConnectionState === 'disconnected') {
-                    resetConnection();
-                    if (isHost) {
-                      initiateOffer();
+                  if (peer.pc === pc && pc.iceConnectionState === 'disconnected') {
+                    resetConnection(peer.id);
+                    if (peer.offerer) {
+                      initiateOffer(peer.id);
                     }
                   }
                 }, 2000);
@@ -545,20 +1360,19 @@ HTML = '''
           };
           
           // Also monitor signaling state
-          peerConnection.onsignalingstatechange = () => {
-            console.log('Signaling State:', peerConnection.signalingState);
+          pc.onsignalingstatechange = () => {
+            console.log('Signaling State:', pc.signalingState);
           };
           
           // Set up audio output (to avoid echo)
-          const remoteVideo = document.getElementById('remoteVideo');
           if (typeof remoteVideo.setSinkId === 'function') {
             remoteVideo.setSinkId('default')
               .then(() => console.log('Audio output set to default speaker'))
               .catch(e => console.error('Error setting audio output:', e));
           }
           
-          setupConnectionTimeout();
-          return peerConnection;
+          setupConnectionTimeout(peer);
+          return pc;
           
         } catch (e) {
           console.error('Error creating peer connection:', e);
@@ -567,95 +1381,381 @@ HTML = '''
         }
       }
       
-      function resetConnection() {
-        isConnected = false;
-        if (peerConnection) {
-          peerConnection.onicecandidate = null;
-          peerConnection.ontrack = null;
-          peerConnection.oniceconnectionstatechange = null;
-          peerConnection.close();
-          peerConnection = null;
+      function resetConnection(peerId) {
+        const peer = peers[peerId];
+        if (!peer) return;
+        peer.connected = false;
+        peer.pending = [];
+        peer.complete = false;
+        clearTimeout(peer.timeout);
+        if (peer.pc) {
+          peer.pc.onicecandidate = null;
+          peer.pc.ontrack = null;
+          peer.pc.oniceconnectionstatechange = null;
+          peer.pc.close();
+          peer.pc = null;
+        }
+        peer.tile.video.srcObject = null;
+        peer.tile.status.style.display = 'block';
+        peer.tile.status.textContent = 'Reconnecting...';
+      }
+
+      function removePeer(peerId) {
+        const peer = peers[peerId];
+        if (!peer) return;
+        resetConnection(peerId);
+        peer.tile.box.remove();
+        delete peers[peerId];
+        if (Object.keys(peers).length === 0) {
+          document.getElementById('remoteVideoBox').style.display = '';
+        }
+      }
+
+      // Start the link to one peer over: the side that offers re-offers, the other asks it to
+      function renegotiate(peerId) {
+        const peer = peers[peerId];
+        if (!peer) return;
+        resetConnection(peerId);
+        if (peer.offerer) {
+          initiateOffer(peerId);
+        } else {
+          socket.emit('request-offer', { target: peerId });
         }
-        document.getElementById('remoteVideo').srcObject = null;
-        document.getElementById('remoteConnectionStatus').style.display = 'block';
-        document.getElementById('remoteConnectionStatus').textContent = 'Reconnecting...';
       }
       
-      // Fix for handling offer responses in the client
-      socket.on('offer', async (data) => {
-        if (!isHost) {
-          showConnectionStatus('Received connection offer from host...');
-          const pc = createPeerConnection();
-          if (!pc) return;
-          
+      function joinSfu() {
+        if (sfuMode && localStream && !sfuConnection && !sfuJoinSent) {
+          sfuJoinSent = true;
+          socket.emit('sfu-join');
+        }
+      }
+
+      function closeSfu() {
+        if (sfuConnection) {
+          sfuConnection.close();
+          sfuConnection = null;
+        }
+        if (sfuLowLayer) {
+          sfuLowLayer.stop();
+          sfuLowLayer = null;
+        }
+        sfuJoinSent = false;
+        sfuPublished = false;
+        sfuLayout = {};
+        applySfuLayout();
+      }
+
+      // The server does not take trickled candidates, so answers go out with all of ours
+      function iceGatheringComplete(pc, timeout = 2000) {
+        if (pc.iceGatheringState === 'complete') return Promise.resolve();
+        return new Promise(resolve => {
+          const check = () => {
+            if (pc.iceGatheringState === 'complete') {
+              pc.removeEventListener('icegatheringstatechange', check);
+              resolve();
+            }
+          };
+          pc.addEventListener('icegatheringstatechange', check);
+          setTimeout(resolve, timeout);
+        });
+      }
+
+      // The server always offers. Its first three transceivers take what we publish: the
+      // microphone, the camera, and a low-resolution copy it can forward to subscribers
+      // short on bandwidth. Every other transceiver carries someone else's media.
+      onSignal('sfu-offer', async (data) => {
+        try {
+          if (!sfuConnection) {
+            sfuConnection = new RTCPeerConnection(configuration);
+            sfuConnection.ontrack = () => applySfuLayout();
+            sfuConnection.oniceconnectionstatechange = () => {
+              const state = sfuConnection && sfuConnection.iceConnectionState;
+              console.log('SFU ICE Connection State:', state);
+              if (state === 'failed') {
+                // The server has dropped this connection; start over with a fresh one
+                showConnectionStatus('Media connection to the server failed, reconnecting...', true);
+                closeSfu();
+                joinSfu();
+              }
+            };
+          }
+          const pc = sfuConnection;
+          sfuLayout = data.layout;
+          await pc.setRemoteDescription({ type: 'offer', sdp: data.sdp });
+          if (!sfuPublished) {
+            const [audio, high, low] = pc.getTransceivers();
+            const camera = localStream.getVideoTracks()[0];
+            sfuLowLayer = camera.clone();
+            sfuLowLayer.applyConstraints({ width: 320, height: 180, frameRate: 15 })
+              .catch(e => console.warn('Could not scale down the low layer:', e));
+            const published = [[audio, localStream.getAudioTracks()[0]], [high, camera], [low, sfuLowLayer]];
+            for (const [transceiver, track] of published) {
+              transceiver.direction = 'sendonly';
+              await transceiver.sender.replaceTrack(track);
+            }
+            sfuPublished = true;
+          }
+          await pc.setLocalDescription(await pc.createAnswer());
+          await iceGatheringComplete(pc);
+          emitSignal('sfu-answer', { sdp: pc.localDescription.sdp });
+          applySfuLayout();
+          showConnectionStatus('Connected to the media server');
+        } catch (e) {
+          console.error('Error handling SFU offer:', e);
+          showConnectionStatus('Failed to connect to the media server', true);
+        }
+      });
+
+      socket.on('sfu-layout', (data) => {
+        sfuLayout = data.layout;
+        applySfuLayout();
+      });
+
+      // One tile per publisher, showing the tracks the server forwards from it
+      function applySfuLayout() {
+        const byPublisher = {};
+        const transceivers = sfuConnection ? sfuConnection.getTransceivers() : [];
+        for (const transceiver of transceivers) {
+          const publisher = sfuLayout[transceiver.mid];
+          if (publisher && transceiver.receiver.track) {
+            (byPublisher[publisher] = byPublisher[publisher] || []).push(transceiver.receiver.track);
+          }
+        }
+        for (const publisher of Object.keys(sfuTiles)) {
+          if (!byPublisher[publisher]) {
+            sfuTiles[publisher].box.remove();
+            delete sfuTiles[publisher];
+          }
+        }
+        for (const [publisher, tracks] of Object.entries(byPublisher)) {
+          const tile = sfuTiles[publisher] || (sfuTiles[publisher] = createPeerTile());
+          const shown = tile.video.srcObject ? tile.video.srcObject.getTracks() : [];
+          if (shown.length !== tracks.length || tracks.some(track => !shown.includes(track))) {
+            tile.video.srcObject = new MediaStream(tracks);
+            tile.video.play().catch(e => console.warn('Remote video autoplay was prevented:', e));
+          }
+          tile.status.style.display = 'none';
+        }
+        if (Object.keys(sfuTiles).length === 0 && Object.keys(peers).length === 0) {
+          document.getElementById('remoteVideoBox').style.display = '';
+        }
+      }
+
+      // Senders carrying our camera: one per mesh peer, or the high layer towards the SFU
+      function videoSenders() {
+        const senders = Object.values(peers).map(peer =>
+          peer.pc && peer.pc.getSenders().find(s => s.track && s.track.kind === 'video'));
+        if (sfuConnection && sfuPublished) senders.push(sfuConnection.getTransceivers()[1].sender);
+        return senders.filter(Boolean);
+      }
+
+      // Connection quality telemetry (see telemetry.py): every statsInterval seconds, one sample
+      // per peer connection from getStats(), sent in batches of a few intervals - right away when
+      // an encoder is held back, since the server's bitrate control (see abr.py) acts on them
+      const STATS_BATCH_INTERVALS = 3;
+      let statsTimer = null;
+      let statsBatch = [];
+      let statsTicks = 0;
+      const previousStats = new WeakMap();  // peer connection -> counters of its last sample
+
+      function startStatsSampling(interval) {
+        clearInterval(statsTimer);
+        statsTimer = interval > 0 ? setInterval(sampleStats, interval * 1000) : null;
+      }
+
+      async function sampleStats() {
+        const connections = Object.values(peers).filter(peer => peer.connected && peer.pc).map(peer => peer.pc);
+        if (sfuConnection) connections.push(sfuConnection);
+        let urgent = false;
+        for (const pc of connections) {
           try {
-            // Add all local tracks before processing the offer
-            localStream.getTracks().forEach(track => {
-              pc.addTrack(track, localStream);
-            });
-            
-            const offerDesc = new RTCSessionDescription(data.offer);
-            await pc.setRemoteDescription(offerDesc);
-            console.log('Remote description set based on offer');
-            
-            // Create answer
-            const answer = await pc.createAnswer();
-            await pc.setLocalDescription(answer);
-            
-            // Wait a bit for ICE candidates before sending answer
-            await new Promise(resolve => setTimeout(resolve, 1000));
-            
-            // Send answer with current local description (which may have ICE candidates)
-            socket.emit('answer', { answer: pc.localDescription });
-            console.log('Answer sent to host');
+            const sample = statsSample(pc, await pc.getStats());
+            if (sample) {
+              statsBatch.push(sample);
+              urgent = urgent || sample.quality_limited === 1;
+            }
           } catch (e) {
-            console.error('Error handling offer:', e);
-            showConnectionStatus('Failed to process connection offer', true);
-            
-            if (connectionAttempts < maxConnectionAttempts) {
-              socket.emit('connection-failed', { reason: 'offer-error' });
+            console.warn('getStats failed:', e);
+          }
+        }
+        statsTicks += 1;
+        if ((urgent || statsTicks >= STATS_BATCH_INTERVALS) && statsBatch.length > 0 && socket.connected) {
+          emitSignal('call-stats', statsBatch);
+          statsBatch = [];
+          statsTicks = 0;
+        }
+      }
+
+      // Rates come from the difference to the previous report; the first report only seeds them
+      function statsSample(pc, report) {
+        const now = { time: performance.now(), bytesSent: 0, packetsLost: 0, packetsReceived: 0,
+                      framesDecoded: 0, framesDropped: 0, videoStreams: 0 };
+        const sample = { jitter_ms: null, quality_limited: 0 };
+        report.forEach(stat => {
+          if (stat.type === 'candidate-pair' && stat.nominated && stat.state === 'succeeded') {
+            if (stat.currentRoundTripTime !== undefined) sample.rtt_ms = stat.currentRoundTripTime * 1000;
+            if (stat.availableOutgoingBitrate !== undefined) sample.available_kbps = stat.availableOutgoingBitrate / 1000;
+          } else if (stat.type === 'remote-inbound-rtp' && stat.kind === 'video' && stat.fractionLost !== undefined) {
+            // Loss on our uplink, as the far end reports it in RTCP
+            sample.send_loss_pct = Math.max(sample.send_loss_pct || 0, stat.fractionLost * 100);
+          } else if (stat.type === 'inbound-rtp') {
+            now.packetsLost += stat.packetsLost || 0;
+            now.packetsReceived += stat.packetsReceived || 0;
+            if (stat.jitter !== undefined) sample.jitter_ms = Math.max(sample.jitter_ms || 0, stat.jitter * 1000);
+            if (stat.kind === 'video') {
+              now.framesDecoded += stat.framesDecoded || 0;
+              now.framesDropped += stat.framesDropped || 0;
+              now.videoStreams += 1;
+            }
+          } else if (stat.type === 'outbound-rtp') {
+            now.bytesSent += stat.bytesSent || 0;
+            if (stat.kind === 'video' && stat.qualityLimitationReason) {
+              if (stat.qualityLimitationReason !== 'none') sample.quality_limited = 1;
+              sample.cpu_limited = Math.max(sample.cpu_limited || 0, stat.qualityLimitationReason === 'cpu' ? 1 : 0);
             }
           }
+        });
+        const before = previousStats.get(pc);
+        previousStats.set(pc, now);
+        if (!before) return null;
+        const seconds = (now.time - before.time) / 1000;
+        if (seconds <= 0) return null;
+        const lost = now.packetsLost - before.packetsLost;
+        const received = now.packetsReceived - before.packetsReceived;
+        if (lost + received > 0) sample.loss_pct = 100 * Math.max(lost, 0) / (lost + received);
+        sample.outbound_kbps = (now.bytesSent - before.bytesSent) * 8 / seconds / 1000;
+        if (now.videoStreams > 0) {
+          sample.fps = (now.framesDecoded - before.framesDecoded) / seconds / now.videoStreams;
+          sample.frames_dropped = now.framesDropped - before.framesDropped;
         }
+        return sample;
+      }
+
+      // Encoding parameters from the server's bitrate control, applied to every sender of our camera.
+      // A shared screen keeps its resolution, so only its bitrate and frame rate are limited
+      let encodingParams = null;
+
+      async function applyEncodingParams(senders) {
+        if (!encodingParams) return;
+        const params = screenStream ? { ...encodingParams, scaleResolutionDownBy: 1 } : encodingParams;
+        for (const sender of senders) {
+          try {
+            const parameters = sender.getParameters();
+            if (!parameters.encodings || parameters.encodings.length === 0) continue;  // not negotiated yet
+            Object.assign(parameters.encodings[0], params);
+            await sender.setParameters(parameters);
+          } catch (e) {
+            console.warn('Could not apply encoding parameters:', e);
+          }
+        }
+      }
+
+      socket.on('encoding-params', (params) => {
+        encodingParams = params;
+        applyEncodingParams(videoSenders());
+      });
+
+      // Fix for handling offer responses in the client
+      onSignal('offer', async (data) => {
+        await acceptOffer(data.from, data.offer);
+      });
+
+      async function acceptOffer(peerId, offer) {
+        showConnectionStatus('Received connection offer...');
+        const pc = createPeerConnection(peerId, false);
+        if (!pc) return;
+        const peer = peers[peerId];
+        
+        try {
+          // Add all local tracks before processing the offer
+          localStream.getTracks().forEach(track => {
+            pc.addTrack(track, localStream);
+          });
+          
+          const offerDesc = new RTCSessionDescription(offer);
+          await pc.setRemoteDescription(offerDesc);
+          console.log('Remote description set based on offer');
+          await drainPendingCandidates(peer);
+          
+          // Create answer
+          const answer = await pc.createAnswer();
+          await pc.setLocalDescription(answer);
+          
+          // Wait a bit for ICE candidates before sending answer
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          if (peer.pc !== pc) return;  // superseded while we waited
+          
+          // Send answer with current local description (which may have ICE candidates)
+          emitSignal('answer', { target: peer.id, answer: pc.localDescription });
+          console.log('Answer sent to', peer.id);
+        } catch (e) {
+          console.error('Error handling offer:', e);
+          showConnectionStatus('Failed to process connection offer', true);
+          
+          if (peer.attempts < maxConnectionAttempts) {
+            socket.emit('connection-failed', { reason: 'offer-error', target: peer.id });
+          }
+        }
+      }
+
+      onSignal('answer', async (data) => {
+        await acceptAnswer(data.from, data.answer);
       });
 
-      socket.on('answer', async (data) => {
-        if (isHost && peerConnection) {
+      async function acceptAnswer(peerId, answer) {
+        const peer = peers[peerId];
+        if (peer && peer.offerer && peer.pc) {
           try {
-            showConnectionStatus('Received answer from client...');
-            const answerDesc = new RTCSessionDescription(data.answer);
-            await peerConnection.setRemoteDescription(answerDesc);
+            showConnectionStatus('Received answer...');
+            const answerDesc = new RTCSessionDescription(answer);
+            await peer.pc.setRemoteDescription(answerDesc);
             console.log('Remote description set based on answer');
+            await drainPendingCandidates(peer);
           } catch (e) {
             console.error('Error handling answer:', e);
             showConnectionStatus('Failed to process connection answer', true);
             
-            if (connectionAttempts < maxConnectionAttempts) {
-              resetConnection();
-              setTimeout(initiateOffer, 2000);
+            if (peer.attempts < maxConnectionAttempts) {
+              resetConnection(peer.id);
+              setTimeout(() => {
+                if (peers[peer.id] === peer) initiateOffer(peer.id);
+              }, 2000);
             }
           }
         }
-      });
+      }
 
-      socket.on('candidate', async (data) => {
-        try {
-          if (peerConnection && peerConnection.remoteDescription) {
-            const candidate = new RTCIceCandidate(data.candidate);
-            await peerConnection.addIceCandidate(candidate);
-            console.log('Added ICE candidate');
-          } else {
-            // Queue candidates if remote description not set yet
-            console.log('Queueing ICE candidate until remote description is set');
-            setTimeout(() => {
-              if (peerConnection && peerConnection.remoteDescription) {
-                peerConnection.addIceCandidate(new RTCIceCandidate(data.candidate))
-                  .catch(e => console.error('Error adding queued ICE candidate:', e));
-              }
-            }, 1000);
+      async function drainPendingCandidates(peer) {
+        const pc = peer.pc;
+        if (!pc || !pc.remoteDescription) return;
+        const queued = peer.pending;
+        peer.pending = [];
+        for (const candidate of queued) {
+          try {
+            await pc.addIceCandidate(new RTCIceCandidate(candidate));
+          } catch (e) {
+            console.error('Error adding queued ICE candidate:', e);
           }
-        } catch (e) {
-          console.error('Error handling ICE candidate:', e);
+        }
+        if (peer.complete) {
+          peer.complete = false;
+          // An empty call signals end-of-candidates to the ICE agent
+          pc.addIceCandidate().catch(e => console.warn('End-of-candidates not accepted:', e));
+        }
+      }
+
+      // The server batches trickled candidates per peer and holds them until our remote
+      // description from that peer exists
+      onSignal('candidates', async (data) => {
+        const peer = peers[data.from];
+        if (!peer) return;
+        peer.pending.push(...data.candidates);
+        peer.complete = peer.complete || data.done;
+        if (peer.pc && peer.pc.remoteDescription) {
+          console.log(`Adding ${data.candidates.length} ICE candidates from ${peer.id}`);
+          await drainPendingCandidates(peer);
+        } else {
+          console.log('Queueing ICE candidates until remote description is set');
         }
       });
 
@@ -671,28 +1771,32 @@ HTML = '''
       socket.on('reconnect', (attemptNumber) => {
         showConnectionStatus(`Reconnected to server after ${attemptNumber} attempts`);
         // Re-establish WebRTC connection if needed
-        if (isHost && !isConnected) {
+        if (isHost && connectedPeers() === 0) {
           socket.emit('ready-for-connection');
         }
       });
 
       socket.on('role-assigned', (data) => {
         isHost = data.isHost;
+        if ('codec' in data) wireCodec = data.codec === 'msgpack';
+        if (data.token) {
+          sessionStorage.setItem(resumeKey, data.token);
+          socket.io.opts.query.resume = data.token;
+        }
+        sfuMode = !!data.sfu;
+        joinSfu();
+        if ('statsInterval' in data) startStatsSampling(data.statsInterval);
         document.getElementById('localRole').textContent = isHost ? 'Host' : 'Client';
-        document.getElementById('remoteRole').textContent = isHost ? 'Client' : 'Host';
-        showConnectionStatus(isHost ? 'You are the host' : 'You are the client');
+        showConnectionStatus(data.resumed ? 'Session resumed' : (isHost ? 'You are the host' : 'You are the client'));
         
-        // If host, wait for client connection notification
-        // If client, wait for initiate-connection event
+        // Participants already in the call offer to us; we offer to those who join later
       });
       
       socket.on('host-changed', (data) => {
         if (data.newHost) {
           isHost = true;
           document.getElementById('localRole').textContent = 'Host';
-          document.getElementById('remoteRole').textContent = 'Client';
           showConnectionStatus('You have been promoted to host');
-          // Wait for new client to connect
         }
       });
       
@@ -704,56 +1808,115 @@ HTML = '''
         }
       });
 
+      // The server asks us to offer to a participant that joined after us, staggering
+      // these requests so several joins never start all their connections at once
       socket.on('user-connected', async (data) => {
-        if (isHost) {
-          showConnectionStatus('Client connected, establishing video call...');
-          initiateOffer();
+        showConnectionStatus('Participant joined, establishing video call...');
+        initiateOffer(data.userId);
+      });
+
+      // The server re-sends what each peer negotiated while we were away, so the calls can
+      // continue (or finish connecting) without waiting for a fresh offer round trip
+      onSignal('resume-state', async (data) => {
+        if (data.sfuRejoin) {
+          // A new server process took over and has no media connection for us yet
+          closeSfu();
+          joinSfu();
+        }
+        for (const link of data.links) {
+          const peer = peers[link.peer];
+          if (peer && peer.pc && ['connected', 'connecting'].includes(peer.pc.connectionState)) {
+            console.log(`Session resumed; peer connection to ${link.peer} is still up`);
+            continue;
+          }
+          if (link.offer && !link.offerer) {
+            resetConnection(link.peer);
+            const entry = peerEntry(link.peer);
+            entry.pending.push(...link.candidates);
+            entry.complete = link.done;
+            await acceptOffer(link.peer, link.offer);
+          } else if (link.answer && link.offerer && peer && peer.pc && peer.pc.signalingState === 'have-local-offer') {
+            peer.pending.push(...link.candidates);
+            peer.complete = link.done;
+            await acceptAnswer(link.peer, link.answer);
+          } else if (link.present) {
+            // Nothing cached fits this page's state: start over with a fresh offer
+            if (link.offerer) {
+              initiateOffer(link.peer);
+            } else {
+              resetConnection(link.peer);
+              socket.emit('request-offer', { target: link.peer });
+            }
+          }
         }
       });
 
+      socket.on('peer-away', (data) => {
+        showConnectionStatus(`A participant lost connection to the server, holding their place for ${data.grace}s...`);
+      });
+
+      socket.on('peer-resumed', (data) => {
+        clearLiveCaption(data.previousId);
+        // Same participant, new sid: its peer connection carries on under the new id
+        const peer = peers[data.previousId];
+        if (peer) {
+          delete peers[data.previousId];
+          peer.id = data.userId;
+          peers[data.userId] = peer;
+        }
+        if (sfuTiles[data.previousId]) {
+          sfuTiles[data.userId] = sfuTiles[data.previousId];
+          delete sfuTiles[data.previousId];
+        }
+        showConnectionStatus('A participant is back');
+      });
+
       socket.on('user-disconnected', (data) => {
-        document.getElementById('remoteVideo').srcObject = null;
-        document.getElementById('remoteConnectionStatus').style.display = 'block';
-        document.getElementById('remoteConnectionStatus').textContent = 'Remote user disconnected';
-        document.getElementById('remoteRole').textContent = 'Waiting...';
-        showConnectionStatus('Remote user disconnected. Waiting for new connection...');
-        
-        if (peerConnection) {
-          resetConnection();
+        clearLiveCaption(data.userId);
+        removePeer(data.userId);
+        if (Object.keys(peers).length === 0) {
+          document.getElementById('remoteConnectionStatus').style.display = 'block';
+          document.getElementById('remoteConnectionStatus').textContent = 'Remote user disconnected';
+          showConnectionStatus('Remote user disconnected. Waiting for new connection...');
+        } else {
+          showConnectionStatus('A participant left the call');
         }
       });
       
-      socket.on('try-reconnect', () => {
+      socket.on('error', (data) => {
+        showConnectionStatus(data.message, true);
+      });
+
+      socket.on('rate-limited', (data) => {
+        console.warn(`Server is rate limiting ${data.event}, retry in ${data.retryAfter}s`);
+      });
+
+      socket.on('try-reconnect', (data) => {
+        if (data && data.resume) {
+          // The server is restarting: move the socket to the new process and resume there;
+          // the peer connections carry on untouched
+          setTimeout(() => {
+            socket.disconnect();
+            socket.connect();
+          }, data.delay * 1000);
+          return;
+        }
         showConnectionStatus('Server suggests reconnecting...', true);
-        resetConnection();
+        const targets = data && data.target ? [data.target] : Object.keys(peers);
+        targets.forEach(peerId => resetConnection(peerId));
         
         setTimeout(() => {
           socket.emit('ready-for-connection');
-          if (isHost) {
-            initiateOffer();
-          }
+          targets.forEach(renegotiate);
         }, 2000);
       });
       
-      socket.on('heartbeat-response', (data) => {
-        // Connection is alive
-      });
-      
-      // Send heartbeat periodically
-      setInterval(() => {
-        if (socket.connected) {
-          socket.emit('heartbeat');
-        }
-      }, 30000);
-
       // Reconnect button
       document.getElementById('reconnectButton').addEventListener('click', () => {
         showConnectionStatus('Reconnecting...');
-        resetConnection();
         socket.emit('ready-for-connection');
-        if (isHost) {
-          setTimeout(initiateOffer, 1000);
-        }
+        Object.keys(peers).forEach(peerId => resetConnection(peerId));
+        setTimeout(() => Object.keys(peers).forEach(renegotiate), 1000);
       });
 
       // Controls
@@ -769,6 +1932,7 @@ HTML = '''
         localStream.getVideoTracks().forEach(track => {
           track.enabled = !track.enabled;
         });
+        if (sfuLowLayer) sfuLowLayer.enabled = localStream.getVideoTracks()[0].enabled;
         document.getElementById('muteVideo').textContent = 
           localStream.getVideoTracks()[0].enabled ? 'Mute Video' : 'Unmute Video';
       });
@@ -779,15 +1943,13 @@ HTML = '''
             // Toggle back to camera
             const cameraTrack = localStream.getVideoTracks()[0];
             
-            if (peerConnection) {
-              const sender = peerConnection.getSenders().find(s => s.track && s.track.kind === 'video');
-              if (sender) {
-                await sender.replaceTrack(cameraTrack);
-              }
+            for (const sender of videoSenders()) {
+              await sender.replaceTrack(cameraTrack);
             }
             
             screenStream.getTracks().forEach(track => track.stop());
             screenStream = null;
+            applyEncodingParams(videoSenders());
             document.getElementById('localVideo').srcObject = localStream;
             document.getElementById('shareScreen').textContent = 'Share Screen';
             
@@ -803,12 +1965,10 @@ HTML = '''
             
             const screenTrack = screenStream.getVideoTracks()[0];
             
-            if (peerConnection) {
-              const sender = peerConnection.getSenders().find(s => s.track && s.track.kind === 'video');
-              if (sender) {
-                await sender.replaceTrack(screenTrack);
-              }
+            for (const sender of videoSenders()) {
+              await sender.replaceTrack(screenTrack);
             }
+            applyEncodingParams(videoSenders());
             
             document.getElementById('localVideo').srcObject = screenStream;
             document.getElementById('shareScreen').textContent = 'Show Camera';
@@ -842,12 +2002,29 @@ HTML = '''
         }
       });
 
-      socket.on('chat-message', (data) => {
+      // Highest chat seq shown, so a backfill after reconnecting only adds what was missed
+      let lastChatSeq = 0;
+
+      function appendChatLine(text) {
         const chatMessages = document.getElementById('chat-messages');
         const messageElem = document.createElement('div');
-        messageElem.textContent = data;
+        messageElem.textContent = text;
         chatMessages.appendChild(messageElem);
         chatMessages.scrollTop = chatMessages.scrollHeight;
+      }
+
+      socket.on('chat-message', (data, seq) => {
+        if (seq) lastChatSeq = Math.max(lastChatSeq, seq);
+        appendChatLine(data);
+      });
+
+      socket.on('chat-history', (data) => {
+        data.messages.forEach((message) => {
+          if (message.seq > lastChatSeq) {
+            appendChatLine(`${message.sender}: ${message.text}`);
+            lastChatSeq = message.seq;
+          }
+        });
       });
 
       // Speech Recognition Setup
@@ -904,12 +2081,45 @@ HTML = '''
           }
 
           if (finalTranscript) {
+            clearTimeout(captionTimer);
+            captionTimer = null;
+            pendingCaption = null;
             addTranscriptionEntry(finalTranscript, isHost ? 'Host' : 'Client');
             socket.emit('transcription', { text: finalTranscript });
+          } else if (interimTranscript) {
+            queueCaption(interimTranscript);
           }
         };
       }
 
+      // Interim results are sent at most once per interval, latest text only
+      const CAPTION_SEND_INTERVAL = 150;
+      let pendingCaption = null;
+      let captionTimer = null;
+
+      function queueCaption(text) {
+        pendingCaption = text;
+        if (captionTimer) return;
+        captionTimer = setTimeout(() => {
+          captionTimer = null;
+          if (pendingCaption !== null) {
+            socket.emit('caption', { text: pendingCaption });
+            pendingCaption = null;
+          }
+        }, CAPTION_SEND_INTERVAL);
+      }
+
+      // Live caption lines of remote speakers, by sender
+      const liveCaptions = {};
+
+      function clearLiveCaption(sender) {
+        const caption = liveCaptions[sender];
+        if (caption) {
+          caption.elem.remove();
+          delete liveCaptions[sender];
+        }
+      }
+
       function addTranscriptionEntry(text, speaker) {
         const transcriptionBox = document.getElementById('transcriptionBox');
         const entry = document.createElement('div');
@@ -940,157 +2150,742 @@ HTML = '''
         }
       });
 
+      // The server does not echo our own transcriptions or captions back
       socket.on('transcription', (data) => {
-        if (data.sender !== socket.id) {
-          addTranscriptionEntry(data.text, isHost ? 'Client' : 'Host');
+        clearLiveCaption(data.sender);
+        addTranscriptionEntry(data.text, data.role === 'host' ? 'Host' : 'Client');
+      });
+
+      socket.on('caption', (data) => {
+        let caption = liveCaptions[data.sender];
+        if (!caption) {
+          const elem = document.createElement('div');
+          elem.className = 'transcription-entry';
+          elem.style.opacity = '0.6';
+          document.getElementById('transcriptionBox').appendChild(elem);
+          caption = liveCaptions[data.sender] = { elem, text: '' };
         }
+        caption.text = caption.text.slice(0, data.keep) + data.text;
+        caption.elem.textContent = `${data.role === 'host' ? 'Host' : 'Client'}: ${caption.text}`;
+        const transcriptionBox = document.getElementById('transcriptionBox');
+        transcriptionBox.scrollTop = transcriptionBox.scrollHeight;
       });
       
       // Start the application
       init();
-    </script>
-  </body>
-</html>
 '''
 
+
+def build_assets():
+    """Write the page's hashed assets to static/; returns the bundle that serves them"""
+    bundle = AssetBundle(static_folder)
+    bundle.add('app.css', PAGE_STYLE.encode('utf-8'), 'text/css')
+    bundle.add('app.js', PAGE_SCRIPT.encode('utf-8'), 'application/javascript')
+    with open(os.path.join(vendor_folder, 'socket.io.min.js'), 'rb') as f:
+        bundle.add('socket.io.min.js', f.read(), 'application/javascript')
+    deleted = bundle.prune()
+    if deleted:
+        logger.info('Deleted %d static files of older builds', len(deleted))
+    return bundle
+
+
+def build_index_page():
+    """Render the page once and precompress it; returns {encoding: (body, etag)}"""
+    with app.app_context():
+        body = render_template_string(HTML, assets=static_assets).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    return {encoding: (variant, digest + ETAG_SUFFIXES[encoding]) for encoding, variant in precompress(body).items()}
+
+
+static_assets = build_assets()
+index_page = build_index_page()
+index_etags = [etag for _, etag in index_page.values()]
+# Sent with the page so the scripts start downloading before the parser reaches them
+index_preload = static_assets.preload_links(['app.css', 'socket.io.min.js', 'app.js'])
+
+
 @app.route('/')
-def index():
-    return render_template_string(HTML)
+@app.route('/room/<room_id>')
+def index(room_id=None):
+    encoding = negotiate(index_page, request.accept_encodings)
+    body, etag = index_page[encoding]
+
+    # Every variant is the same rendering, so a tag from any of them proves the copy is current
+    if any(request.if_none_match.contains_weak(tag) for tag in index_etags):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='text/html')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    # The page changes with every deploy, so revalidate each time; a hit is a cheap 304
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Link'] = index_preload
+    return response
+
+
+@app.route('/static/<name>')
+def static_asset(name):
+    """A built asset; its name changes with its content, so it may be cached for good"""
+    asset = static_assets.assets.get(name)
+    if asset is None:
+        return Response(status=404)
+    encoding = negotiate(asset.variants, request.accept_encodings)
+    # Any encoding's tag proves the cached copy has the same content
+    if any(request.if_none_match.contains_weak(tag) for tag in asset.etags.values()):
+        response = Response(status=304)
+    else:
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(asset.etags[encoding])
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.route('/ice-config')
+def ice_config():
+    """A short ICE server list for one session, with credentials for the built-in relay if it runs"""
+    response = app.json.response({'iceServers': ice_directory.config(secrets.token_urlsafe(9)),
+                                  'ttl': TURN_CREDENTIAL_TTL})
+    # The credentials are this visitor's, but a reload within the ranking's lifetime may reuse them
+    response.headers['Cache-Control'] = f'private, max-age={iceservers.CONFIG_TTL}'
+    return response
+
 
-@socketio.on('connect')
+@app.before_request
+def tag_request():
+    if hub_monitor is not None:
+        hub_monitor.enter(f'http {request.endpoint}')
+
+
+@app.teardown_request
+def untag_request(exc):
+    if hub_monitor is not None:
+        hub_monitor.leave()
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/chat-history')
+def chat_history():
+    """Page backwards through a room's chat: ?room=<id>&before=<seq>&limit=<n>.
+
+    The room travels as a query argument so the multi-worker supervisor routes the
+    request to the worker that owns the room.
+    """
+    room_id = request.args.get('room') or DEFAULT_ROOM
+    if not ROOM_ID_PATTERN.match(room_id):
+        return {'error': 'Invalid room id'}, 400
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), CHAT_PAGE_LIMIT)
+    messages = chat_store.page(room_id, before=before, limit=limit)
+    return {
+        'messages': messages,
+        'before': messages[0]['seq'] if messages and messages[0]['seq'] > 1 else None,
+    }
+
+
+@app.route('/call-stats')
+def call_stats():
+    """Connection quality percentiles: ?room=<id> for one call, or the whole fleet; &window=<seconds>"""
+    if stats_store is None:
+        return {'error': 'Telemetry needs numpy'}, 501
+    window = min(max(request.args.get('window', STATS_WINDOW, type=float), 1), telemetry.IDLE_TIMEOUT)
+    room_id = request.args.get('room')
+    if room_id is None:
+        return dict(stats_store.fleet_summary(window), window=window)
+    if not ROOM_ID_PATTERN.match(room_id):
+        return {'error': 'Invalid room id'}, 400
+    summary = stats_store.call_summary(room_id, window)
+    if summary is None:
+        return {'error': 'No samples for this room'}, 404
+    return dict(summary, room=room_id, window=window)
+
+
+def admin_authorized():
+    """Whether the request carries the admin token (NETSTREAM_ADMIN_TOKEN)"""
+    scheme, _, supplied = request.headers.get('Authorization', '').partition(' ')
+    return (ADMIN_TOKEN is not None and scheme == 'Bearer'
+            and secrets.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()))
+
+
+@app.route('/call-abr', methods=['GET', 'PUT', 'DELETE'])
+def call_abr():
+    """Encoding rungs of a call's senders: ?room=<id>. PUT &level=<n> pins them all, DELETE unpins (admin token)"""
+    room_id = request.args.get('room') or DEFAULT_ROOM
+    if not ROOM_ID_PATTERN.match(room_id):
+        return {'error': 'Invalid room id'}, 400
+    room = registry.rooms.get(room_id)
+    sids = list(room.seats) if room is not None else []
+    if request.method != 'GET':
+        if not admin_authorized():
+            return {'error': 'Admin token required'}, 403
+        if request.method == 'DELETE':
+            abr_controller.clear_override(room_id)
+        else:
+            level = request.args.get('level', type=int)
+            if level is None or not 0 <= level < len(abr.LADDER):
+                return {'error': f'level must be 0-{len(abr.LADDER) - 1}'}, 400
+            for sid, rung in abr_controller.override(room_id, level, sids):
+                socketio.emit('encoding-params', rung.params(), to=sid)
+    state = abr_controller.call_state(room_id, sids)
+    state['ladder'] = [rung.params() for rung in abr.LADDER]
+    return state
+
+
+@app.route('/debug/hub')
+def debug_hub():
+    """Hub lag and greenlet run time histograms, and the longest blocking stretches with stacks (admin token)"""
+    if not admin_authorized():
+        return {'error': 'Admin token required'}, 403
+    if server_loop != 'gevent':
+        return {'error': 'The hub monitor needs the gevent server (videoapp.py)'}, 501
+    if hub_monitor is None:
+        return {'error': 'Hub monitor is off (--block-threshold 0)'}, 404
+    return dict(hub_monitor.report(), pid=os.getpid())
+
+
+# The profiling run in progress, if any; one at a time
+current_profile = None
+
+
+@app.route('/debug/profile', methods=['POST'])
+def debug_profile():
+    """Sample the hub for ?seconds=<n> at ?hz=<n>; collapsed stacks, or per-handler totals with &format=json (admin token)"""
+    global current_profile
+    if not admin_authorized():
+        return {'error': 'Admin token required'}, 403
+    if server_loop != 'gevent':
+        return {'error': 'Profiling needs the gevent server (videoapp.py)'}, 501
+    if current_profile is not None:
+        return {'error': 'A profile is already running'}, 409
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), profiler.MAX_SECONDS)
+    hz = min(max(request.args.get('hz', profiler.DEFAULT_HZ, type=int), 1), profiler.MAX_HZ)
+    profile = current_profile = profiler.Profile(signaling_handlers, threading.get_ident(), seconds, hz)
+    try:
+        # Sampled from a pool thread; this greenlet just waits, so the hub is free to serve meanwhile
+        gevent.get_hub().threadpool.spawn(profile.run).get()
+    finally:
+        current_profile = None
+    if request.args.get('format') == 'json':
+        return {'pid': os.getpid(), 'seconds': seconds, 'hz': hz, 'samples': profile.samples,
+                'handlers': profile.by_handler(), 'stacks': dict(profile.stacks.most_common())}
+    return Response(profile.collapsed(), mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename="netstream-{os.getpid()}.collapsed"'})
+
+
+@app.route('/transcripts/search')
+def transcript_search():
+    """Phrase search over a room's transcript: ?room=<id>&q=<phrase>&limit=<n>"""
+    room_id = request.args.get('room') or DEFAULT_ROOM
+    if not ROOM_ID_PATTERN.match(room_id):
+        return {'error': 'Invalid room id'}, 400
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 50, type=int), 1), CHAT_PAGE_LIMIT)
+    start = time.perf_counter()
+    hits = transcripts.search(room_id, query, limit)
+    return {'query': query, 'hits': hits, 'took_ms': round((time.perf_counter() - start) * 1000, 3)}
+
+
+@app.route('/transcripts/export')
+def transcript_export():
+    """Stream a room's whole transcript as JSON lines: ?room=<id>"""
+    room_id = request.args.get('room') or DEFAULT_ROOM
+    if not ROOM_ID_PATTERN.match(room_id):
+        return {'error': 'Invalid room id'}, 400
+    return Response(transcripts.export(room_id), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{room_id}-transcript.jsonl"'})
+
+
+@signaling_event('connect')
 def handle_connect():
-    global host_id
     user_id = request.sid
-    logger.info(f"New connection: {user_id}")
-    
-    connection_timestamps[user_id] = time.time()
-    
-    if not connected_users: 
-        host_id = user_id
-        connected_users.append(user_id)
-        user_roles[user_id] = 'host'
-        logger.info(f"User {user_id} assigned as host")
-        socketio.emit('role-assigned', {'isHost': True}, to=user_id)
-    elif len(connected_users) < 2:  
-        connected_users.append(user_id)
-        user_roles[user_id] = 'client'
-        logger.info(f"User {user_id} assigned as client")
-        socketio.emit('role-assigned', {'isHost': False}, to=user_id)
-        socketio.emit('user-connected', {'userId': user_id}, to=host_id)
-    else:
-        logger.warning(f"Room full, rejecting user {user_id}")
+    room_id = request.args.get('room') or DEFAULT_ROOM
+    logger.info("New connection: %s (room %s)", user_id, room_id, extra={'event': 'connect', 'sid': user_id})
+
+    if not connect_bucket.take():
+        logger.warning("Connection rate limit reached, rejecting user %s", user_id,
+                       extra={'event': 'connect', 'sid': user_id})
+        RATE_LIMITED.inc('connect')
+        socketio.emit('error', {'message': 'Server busy, retry shortly',
+                                'retryAfter': round(connect_bucket.retry_after(), 3)}, to=user_id)
+        return False
+
+    if not ROOM_ID_PATTERN.match(room_id):
+        logger.warning("Invalid room id, rejecting user %s", user_id, extra={'event': 'connect', 'sid': user_id})
+        socketio.emit('error', {'message': 'Invalid room id'}, to=user_id)
+        return False
+
+    codec = None
+    if request.args.get('codec') == wirecodec.CODEC_NAME and wirecodec.available():
+        codec = wirecodec.CODEC_NAME
+
+    old_id = resume_tokens.get(request.args.get('resume'))
+    if old_id is not None and getattr(registry.room_of(old_id), 'room_id', None) == room_id:
+        if codec is not None:
+            wire_codecs.add(user_id)
+        resume_session(old_id, user_id, codec)
+        return
+
+    room, role = registry.join(user_id, room_id)
+    if role is None:
+        logger.warning("Room %s full, rejecting user %s", room_id, user_id,
+                       extra={'event': 'connect', 'sid': user_id})
         socketio.emit('error', {'message': 'Room is full'}, to=user_id)
         return False
 
-@socketio.on('disconnect')
+    # Only seated sessions: a rejected connect never reaches handle_disconnect to discard it
+    if codec is not None:
+        wire_codecs.add(user_id)
+    join_room(room.channel)
+    limiter.open(user_id)
+    timers.schedule(user_id, LIVENESS_CHECK_INTERVAL, check_liveness)
+    timers.start()
+    logger.info("User %s assigned as %s in room %s", user_id, role, room_id,
+                extra={'event': 'connect', 'sid': user_id})
+    token = issue_resume_token(user_id)
+    socketio.emit('role-assigned', {'isHost': role == 'host', 'codec': codec, 'token': token,
+                                    'sfu': sfu_router is not None, 'statsInterval': STATS_INTERVAL}, to=user_id)
+    # Everyone already seated offers to the newcomer, each in its own staggered slot
+    if sfu_router is None:
+        for peer in room.peers_of(user_id):
+            call_later(room.stagger(peer, user_id), introduce, room, peer, user_id)
+    history = chat_store.recent(room_id, CHAT_BACKFILL)
+    if history:
+        socketio.emit('chat-history', {'messages': history}, to=user_id)
+
+
+def introduce(room, offerer, answerer):
+    """Ask offerer to start a peer connection with answerer, if both are still in the call"""
+    if offerer in room.seats and answerer in room.seats and offerer not in room.away:
+        socketio.emit('user-connected', {'userId': answerer}, to=offerer)
+
+
+def issue_resume_token(user_id):
+    token = secrets.token_urlsafe(18)
+    session_tokens[user_id] = token
+    resume_tokens[token] = user_id
+    return token
+
+
+def revoke_resume_token(user_id):
+    """Make a session unresumable, e.g. before evicting it"""
+    resume_tokens.pop(session_tokens.pop(user_id, None), None)
+
+
+def resume_session(old_id, user_id, codec):
+    """Hand a held (or still lingering) seat to the reconnected sid and re-prime it"""
+    room = registry.room_of(old_id)
+    lingering = old_id not in room.away  # the old socket has not been noticed dead yet
+    timers.cancel(('resume', old_id))
+    revoke_resume_token(old_id)
+    registry.resume(old_id, user_id)
+    abr_controller.rename(old_id, user_id)
+    if lingering:
+        socketio.server.disconnect(old_id)  # its disconnect finds no seat and does nothing
+
+    join_room(room.channel)
+    limiter.open(user_id)
+    timers.schedule(user_id, LIVENESS_CHECK_INTERVAL, check_liveness)
+    role = room.role_of(user_id)
+    logger.info("User %s resumed %s seat of %s in room %s", user_id, role, old_id, room.room_id,
+                extra={'event': 'connect', 'sid': user_id})
+    RESUMES.inc(role)
+    socketio.emit('role-assigned', {'isHost': role == 'host', 'codec': codec, 'token': issue_resume_token(user_id),
+                                    'resumed': True, 'sfu': sfu_router is not None,
+                                    'statsInterval': STATS_INTERVAL}, to=user_id)
+    socketio.emit('peer-resumed', {'userId': user_id, 'previousId': old_id}, to=room.channel, skip_sid=user_id)
+
+    if sfu_router is not None:
+        # Media runs over the participant's own connection to the server, which the socket
+        # drop did not touch - unless this process took over from another (graceful restart)
+        rejoin = old_id not in sfu_router.sessions
+        if not rejoin:
+            sfu_router.rename(old_id, user_id)
+        socketio.emit('resume-state', {'links': [], 'sfuRejoin': rejoin}, to=user_id)
+    else:
+        # Re-prime every link from the cache instead of waiting for the peers to renegotiate
+        links = []
+        for peer in room.peers_of(user_id):
+            state = room.link(user_id, peer).replay_for(user_id, peer)
+            state.update(peer=peer, offerer=room.offerer_of(user_id, peer) == user_id,
+                         present=peer not in room.away)
+            if 'offer' in state or 'answer' in state:
+                room.described.add((peer, user_id))
+            links.append(state)
+        socketio.emit('resume-state', for_wire('resume-state', user_id, {'links': links}), to=user_id)
+
+    history = chat_store.recent(room.room_id, CHAT_BACKFILL)
+    if history:
+        socketio.emit('chat-history', {'messages': history}, to=user_id)
+
+
+@signaling_event('disconnect')
 def handle_disconnect():
-    global host_id
     user_id = request.sid
-    logger.info(f"User disconnected: {user_id}")
-    
-    if user_id in connection_timestamps:
-        del connection_timestamps[user_id]
-    
-    if user_id in connected_users:
-        connected_users.remove(user_id)
-        
-        if user_id == host_id:
-            old_host = host_id
-            host_id = None
-            logger.info(f"Host {old_host} disconnected")
-            
-            if connected_users:
-                new_host = connected_users[0]
-                host_id = new_host
-                user_roles[new_host] = 'host'
-                logger.info(f"Promoting client {new_host} to host")
-                socketio.emit('role-assigned', {'isHost': True}, to=new_host)
-                socketio.emit('host-changed', {'newHost': True}, to=new_host)
-        else:
-            logger.info(f"Client {user_id} disconnected")
-        
-        if connected_users:
-            socketio.emit('user-disconnected', {'userId': user_id}, room=connected_users)
+    logger.info("User disconnected: %s", user_id, extra={'event': 'disconnect', 'sid': user_id})
+
+    timers.cancel(user_id)
+    wire_codecs.discard(user_id)
+    limiter.close(user_id)
+    room = registry.room_of(user_id)
+    if room is None:
+        return
+    if user_id in session_tokens:
+        # Hold the seat so a reconnect with the resume token keeps the role and the call
+        room.away.add(user_id)
+        timers.schedule(('resume', user_id), RESUME_GRACE, release_seat)
+        socketio.emit('peer-away', {'userId': user_id, 'grace': RESUME_GRACE}, to=room.channel, skip_sid=user_id)
+        return
+    release_seat(user_id)
+
+
+def release_seat(user_id):
+    """Unseat a participant for good: promote its peer if needed and tell the room.
+
+    Runs directly for unresumable sessions and from the timing wheel, keyed
+    ('resume', sid), when a held seat's grace period runs out.
+    """
+    if isinstance(user_id, tuple):
+        user_id = user_id[1]
+    revoke_resume_token(user_id)
+    room, new_host = registry.leave(user_id)
+    abr_controller.forget(user_id)
+    if room is None:
+        return
+    if sfu_router is not None:
+        sfu_router.leave(user_id)
+
+    if new_host is not None:
+        logger.info("Host %s disconnected, promoting client %s to host", user_id, new_host,
+                    extra={'event': 'disconnect', 'sid': user_id})
+        HOST_PROMOTIONS.inc()
+        socketio.emit('role-assigned', {'isHost': True}, to=new_host)
+        socketio.emit('host-changed', {'newHost': True}, to=new_host)
+    else:
+        logger.info("User %s left room %s", user_id, room.room_id, extra={'event': 'disconnect', 'sid': user_id})
+
+    if not room.is_empty():
+        socketio.emit('user-disconnected', {'userId': user_id}, to=room.channel, skip_sid=user_id)
+    else:
+        chat_store.close(room.room_id)
+        transcripts.close(room.room_id)
 
-@socketio.on('ready-for-connection')
-def handle_ready(data):
+
+@signaling_event('ready-for-connection')
+def handle_ready(data=None):
     """New event to ensure both sides are ready before attempting connection"""
     user_id = request.sid
-    logger.info(f"User {user_id} ready for connection")
-    
-    if user_id == host_id and len(connected_users) > 1:
-        client_id = [uid for uid in connected_users if uid != host_id][0]
-        socketio.emit('initiate-connection', {'hostId': host_id}, to=client_id)
+    logger.info("User %s ready for connection", user_id, extra={'event': 'ready-for-connection', 'sid': user_id})
+
+    room = registry.room_of(user_id)
+    if room is not None and user_id == room.host_id and len(room.seats) > 1:
+        socketio.emit('initiate-connection', {'hostId': user_id}, to=room.channel, skip_sid=user_id)
+
+
+def signaling_target(room, sender_id, data):
+    """The participant a signaling message is addressed to, or None.
+
+    Messages name their target sid; one without a target goes to the only peer of
+    a two-party call.
+    """
+    if room is None:
+        return None
+    target_id = data.get('target') if isinstance(data, dict) else None
+    if target_id is None:
+        peers = room.peers_of(sender_id)
+        return peers[0] if len(peers) == 1 else None
+    return target_id if target_id != sender_id and target_id in room.seats else None
+
+
+def flush_candidates(room, sender_id, target_id):
+    """Deliver every candidate buffered from sender_id for target_id in one batched 'candidates' event"""
+    key = (sender_id, target_id)
+    room.flush_scheduled.discard(key)
+    if key not in room.described or room.role_of(target_id) is None:
+        return
+    candidates = room.pending_candidates.pop(key, [])
+    done = key in room.candidates_done
+    room.candidates_done.discard(key)
+    if candidates or done:
+        logger.info("Delivering %d ICE candidates from %s to %s%s", len(candidates), sender_id, target_id,
+                    " (end of candidates)" if done else "", extra={'event': 'candidate', 'sid': target_id})
+        socketio.emit('candidates', for_wire('candidates', target_id, {
+            'from': sender_id, 'candidates': candidates, 'done': done}), to=target_id)
+
+
+def schedule_candidate_flush(room, sender_id, target_id, delay=CANDIDATE_FLUSH_WINDOW):
+    """Flush a pair's buffer after a short window so a trickle burst shares one emit"""
+    key = (sender_id, target_id)
+    if key in room.described and key not in room.flush_scheduled:
+        room.flush_scheduled.add(key)
+        call_later(delay, flush_candidates, room, sender_id, target_id)
+
+
+@signaling_event('request-offer')
+def handle_request_offer(data=None):
+    """A participant that lost its peer connection to the target asks it for a fresh offer"""
+    room = registry.room_of(request.sid)
+    target_id = signaling_target(room, request.sid, data)
+    if target_id is not None and target_id not in room.away:
+        socketio.emit('user-connected', {'userId': request.sid}, to=target_id)
+
 
-@socketio.on('offer')
+@signaling_event('offer')
 def handle_offer(data):
     try:
-        if host_id and len(connected_users) > 1:
-            client_id = [uid for uid in connected_users if uid != host_id][0]
-            logger.info(f"Forwarding offer from host to client {client_id}")
-            socketio.emit('offer', {'offer': data['offer']}, to=client_id)
+        sender_id = request.sid
+        room = registry.room_of(sender_id)
+        target_id = signaling_target(room, sender_id, data)
+        if target_id:
+            logger.info("Forwarding offer to %s", target_id, extra={'event': 'offer', 'sid': sender_id})
+            room.restart_link(sender_id, target_id)
+            room.link(sender_id, target_id).record_offer(sender_id, data['offer'])
+            socketio.emit('offer', for_wire('offer', target_id, {'from': sender_id, 'offer': data['offer']}),
+                          to=target_id)
+            room.described.add((sender_id, target_id))
+            flush_candidates(room, sender_id, target_id)
         else:
-            logger.warning("Cannot forward offer: not enough users or no host")
+            logger.warning("Cannot forward offer: no such peer in room", extra={'event': 'offer', 'sid': sender_id})
     except Exception as e:
-        logger.error(f"Error handling offer: {e}")
+        logger.error("Error handling offer: %s", e, extra={'event': 'offer'})
+
 
-@socketio.on('answer')
+@signaling_event('answer')
 def handle_answer(data):
     try:
-        if host_id:
-            logger.info(f"Forwarding answer to host {host_id}")
-            socketio.emit('answer', {'answer': data['answer']}, to=host_id)
+        room = registry.room_of(request.sid)
+        target_id = signaling_target(room, request.sid, data)
+        if target_id:
+            logger.info("Forwarding answer to %s", target_id, extra={'event': 'answer', 'sid': request.sid})
+            room.link(request.sid, target_id).answer = data['answer']
+            socketio.emit('answer', for_wire('answer', target_id, {'from': request.sid, 'answer': data['answer']}),
+                          to=target_id)
+            room.described.add((request.sid, target_id))
+            flush_candidates(room, request.sid, target_id)
         else:
-            logger.warning("Cannot forward answer: no host available")
+            logger.warning("Cannot forward answer: no such peer in room",
+                           extra={'event': 'answer', 'sid': request.sid})
     except Exception as e:
-        logger.error(f"Error handling answer: {e}")
+        logger.error("Error handling answer: %s", e, extra={'event': 'answer'})
 
-@socketio.on('candidate')
+
+@signaling_event('candidate')
 def handle_candidate(data):
+    """Buffer a trickled candidate for its target; a null candidate marks end-of-candidates"""
     try:
         sender_id = request.sid
-        if sender_id == host_id:
-            if len(connected_users) > 1:
-                target_id = [uid for uid in connected_users if uid != host_id][0]
-                logger.info(f"Forwarding ICE candidate from host to client {target_id}")
-                socketio.emit('candidate', {'candidate': data['candidate']}, to=target_id)
-            else:
-                logger.warning("Cannot forward ICE candidate: no client connected")
+        room = registry.room_of(sender_id)
+        target_id = signaling_target(room, sender_id, data)
+        if not target_id:
+            logger.warning("Cannot forward ICE candidate: no such peer in room",
+                           extra={'event': 'candidate', 'sid': sender_id})
+            return
+        candidate = data.get('candidate')
+        room.link(sender_id, target_id).record_candidate(sender_id, candidate or None)
+        key = (sender_id, target_id)
+        if candidate:
+            logger.debug("Queued ICE candidate for %s", target_id, extra={'event': 'candidate', 'sid': sender_id})
+            room.pending_candidates.setdefault(key, []).append(candidate)
+            schedule_candidate_flush(room, sender_id, target_id)
         else:
-            logger.info(f"Forwarding ICE candidate from client to host {host_id}")
-            socketio.emit('candidate', {'candidate': data['candidate']}, to=host_id)
+            room.candidates_done.add(key)
+            if key in room.described:
+                flush_candidates(room, sender_id, target_id)
     except Exception as e:
-        logger.error(f"Error handling ICE candidate: {e}")
+        logger.error("Error handling ICE candidate: %s", e, extra={'event': 'candidate'})
 
-@socketio.on('connection-failed')
+
+@signaling_event('connection-failed')
 def handle_connection_failed(data):
     """Handle notification that WebRTC connection failed"""
     user_id = request.sid
-    logger.warning(f"Connection failed for user {user_id}: {data.get('reason', 'Unknown reason')}")
-    socketio.emit('try-reconnect', room=user_id)
+    reason = data.get('reason', 'Unknown reason')
+    logger.warning("Connection failed for user %s: %s", user_id, reason,
+                   extra={'event': 'connection-failed', 'sid': user_id})
+    # Reasons come from the client, so only known ones become label values
+    CONNECTION_FAILURES.inc(reason if reason in KNOWN_FAILURE_REASONS else 'other')
+    socketio.emit('try-reconnect', {'target': data.get('target')}, room=user_id)
+
 
-@socketio.on('chat-message')
+@signaling_event('chat-message')
 def handle_chat_message(message):
     sender = request.sid
-    sender_type = 'Host' if sender == host_id else 'Client'
-    logger.info(f"Chat message from {sender_type}: {message[:20]}...")
-    socketio.emit('chat-message', f"{sender_type}: {message}", to=connected_users)
+    room = registry.room_of(sender)
+    if room is None:
+        return
+    sender_type = 'Host' if sender == room.host_id else 'Client'
+    logger.info("Chat message from %s: %.20s...", sender_type, message, extra={'event': 'chat-message', 'sid': sender})
+    entry = chat_store.append(room.room_id, sender_type, str(message))
+    # The seq rides along as a second argument so clients can skip it in a later backfill
+    socketio.emit('chat-message', (f"{sender_type}: {message}", entry['seq']), to=room.channel)
+
 
-@socketio.on('transcription')
+@signaling_event('transcription')
 def handle_transcription(data):
     sender = request.sid
+    room = registry.room_of(sender)
+    if room is None or not isinstance(data, dict) or not isinstance(data.get('text'), str):
+        return
+    role = room.role_of(sender)
+    entry = transcripts.append(room.room_id, role, data['text'])
+    # A final result commits the speaker's live caption, so nothing interim is left to flush
+    room.captions.pop(sender, None)
     socketio.emit('transcription', {
         'text': data['text'],
-        'sender': sender
-    }, to=connected_users)
-@socketio.on('heartbeat')
-def handle_heartbeat():
-    user_id = request.sid
-    logger.debug(f"Heartbeat from {user_id}")
-    socketio.emit('heartbeat-response', {'status': 'ok'}, to=user_id)
+        'sender': sender,
+        'role': role,
+        'seq': entry['seq'],
+    }, to=room.channel, skip_sid=sender)
+
+
+@signaling_event('caption')
+def handle_caption(data):
+    """Interim speech result; only the latest one per speaker is relayed each flush interval"""
+    sender = request.sid
+    room = registry.room_of(sender)
+    if room is None or not isinstance(data, dict) or not isinstance(data.get('text'), str):
+        return
+    room.captions.setdefault(sender, ['', None])[1] = data['text']
+    if sender not in room.caption_scheduled:
+        room.caption_scheduled.add(sender)
+        call_later(CAPTION_FLUSH_INTERVAL, flush_caption, room, sender)
+
+
+def flush_caption(room, sender):
+    """Send the peer what changed in sender's caption: keep `keep` chars, then append `text`"""
+    room.caption_scheduled.discard(sender)
+    state = room.captions.get(sender)
+    if state is None or state[1] is None:
+        return
+    sent, text = state
+    state[0], state[1] = text, None
+    if text == sent:
+        return
+    keep = len(os.path.commonprefix([sent, text]))
+    socketio.emit('caption', {'sender': sender, 'role': room.role_of(sender), 'keep': keep, 'text': text[keep:]},
+                  to=room.channel, skip_sid=sender)
+
+
+@signaling_event('call-stats')
+def handle_call_stats(samples):
+    """A batch of getStats() samples from one participant: filed under its room, and fed to its bitrate control"""
+    room = registry.room_of(request.sid)
+    if room is None or not isinstance(samples, list):
+        return
+    samples = [sample for sample in samples[:telemetry.MAX_BATCH] if isinstance(sample, dict)]
+    if stats_store is not None:
+        stats_store.add(room.room_id, samples)
+    rung = abr_controller.observe(request.sid, room.room_id, samples)
+    if rung is not None:
+        socketio.emit('encoding-params', rung.params(), to=request.sid)
+
+
+def sfu_emit(event, data, user_id):
+    socketio.emit(event, for_wire(event, user_id, data), to=user_id)
+
+
+@signaling_event('sfu-join')
+def handle_sfu_join():
+    """Open the participant's peer connection to the SFU; the server sends the offer"""
+    room = registry.room_of(request.sid)
+    if sfu_router is not None and room is not None:
+        sfu_router.join(request.sid, room.room_id)
+
+
+@signaling_event('sfu-answer')
+def handle_sfu_answer(data):
+    if sfu_router is not None and registry.room_of(request.sid) is not None:
+        sfu_router.answer(request.sid, data['sdp'])
+
 
 if __name__ == '__main__':
-    port = 8080
+    import argparse
+    parser = argparse.ArgumentParser(description='NetStream Video Chat Server')
+    parser.add_argument('--host', default='0.0.0.0', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes to serve signaling with')
+    parser.add_argument('--message-queue', help='bus for cross-process emits: local:///path/bus.sock or redis://host:port/db')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-mode', default='sync', choices=['sync', 'queue'],
+                        help='queue: hand records to a writer thread instead of writing on the event loop')
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'])
+    parser.add_argument('--log-sample', default='',
+                        help='per-event sampling rates, e.g. candidate=0.1,chat-message=0.5')
+    parser.add_argument('--chat-dir', default=CHAT_DIR, help='directory for the on-disk chat history logs')
+    parser.add_argument('--transcript-dir', default=TRANSCRIPT_DIR, help='directory for the on-disk transcripts')
+    parser.add_argument('--connect-rate', type=float, default=CONNECT_RATE_LIMIT[0],
+                        help='connections accepted per second (per worker), with twice that as burst')
+    parser.add_argument('--sfu', action='store_true',
+                        help=f'route media through the server (needs aiortc), for rooms of up to {SFU_MAX_PARTICIPANTS}')
+    parser.add_argument('--turn', action='store_true',
+                        help='run a TURN relay next to the server; the shared secret is read from NETSTREAM_TURN_SECRET')
+    parser.add_argument('--turn-port', type=int, default=TURN_PORT, help='UDP and TCP port of the relay')
+    parser.add_argument('--turn-external-ip',
+                        help='address clients reach the relay at, if not the one it listens on (e.g. behind 1:1 NAT)')
+    parser.add_argument('--turn-relay-ports', help='range of UDP ports to relay from, e.g. 49152-65535')
+    parser.add_argument('--turn-allow-peer', action='append', default=[], metavar='CIDR',
+                        help='private network the relay may reach peers in, e.g. 10.0.0.0/8 (repeatable); '
+                             'private and CGNAT peers are refused otherwise')
+    parser.add_argument('--block-threshold', type=float, default=hubmonitor.BLOCK_THRESHOLD,
+                        help='seconds a greenlet may hold the event loop before its stack is recorded; 0 turns the monitor off')
+    parser.add_argument('--worker-channel-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--restore', help=argparse.SUPPRESS)
+    parser.add_argument('--ready-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.sfu and not sfu.available():
+        parser.error('--sfu needs aiortc: pip install aiortc')
+    if args.sfu and args.workers > 1:
+        parser.error('--sfu terminates media in one process and cannot be combined with --workers')
+    port = args.port
+    relay_ports = None
+    if args.turn_relay_ports:
+        low, _, high = args.turn_relay_ports.partition('-')
+        if not (low.isdigit() and high.isdigit() and int(low) <= int(high)):
+            parser.error('--turn-relay-ports takes a range, e.g. 49152-65535')
+        relay_ports = (int(low), int(high))
+    for network in args.turn_allow_peer:
+        try:
+            ipaddress.ip_network(network)
+        except ValueError:
+            parser.error(f'--turn-allow-peer takes a network, e.g. 10.0.0.0/8, not {network!r}')
+    configure_logging(getattr(logging, args.log_level), mode=args.log_mode, fmt=args.log_format,
+                      sample_rates=parse_sample_rates(args.log_sample))
+    chat_store.directory = args.chat_dir
+    transcripts.directory = args.transcript_dir
+    connect_bucket = TokenBucket(args.connect_rate, 2 * args.connect_rate)
+    worker_args = ['--chat-dir', args.chat_dir, '--transcript-dir', args.transcript_dir,
+                   '--connect-rate', str(args.connect_rate),
+                   '--log-level', args.log_level, '--log-mode', args.log_mode,
+                   '--log-format', args.log_format, '--log-sample', args.log_sample,
+                   '--block-threshold', str(args.block_threshold)]
+    if args.turn:
+        # Every process that mints credentials, and a successor after a restart, needs the same secret
+        os.environ.setdefault('NETSTREAM_TURN_SECRET', secrets.token_urlsafe(32))
+        relay_ip = args.turn_external_ip
+        if relay_ip is None:
+            relay_ip = args.host if args.host not in ('0.0.0.0', '') else turn.local_address()
+        turn_secret = os.environ['NETSTREAM_TURN_SECRET'].encode()
+        ice_directory.add_relay([f'turn:{relay_ip}:{args.turn_port}?transport=udp',
+                                 f'turn:{relay_ip}:{args.turn_port}?transport=tcp'], turn_secret, TURN_CREDENTIAL_TTL)
+        worker_args += ['--turn', '--turn-port', str(args.turn_port), '--turn-external-ip', relay_ip]
+
+    if args.worker_channel_fd is not None:
+        from workers import run_worker
+        if args.message_queue:
+            attach_message_bus(args.message_queue)
+        ice_directory.start()
+        start_hub_monitor(args.block_threshold)
+        run_worker(app, WebSocketHandler, args.worker_channel_fd)
+        raise SystemExit(0)
+
     print('NetStream Video Chat Server')
     print('---------------------------')
     print(f'Local access: http://localhost:{port}')
@@ -1099,9 +2894,55 @@ if __name__ == '__main__':
     print('Then share the ngrok URL with others')
     
     try:
-        http_server = WSGIServer(('0.0.0.0', port), app, handler_class=WebSocketHandler)
-        logger.info(f'Server running on http://0.0.0.0:{port}')
-        http_server.serve_forever()
+        if args.turn:
+            # With --workers the supervisor runs it, and /metrics (served by the workers) has no relay metrics
+            turn_server = turn.TurnServer((args.host, args.turn_port), turn_secret, relay_ip, relay_ports,
+                                         allowed_peers=args.turn_allow_peer)
+            for metric in turn_server.metrics:
+                metrics_registry.register(metric)
+            turn_server.start()
+        if args.workers > 1:
+            from workers import run_supervisor
+            broker = None
+            bus_url = args.message_queue
+            if bus_url is None:
+                bus_url = f'local://{tempfile.gettempdir()}/netstream-{port}.bus'
+            if bus_url.startswith('local://'):
+                broker = LocalBroker(bus_url[len('local://'):])
+                broker.start()
+            logger.info('Server running on http://%s:%d with %d workers', args.host, port, args.workers)
+            try:
+                run_supervisor((args.host, port), args.workers, ['--message-queue', bus_url] + worker_args)
+            finally:
+                if broker is not None:
+                    broker.stop()
+        else:
+            if args.message_queue:
+                attach_message_bus(args.message_queue)
+            ice_directory.start()
+            start_hub_monitor(args.block_threshold)
+            if args.sfu:
+                sfu_router = sfu.MediaRouter(sfu_emit)
+                registry.capacity = SFU_MAX_PARTICIPANTS
+                for metric in sfu_router.metrics:
+                    metrics_registry.register(metric)
+                sfu_router.start()
+            if args.listen_fd is not None:
+                # Successor of a graceful restart: same socket, and the calls of the old process
+                http_server = WSGIServer(inherit_listener(args.listen_fd), app, handler_class=WebSocketHandler)
+                if args.restore:
+                    state = read_snapshot(args.restore)
+                    restore_state(state, state['grace'])
+                    os.unlink(args.restore)
+            else:
+                http_server = WSGIServer((args.host, port), app, handler_class=WebSocketHandler)
+            http_server.start()
+            if args.ready_fd is not None:
+                signal_ready(args.ready_fd)
+            snapshot_path = os.path.join(tempfile.gettempdir(), f'netstream-{port}.snapshot')
+            gevent.signal_handler(signal.SIGHUP, lambda: gevent.spawn(graceful_restart, http_server, snapshot_path))
+            logger.info('Server running on http://%s:%d (pid %d, SIGHUP restarts gracefully)', args.host, port, os.getpid())
+            http_server.serve_forever()
     except OSError as e:
-        logger.error(f'Server error: {e}')
-        print(f'Server error: {e}')
\ No newline at end of file
+        logger.error('Server error: %s', e)
+        print(f'Server error: {e}')
@@ -0,0 +1,45 @@
+# NetStream - opt-in binary envelope for large signaling payloads
+#
+# A client that asks for it (query argument codec=msgpack) may receive, and
+# send, an event argument as one binary attachment instead of JSON: a format
+# byte followed by the msgpack encoding of the argument, deflated (zlib
+# format, which the browser's CompressionStream('deflate') speaks). Only
+# payloads whose msgpack encoding reaches COMPRESS_THRESHOLD are wrapped; a
+# small candidate costs less as plain JSON than as an attachment, which
+# Socket.IO sends as an extra websocket frame. Clients that never ask keep
+# getting plain JSON.
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; without it every client gets JSON
+    msgpack = None
+
+CODEC_NAME = 'msgpack'
+FORMAT_MSGPACK_DEFLATE = 0x01
+COMPRESS_THRESHOLD = 512  # bytes of msgpack below which a payload stays JSON
+COMPRESS_LEVEL = 6
+MAX_DECODED = 1 << 20  # refuse envelopes that inflate beyond this
+
+
+def available():
+    return msgpack is not None
+
+
+def encode(data):
+    """Return data wrapped in the binary envelope, or unchanged if it is too small to gain"""
+    packed = msgpack.packb(data, use_bin_type=True)
+    if len(packed) < COMPRESS_THRESHOLD:
+        return data
+    return bytes((FORMAT_MSGPACK_DEFLATE,)) + zlib.compress(packed, COMPRESS_LEVEL)
+
+
+def decode(payload):
+    """Unwrap an envelope received from a client"""
+    if not payload or payload[0] != FORMAT_MSGPACK_DEFLATE or msgpack is None:
+        raise ValueError('unknown wire format')
+    inflater = zlib.decompressobj()
+    packed = inflater.decompress(payload[1:], MAX_DECODED)
+    if inflater.unconsumed_tail:
+        raise ValueError('wire envelope too large')
+    return msgpack.unpackb(packed, raw=False)
@@ -0,0 +1,156 @@
+# NetStream - multi-worker serving
+#
+# The supervisor owns the listening socket and hands every accepted connection
+# to a worker process over a Unix socketpair (SCM_RIGHTS). Room state lives in
+# the worker that serves the room, so connections are routed by the `room`
+# query argument of their first request line: both sides of a call always land
+# in the same worker. Emits that do cross workers go through the message bus
+# (see netbus.py). For multi-node deployments the load balancer has to apply
+# the same rule, e.g. nginx `hash $arg_room consistent;`.
+import itertools
+import logging
+import os
+import signal
+import socket as stdlib_socket
+import sys
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+import gevent
+from gevent import socket, subprocess
+from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
+
+logger = logging.getLogger(__name__)
+
+PEEK_BYTES = 2048
+PEEK_TIMEOUT = 2.0  # seconds to wait for a request line before routing blindly
+
+
+def room_from_request_line(data):
+    """Extract the room query argument from the start of an HTTP request, or None"""
+    line = data.split(b'\r\n', 1)[0].decode('latin-1')
+    parts = line.split(' ')
+    if len(parts) < 2:
+        return None
+    rooms = parse_qs(urlsplit(parts[1]).query).get('room')
+    return rooms[0] if rooms else None
+
+
+class WorkerServer(WSGIServer):
+    """WSGIServer whose connections arrive as file descriptors from the supervisor.
+
+    The dispatch channel stands in for the listening socket: gevent watches it for
+    readability and do_read() receives the next connection instead of accept()ing one.
+    """
+
+    def do_read(self):
+        try:
+            _, fds, _, _ = stdlib_socket.recv_fds(self.socket, 1, 1)
+        except BlockingIOError:
+            return None
+        if not fds:
+            logger.error('Supervisor channel closed, worker exiting')
+            gevent.spawn(self.stop)
+            return None
+        conn = socket.socket(fileno=fds[0])
+        try:
+            address = conn.getpeername()
+        except OSError:
+            address = ('', 0)
+        return conn, address
+
+
+class Supervisor(StreamServer):
+    """Accepts connections and routes each one to a worker process by room id"""
+
+    def __init__(self, listener, workers, worker_args, env=None):
+        super().__init__(listener)
+        self.worker_count = workers
+        self.worker_args = worker_args
+        self.env = env
+        self.channels = [None] * workers
+        self.processes = [None] * workers
+        self.round_robin = itertools.count()
+
+    def start_workers(self):
+        for index in range(self.worker_count):
+            self.spawn_worker(index)
+            gevent.spawn(self.watch_worker, index)
+
+    def spawn_worker(self, index):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        command = [sys.executable, os.path.abspath(sys.argv[0]), '--worker-channel-fd', str(child.fileno())]
+        self.processes[index] = subprocess.Popen(command + self.worker_args, pass_fds=(child.fileno(),),
+                                                 env=self.env)
+        child.close()
+        self.channels[index] = parent
+        logger.info('Started worker %d (pid %d)', index, self.processes[index].pid)
+
+    def watch_worker(self, index):
+        while True:
+            code = self.processes[index].wait()
+            if not self.started:
+                return
+            logger.error('Worker %d exited with %s, restarting', index, code)
+            self.channels[index].close()
+            gevent.sleep(1)
+            self.spawn_worker(index)
+
+    def stop_workers(self, timeout=10):
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self.processes:
+            if process is not None:
+                try:
+                    process.wait(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    def pick_worker(self, room_id):
+        if room_id is None:
+            return next(self.round_robin) % self.worker_count
+        return zlib.crc32(room_id.encode('utf-8')) % self.worker_count
+
+    def peek_room(self, sock):
+        data = b''
+        with gevent.Timeout(PEEK_TIMEOUT, False):
+            while b'\r\n' not in data and len(data) < PEEK_BYTES:
+                peeked = sock.recv(PEEK_BYTES, socket.MSG_PEEK)
+                if not peeked:
+                    return None
+                if len(peeked) == len(data):
+                    gevent.sleep(0.005)  # the rest of the request line is still in flight
+                data = peeked
+        return room_from_request_line(data)
+
+    def handle(self, sock, address):
+        index = self.pick_worker(self.peek_room(sock))
+        try:
+            stdlib_socket.send_fds(self.channels[index], [b'c'], [sock.fileno()])
+        except OSError as exc:
+            logger.error('Cannot hand connection to worker %d: %s', index, exc)
+
+
+def run_worker(app, handler_class, channel_fd):
+    """Serve connections handed over by the supervisor until the channel closes"""
+    channel = socket.socket(fileno=channel_fd)
+    server = WorkerServer(channel, app, handler_class=handler_class)
+    gevent.signal_handler(signal.SIGTERM, server.stop)
+    server.serve_forever()
+
+
+def run_supervisor(address, workers, worker_args, env=None):
+    listener = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(1024)
+    supervisor = Supervisor(listener, workers, worker_args, env=env)
+    supervisor.start_workers()
+    gevent.signal_handler(signal.SIGTERM, supervisor.stop)
+    gevent.signal_handler(signal.SIGINT, supervisor.stop)
+    try:
+        supervisor.serve_forever()
+    finally:
+        supervisor.stop_workers()